@@ -0,0 +1,91 @@
+"""
+Compare the CPU time of serving a page of characters on a cache hit:
+- decoding, sorting and rendering the cached characters on every request
+- reusing the characters and their sorted orderings while the cached version does not change, rendering every page
+- serving the pages of the cached version pre-rendered
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/cache_hit_benchmark.py [--requests 200]
+Redis is replaced by an in-memory fakeredis, so only the work done in process is measured.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections.abc import Awaitable, Callable
+from unittest.mock import patch
+
+import cache
+import fakeredis
+from database import CharacterResponse
+from fastapi_pagination import Page, Params, paginate
+from fastapi_pagination.utils import disable_installed_extensions_check
+from pydantic import TypeAdapter
+from response_cache import cache_response, clear_cached_responses, get_cached_response
+from upstream_stub import make_character
+
+# Roughly the number of alive human characters from Earth in the upstream API
+REALISTIC_DATASET_SIZE = 200
+PARAMS = Params(page=1, size=50)
+PAGE_RESPONSE = TypeAdapter(Page[CharacterResponse])
+# The characters cached as plain JSON, as they were before the payload was encoded
+LEGACY_KEY = "legacy:characters"
+
+
+def render(characters: list[dict]) -> bytes:
+    """Validate and serialize a page as FastAPI does for the response model."""
+    return PAGE_RESPONSE.dump_json(PAGE_RESPONSE.validate_python(paginate(characters, PARAMS).model_dump()))
+
+
+async def decode_and_sort(order_by: str, descending: bool) -> bytes:
+    """How a page was served before the sorted orderings were kept per cached version."""
+    characters = json.loads((await cache.redis_client.get(LEGACY_KEY)).decode("utf-8"))["characters"]
+    return render(sorted(characters, key=lambda x: x[order_by], reverse=descending))
+
+
+async def reuse_sorted(order_by: str, descending: bool) -> bytes:
+    return render((await cache.get_cached_characters()).sorted_by(order_by, descending))
+
+
+async def pre_rendered(order_by: str, descending: bool) -> bytes:
+    cached = await cache.get_cached_characters()
+    key = (order_by, descending, PARAMS.page, PARAMS.size)
+    body = get_cached_response(cached.version, key)
+    if body is None:
+        body = render(cached.sorted_by(order_by, descending))
+        cache_response(cached.version, key, body)
+    return body
+
+
+async def measure(serve: Callable[[str, bool], Awaitable[bytes]], requests: int) -> float:
+    """CPU seconds per request, cycling through the sort orders."""
+    orders = [("id", False), ("id", True), ("name", False), ("name", True)]
+    start = time.process_time()
+    for request in range(requests):
+        await serve(*orders[request % len(orders)])
+    return (time.process_time() - start) / requests
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="cache hits to serve per measurement")
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=[1, 10, 100], help="multiples of the realistic dataset"
+    )
+    args = parser.parse_args()
+    disable_installed_extensions_check()
+
+    print(f"{'dataset':>8} {'decode and sort':>16} {'reuse sorted':>16} {'pre-rendered':>16}")
+    for scale in args.scales:
+        clear_cached_responses()
+        with patch("cache.redis_client", fakeredis.FakeAsyncRedis()):
+            characters = [make_character(i) for i in range(1, REALISTIC_DATASET_SIZE * scale + 1)]
+            token = await cache.acquire_lock("benchmark:lock")
+            await cache.set_cached_characters("benchmark:lock", token, characters)
+            await cache.redis_client.set(LEGACY_KEY, json.dumps({"updated_at": time.time(), "characters": characters}))
+            results = [await measure(serve, args.requests) for serve in (decode_and_sort, reuse_sorted, pre_rendered)]
+        print(f"{REALISTIC_DATASET_SIZE * scale:>8}", *(f"{elapsed * 1000:14.3f}ms" for elapsed in results))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
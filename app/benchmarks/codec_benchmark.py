@@ -0,0 +1,77 @@
+"""
+Compare the encoded size and the encode and decode time of the cached characters payload
+for every installed codec and compression.
+
+The payload is made of the upstream stub characters, as varied as the upstream ones, or of the characters recorded
+in `--recorded`, a JSON file of upstream pages or characters, e.g. saved with
+`curl "https://rickandmortyapi.com/api/character?species=Human&status=Alive&page=1" > page.json`.
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/codec_benchmark.py [--characters 200] [--repeat 20]
+       [--recorded page.json]
+"""
+
+import argparse
+import json
+import time
+from collections.abc import Callable
+
+from cache import CODECS, COMPRESSIONS, decode_payload, encode_payload
+from upstream_stub import make_character
+
+# Roughly the number of alive human characters from Earth in the upstream API
+REALISTIC_DATASET_SIZE = 200
+
+
+def best_of(function: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def read_recorded(path: str) -> list[dict]:
+    """Read the characters of a recorded upstream page, list of pages or list of characters."""
+    with open(path, encoding="utf-8") as file:
+        recorded = json.load(file)
+    pages = recorded if isinstance(recorded, list) else [recorded]
+    return [character for page in pages for character in page.get("results", [page])]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--characters", type=int, default=REALISTIC_DATASET_SIZE, help="characters in the payload")
+    parser.add_argument("--repeat", type=int, default=20, help="timings to take the best of")
+    parser.add_argument("--recorded", help="JSON file of recorded upstream pages or characters to encode instead")
+    args = parser.parse_args()
+
+    if args.recorded:
+        characters = read_recorded(args.recorded)
+        source = f"recorded upstream characters from {args.recorded}"
+    else:
+        characters = [make_character(character_id) for character_id in range(1, args.characters + 1)]
+        source = "upstream stub characters"
+    payload = {"updated_at": time.time(), "version": "0" * 40, "characters": characters}
+    legacy = json.dumps(payload).encode("utf-8")
+
+    print(f"Payload: {len(characters)} {source}, {len(legacy)} bytes of JSON\n")
+
+    print(f"{'codec':<22} {'bytes':>10} {'ratio':>6} {'encode':>10} {'decode':>10}")
+    print(
+        f"{'plain json (legacy)':<22} {len(legacy):>10} {1:>6.2f}",
+        f"{best_of(lambda: json.dumps(payload).encode('utf-8'), args.repeat) * 1000:8.3f}ms",
+        f"{best_of(lambda: decode_payload(legacy), args.repeat) * 1000:8.3f}ms",
+    )
+    for codec in CODECS:
+        for compression in COMPRESSIONS:
+            encoded = encode_payload(payload, codec=codec, compression=compression)
+            print(
+                f"{codec + '+' + compression:<22} {len(encoded):>10} {len(encoded) / len(legacy):>6.2f}",
+                f"{best_of(lambda: encode_payload(payload, codec, compression), args.repeat) * 1000:8.3f}ms",  # noqa: B023
+                f"{best_of(lambda: decode_payload(encoded), args.repeat) * 1000:8.3f}ms",  # noqa: B023
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compare the time from startup to the first successful /characters response of an app with an empty cache:
+- crawling the upstream API on the first request
+- caching the characters of a snapshot on startup, with the upstream API unreachable
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/cold_start_benchmark.py [--pages 42] [--latency 0.2]
+The app runs in process behind httpx.ASGITransport, Redis is an in-memory fakeredis and the database a SQLite file.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import statistics
+import tempfile
+import time
+from unittest.mock import patch
+
+os.environ.setdefault("OTEL_SDK_DISABLED", "true")
+
+import cache  # noqa: E402
+import characters  # noqa: E402
+import fakeredis  # noqa: E402
+import httpx  # noqa: E402
+from cache import CachedCharacters  # noqa: E402
+from database import Base  # noqa: E402
+from main import app, get_db  # noqa: E402
+from response_cache import clear_cached_responses  # noqa: E402
+from snapshot import read_snapshot, write_snapshot  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine  # noqa: E402
+from upstream import close_http_client  # noqa: E402
+from upstream_stub import UpstreamStub, make_character  # noqa: E402
+
+# Nothing listens on port 1, every upstream request fails right away
+UNREACHABLE_URL = "http://127.0.0.1:1/api/character?page="
+
+
+async def time_to_first_response(upstream_url: str, snapshot_path: str | None) -> float:
+    """Start the app with an empty cache and return the seconds until /characters answers 200."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{directory}/characters.db")
+        SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+        async def get_test_db():
+            async with SessionLocal() as db:
+                yield db
+
+        async def create_tables():
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+
+        redis_client = fakeredis.FakeAsyncRedis()
+        app.dependency_overrides[get_db] = get_test_db
+        cache.l1_invalidate()
+        clear_cached_responses()
+        try:
+            with (
+                patch("cache.redis_client", redis_client),
+                patch("healthcheck.redis_client", redis_client),
+                patch("healthcheck.engine", engine),
+                patch("main.engine", engine),
+                patch("characters.BASE_URL", upstream_url),
+                patch("characters.SessionLocal", SessionLocal),
+                patch("characters.SNAPSHOT_PATH", snapshot_path),
+                patch("main.create_tables", create_tables),
+                patch("main.REFRESHER_ENABLED", False),
+            ):
+                start = time.perf_counter()
+                async with app.router.lifespan_context(app):
+                    transport = httpx.ASGITransport(app=app)
+                    async with httpx.AsyncClient(transport=transport, base_url="http://app", timeout=None) as client:
+                        response = await client.get("/characters")
+                        response.raise_for_status()
+                        elapsed = time.perf_counter() - start
+
+                    # The snapshot is served stale, its refresh keeps retrying the unreachable upstream API
+                    if characters._background_refresh:
+                        characters._background_refresh.cancel()
+                        with contextlib.suppress(asyncio.CancelledError):
+                            await characters._background_refresh
+            return elapsed
+        finally:
+            app.dependency_overrides.pop(get_db, None)
+            await close_http_client()
+            await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=42, help="number of upstream pages, 42 as the upstream API")
+    parser.add_argument("--latency", type=float, default=0.2, help="upstream latency per page in seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="cold starts to take the median of")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, "characters.snapshot")
+        earth_characters = list(characters.filter_request(make_character(i) for i in range(1, args.pages * 20 + 1)))
+        size = write_snapshot(snapshot_path, CachedCharacters.from_characters(earth_characters))
+        start = time.perf_counter()
+        read_snapshot(snapshot_path)
+        read_time = time.perf_counter() - start
+        print(f"Snapshot of {len(earth_characters)} characters: {size} bytes, read in {read_time * 1000:.1f}ms\n")
+
+        with UpstreamStub(pages=args.pages, latency=args.latency) as stub:
+            crawl = statistics.median(asyncio.run(time_to_first_response(stub.url, None)) for _ in range(args.repeat))
+        snapshot = statistics.median(
+            asyncio.run(time_to_first_response(UNREACHABLE_URL, snapshot_path)) for _ in range(args.repeat)
+        )
+
+    print(f"{'cold start':<32} {'first response':>15}")
+    print(f"{'crawl the upstream API':<32} {crawl * 1000:13.1f}ms")
+    print(f"{'snapshot, upstream unreachable':<32} {snapshot * 1000:13.1f}ms {snapshot / crawl:7.1%} of the crawl")
+
+
+if __name__ == "__main__":
+    main()
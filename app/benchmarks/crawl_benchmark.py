@@ -0,0 +1,82 @@
+"""
+Compare the cold-miss crawl latency of the sequential page loop with the concurrent crawler,
+and the per-page cost of opening a new HTTP client for every page with the shared pooled client.
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/crawl_benchmark.py [--pages 20] [--latency 0.2]
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from unittest.mock import patch
+
+import fakeredis
+import governor
+import httpx
+from characters import crawl_characters, fetch_characters, filter_request
+from upstream import close_http_client, get_http_client
+from upstream_stub import UpstreamStub
+
+
+async def sequential_crawl(url: str) -> list[dict]:
+    """The page loop `get_all_characters` used before pages were fetched concurrently."""
+    characters = await fetch_characters(url, 1)
+    results = list(filter_request(characters["results"]))
+    for page in range(2, characters["info"]["pages"] + 1):
+        results.extend(filter_request((await fetch_characters(url, page))["results"]))
+    return results
+
+
+async def fresh_client_pages(url: str, pages: int) -> None:
+    """Fetch pages one by one, opening a new client per page as `fetch_characters` used to."""
+    for page in range(1, pages + 1):
+        async with httpx.AsyncClient(timeout=30) as client:
+            (await client.get(url + str(page))).raise_for_status()
+
+
+async def shared_client_pages(url: str, pages: int) -> None:
+    """Fetch pages one by one through the shared pooled client."""
+    for page in range(1, pages + 1):
+        (await get_http_client().get(url + str(page))).raise_for_status()
+
+
+async def measure(crawl, *args) -> tuple[float, float, int | None]:
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        results = await crawl(*args)
+    finally:
+        # The shared client is bound to the event loop of this run
+        await close_http_client()
+    return time.perf_counter() - start, time.process_time() - start_cpu, results and len(results)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=20, help="number of upstream pages")
+    parser.add_argument("--latency", type=float, default=0.2, help="upstream latency per page in seconds")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[2, 5, 10], help="concurrency limits to test")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    # The rate governor needs Redis, the crawls are compared ungoverned
+    governor.UPSTREAM_GOVERNOR_ENABLED = False
+
+    with UpstreamStub(pages=args.pages, latency=args.latency) as stub:
+        print("Cold-miss crawl")
+        elapsed, _, count = asyncio.run(measure(sequential_crawl, stub.url))
+        print(f"  {'sequential':<16} {elapsed:8.3f}s  {count} characters")
+        for concurrency in args.concurrency:
+            # Every crawl starts with an empty page cache
+            with patch("cache.redis_client", fakeredis.FakeAsyncRedis()):
+                elapsed, _, count = asyncio.run(measure(crawl_characters, stub.url, concurrency))
+            print(f"  {f'concurrency={concurrency}':<16} {elapsed:8.3f}s  {count} characters")
+
+    with UpstreamStub(pages=args.pages, latency=0) as stub:
+        print("Per-page cost")
+        for name, fetch_pages in (("new client", fresh_client_pages), ("shared client", shared_client_pages)):
+            elapsed, cpu, _ = asyncio.run(measure(fetch_pages, stub.url, args.pages))
+            print(f"  {name:<16} {elapsed / args.pages * 1000:8.2f}ms wall  {cpu / args.pages * 1000:8.2f}ms cpu")
+
+
+if __name__ == "__main__":
+    main()
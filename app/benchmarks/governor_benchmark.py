@@ -0,0 +1,71 @@
+"""
+Compare replicas crawling at once an upstream API enforcing a rate limit, with penalty windows when it is exceeded:
+- ungoverned: each replica sleeps on the `Retry-After` of its own 429 responses
+- governed: the replicas share the rate governor, configured just under the rate limit of the upstream API
+- governed, rate overestimated: the same, configured with twice that rate, left to the 429 pauses and the AIMD limit
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/governor_benchmark.py [--replicas 3] [--rate-limit 20]
+Replicas are concurrent crawls in one process sharing an in-memory fakeredis.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from unittest.mock import patch
+
+import fakeredis
+from characters import crawl_characters
+from upstream import close_http_client
+from upstream_stub import UpstreamStub
+
+
+async def crawl_replicas(url: str, replicas: int) -> tuple[float, list[int]]:
+    """Crawl with every replica at once, returning the seconds until the last is done and the characters of each."""
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(crawl_characters(url) for _ in range(replicas)))
+    finally:
+        await close_http_client()
+    return time.perf_counter() - start, [len(characters) for characters in results]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=3, help="replicas crawling at once")
+    parser.add_argument("--pages", type=int, default=42, help="number of upstream pages, 42 as the upstream API")
+    parser.add_argument("--latency", type=float, default=0.05, help="upstream latency per page in seconds")
+    parser.add_argument("--rate-limit", type=float, default=20, help="upstream requests per second")
+    parser.add_argument("--penalty", type=int, default=5, help="seconds of the penalty window, the Retry-After")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    expected = len([page for page in range(1, args.pages * 20 + 1) if page % 3 != 2])
+    print(f"{args.replicas} replicas crawling {args.pages} pages, the upstream API admits {args.rate_limit:g}/s")
+    print(f"{'':<30} {'crawl':>9} {'429s':>6} {'characters':>12}")
+    for name, enabled, rate in (
+        ("ungoverned", False, args.rate_limit),
+        ("governed", True, args.rate_limit * 0.9),
+        ("governed, rate overestimated", True, args.rate_limit * 2),
+    ):
+        with (
+            UpstreamStub(
+                pages=args.pages, latency=args.latency, rate_limit=args.rate_limit, retry_after=args.penalty
+            ) as stub,
+            patch("cache.redis_client", fakeredis.FakeAsyncRedis()),
+            patch("governor.UPSTREAM_GOVERNOR_ENABLED", enabled),
+            patch("governor.UPSTREAM_RATE_LIMIT", rate),
+            patch("governor.UPSTREAM_RATE_BURST", int(args.rate_limit / 2)),
+            # Throttled replicas must not open the breaker of the process they share
+            patch("upstream.upstream_breaker.minimum_calls", 10**9),
+        ):
+            elapsed, counts = asyncio.run(crawl_replicas(stub.url, args.replicas))
+            complete = sum(count == expected for count in counts)
+            print(
+                f"{name:<30} {elapsed:8.2f}s {stub.app.state.throttled:6}",
+                f"{complete:>5}/{args.replicas} complete",
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Compare how concurrent /characters requests are served when the data path blocks the event loop, as the
+synchronous Redis client, SQLAlchemy session and `time.sleep` backoff did, and when it awaits its I/O:
+- every Redis command taking `--redis-latency` seconds
+- one stale read triggering a background refresh that waits `--upstream-latency` seconds on the upstream API
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/load_benchmark.py [--requests 50]
+The app runs in process behind httpx.ASGITransport, Redis is an in-memory fakeredis and the database an in-memory
+SQLite, so only the latency added by the I/O waits is measured.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import time
+from unittest.mock import patch
+
+os.environ.setdefault("OTEL_SDK_DISABLED", "true")
+
+import cache  # noqa: E402
+import characters  # noqa: E402
+import fakeredis  # noqa: E402
+import httpx  # noqa: E402
+from database import Base  # noqa: E402
+from main import app, get_db  # noqa: E402
+from page_cache import CachedPage  # noqa: E402
+from response_cache import clear_cached_responses  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+from upstream_stub import make_character  # noqa: E402
+
+# Roughly the number of alive human characters from Earth in the upstream API
+REALISTIC_DATASET_SIZE = 200
+
+
+async def wait(latency: float, blocking: bool) -> None:
+    if blocking:
+        time.sleep(latency)
+    else:
+        await asyncio.sleep(latency)
+
+
+def with_latency(client: fakeredis.FakeAsyncRedis, latency: float, blocking: bool) -> fakeredis.FakeAsyncRedis:
+    """Make every command sent to `client` take `latency` seconds, blocking the event loop or not."""
+    execute_command = client.execute_command
+
+    async def slow_execute_command(*args, **options):
+        await wait(latency, blocking)
+        return await execute_command(*args, **options)
+
+    client.execute_command = slow_execute_command
+    return client
+
+
+async def serve(
+    requests: int, redis_latency: float, upstream_latency: float, blocking: bool
+) -> tuple[float, list[float]]:
+    """Send `requests` concurrent requests to /characters and return the wall time and the latency of each."""
+    dataset = [make_character(i) for i in range(1, REALISTIC_DATASET_SIZE + 1)]
+
+    async def crawl_pages(url: str) -> characters.Crawl:
+        await wait(upstream_latency, blocking)
+        return characters.Crawl(cached=[None], pages=[CachedPage(pages=1, characters=dataset, digest="")])
+
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+    async def get_test_db():
+        async with SessionLocal() as db:
+            yield db
+
+    async def create_tables():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+    redis_client = fakeredis.FakeAsyncRedis()
+    app.dependency_overrides[get_db] = get_test_db
+    cache.l1_invalidate()
+    clear_cached_responses()
+    try:
+        with (
+            patch("cache.redis_client", redis_client),
+            patch("cache.API_RATE_LIMIT", 10**9),
+            # Refresh the characters in the background on every read once `upstream_latency` is set
+            patch("cache.CACHE_SOFT_TTL", 0 if upstream_latency else 10**9),
+            patch("characters.crawl_pages", crawl_pages),
+            patch("characters.SessionLocal", SessionLocal),
+            patch("main.create_tables", create_tables),
+            patch("main.REFRESHER_ENABLED", False),
+        ):
+            async with app.router.lifespan_context(app):
+                token = await cache.acquire_lock("benchmark:lock")
+                await cache.set_cached_characters("benchmark:lock", token, dataset)
+                await cache.release_lock("benchmark:lock", token)
+                with_latency(redis_client, redis_latency, blocking)
+
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+
+                    async def request(number: int) -> float:
+                        start = time.perf_counter()
+                        response = await client.get("/characters", headers={"X-API-Key": f"client-{number}"})
+                        response.raise_for_status()
+                        return time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    latencies = await asyncio.gather(*(request(number) for number in range(requests)))
+                    wall = time.perf_counter() - start
+
+                # Let a background refresh started by the requests finish before tearing down
+                if characters._background_refresh:
+                    await characters._background_refresh
+        return wall, latencies
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50, help="concurrent requests per measurement")
+    parser.add_argument("--redis-latency", type=float, default=0.005, help="seconds per Redis command")
+    parser.add_argument("--upstream-latency", type=float, default=0.5, help="seconds per upstream crawl")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print(f"{'scenario':<18} {'data path':<12} {'wall':>9} {'p50':>9} {'p99':>9} {'max':>9}")
+    for scenario, redis_latency, upstream_latency in (
+        ("slow redis", args.redis_latency, 0),
+        ("slow upstream", 0, args.upstream_latency),
+    ):
+        for name, blocking in (("blocking", True), ("async", False)):
+            wall, latencies = asyncio.run(serve(args.requests, redis_latency, upstream_latency, blocking))
+            p50, p99 = (statistics.quantiles(latencies, n=100)[index] for index in (49, 98))
+            print(
+                f"{scenario:<18} {name:<12} {wall:8.3f}s",
+                *(f"{value * 1000:7.1f}ms" for value in (p50, p99, max(latencies))),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Compare the per-request overhead of the Prometheus middleware built on BaseHTTPMiddleware, which resolved the route
+of every request by matching it against every route, with the pure ASGI middleware resolving each path once.
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/middleware_benchmark.py [--requests 2000] [--routes 20]
+Requests are sent one at a time through httpx.ASGITransport to a FastAPI app with `--routes` routes, the requested
+route being the last one, so only the time spent in the middleware differs between the apps.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault("OTEL_SDK_DISABLED", "true")
+
+import httpx  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import StreamingResponse  # noqa: E402
+from opentelemetry import trace  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import Response  # noqa: E402
+from starlette.routing import Match  # noqa: E402
+from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR  # noqa: E402
+from starlette.types import ASGIApp  # noqa: E402
+from utils import (  # noqa: E402
+    EXCEPTIONS,
+    INFO,
+    REQUESTS,
+    REQUESTS_IN_PROGRESS,
+    REQUESTS_PROCESSING_TIME,
+    RESPONSES,
+    PrometheusMiddleware,
+)
+
+
+class LegacyPrometheusMiddleware(BaseHTTPMiddleware):
+    """The Prometheus middleware before it was rewritten as a pure ASGI middleware."""
+
+    def __init__(self, app: ASGIApp, app_name: str = "fastapi-app") -> None:
+        super().__init__(app)
+        self.app_name = app_name
+        INFO.labels(app_name=self.app_name).inc()
+
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        method = request.method
+        path, is_handled_path = self.get_path(request)
+
+        if not is_handled_path:
+            return await call_next(request)
+
+        REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).inc()
+        REQUESTS.labels(method=method, path=path, app_name=self.app_name).inc()
+        before_time = time.perf_counter()
+        try:
+            response = await call_next(request)
+        except BaseException as e:
+            status_code = HTTP_500_INTERNAL_SERVER_ERROR
+            EXCEPTIONS.labels(method=method, path=path, status_code=str(status_code), app_name=self.app_name).inc()
+            raise e from None
+        else:
+            status_code = response.status_code
+            after_time = time.perf_counter()
+            span = trace.get_current_span()
+            trace_id = trace.format_trace_id(span.get_span_context().trace_id)
+
+            REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=self.app_name).observe(
+                after_time - before_time, exemplar={"TraceID": trace_id}
+            )
+        finally:
+            RESPONSES.labels(method=method, path=path, status_code=status_code, app_name=self.app_name).inc()
+
+            if 400 <= status_code < 600:
+                EXCEPTIONS.labels(method=method, path=path, status_code=str(status_code), app_name=self.app_name).inc()
+
+            REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).dec()
+
+        return response
+
+    @staticmethod
+    def get_path(request: Request) -> tuple[str, bool]:
+        for route in request.app.routes:
+            match, child_scope = route.matches(request.scope)
+            if match == Match.FULL:
+                return route.path, True
+
+        return request.url.path, False
+
+
+def create_app(middleware: type | None, routes: int) -> FastAPI:
+    app = FastAPI()
+    if middleware is not None:
+        app.add_middleware(middleware, f"benchmark-{middleware.__name__}")
+
+    for number in range(routes - 1):
+        app.add_api_route(f"/route-{number}/{{item_id}}", lambda item_id: {"id": item_id})
+
+    @app.get("/characters/{character_id}")
+    async def character(character_id: int):
+        return {"id": character_id}
+
+    @app.get("/stream/{character_id}")
+    async def stream(character_id: int):
+        async def chunks():
+            for _ in range(4):
+                yield b"chunk"
+
+        return StreamingResponse(chunks())
+
+    return app
+
+
+async def time_requests(app: FastAPI, path: str, requests: int) -> list[float]:
+    """Send `requests` requests to `path` one at a time and return the latency of each."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        # Warm up the route caches and the label children
+        for _ in range(10):
+            await client.get(path)
+
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = await client.get(path)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per measurement")
+    parser.add_argument("--routes", type=int, default=20, help="routes of the app")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements to take the best of")
+    args = parser.parse_args()
+
+    middlewares = {"none": None, "BaseHTTPMiddleware": LegacyPrometheusMiddleware, "pure ASGI": PrometheusMiddleware}
+    print(f"{'response':<10} {'middleware':<22} {'p50':>9} {'p99':>9} {'overhead':>9}")
+    for response, path in (("json", "/characters/1"), ("streaming", "/stream/1")):
+        apps = {name: create_app(middleware, args.routes) for name, middleware in middlewares.items()}
+        quantiles = {name: [] for name in middlewares}
+        # Interleave the measurements so that every middleware sees the same machine noise
+        for _ in range(args.repeat):
+            for name, app in apps.items():
+                latencies = asyncio.run(time_requests(app, path, args.requests))
+                quantiles[name].append([statistics.quantiles(latencies, n=100)[index] for index in (49, 98)])
+
+        baseline = min(p50 for p50, _ in quantiles["none"])
+        for name in middlewares:
+            p50, p99 = min(quantiles[name])
+            print(f"{response:<10} {name:<22}", *(f"{value * 1e6:7.0f}us" for value in (p50, p99, p50 - baseline)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Compare the round trips and time per request of the rate limiter doing a GET then a SETEX or INCR with the
+single-script limiters, sliding window and token bucket.
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/rate_limit_benchmark.py [--url redis://localhost:6379]
+Without a URL Redis is replaced by an in-memory fakeredis, so only the round trips are meaningful.
+"""
+
+import argparse
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from unittest.mock import patch
+
+import cache
+import fakeredis
+import redis.asyncio
+
+
+async def get_then_incr(client: str) -> bool:
+    """How `is_rate_limited` counted requests before the limiter was a script, with one key for every client."""
+    current = await cache.redis_client.get("api_request_count")
+    if current is None:
+        await cache.redis_client.setex("api_request_count", cache.API_RATE_WINDOW, 1)
+        return False
+    if int(current) >= cache.API_RATE_LIMIT:
+        return True
+    await cache.redis_client.incr("api_request_count")
+    return False
+
+
+async def measure(limit: Callable[[str], Awaitable[object]], requests: int) -> tuple[float, float]:
+    """Seconds and round trips per request, spread over 100 clients."""
+    round_trips = 0
+    execute_command = cache.redis_client.execute_command
+
+    def count_round_trip(*args, **kwargs):
+        nonlocal round_trips
+        round_trips += 1
+        return execute_command(*args, **kwargs)
+
+    with patch.object(cache.redis_client, "execute_command", count_round_trip):
+        start = time.perf_counter()
+        for request in range(requests):
+            await limit(f"ip:{request % 100}")
+        elapsed = time.perf_counter() - start
+    return elapsed / requests, round_trips / requests
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Redis URL, e.g. redis://localhost:6379")
+    parser.add_argument("--requests", type=int, default=2000, help="requests to rate limit per measurement")
+    args = parser.parse_args()
+
+    client = redis.asyncio.Redis.from_url(args.url) if args.url else fakeredis.FakeAsyncRedis()
+    print(f"{'limiter':<16} {'per request':>12} {'round trips':>12}")
+    with (
+        patch("cache.redis_client", client),
+        patch("cache.API_RATE_LIMIT", 10**9),
+        patch("cache.API_RATE_BURST", 10**9),
+    ):
+        for name, limit, algorithm in (
+            ("get then incr", get_then_incr, None),
+            ("sliding window", cache.rate_limit, "sliding_window"),
+            ("token bucket", cache.rate_limit, "token_bucket"),
+        ):
+            await client.flushdb()
+            with patch("cache.API_RATE_ALGORITHM", algorithm):
+                # Load the scripts first, as a running app has
+                await limit("warmup")
+                elapsed, round_trips = await measure(limit, args.requests)
+            print(f"{name:<16} {elapsed * 1e6:10.1f}us {round_trips:12.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""
+Compare what refreshing the characters costs with and without the per-page cache, for a first refresh, a refresh where
+nothing changed upstream and a refresh where one page changed:
+- no page cache: every page is downloaded, parsed and upserted again, as refreshes used to
+- page cache, ETag: pages are requested conditionally and the upstream API answers 304 for the unchanged ones
+- page cache, content hash: the upstream API sends no validators, unchanged pages are recognized by their body
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/refresh_benchmark.py [--pages 42]
+Redis is an in-memory fakeredis and Postgres a SQLite database.
+"""
+
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+from unittest.mock import patch
+
+import fakeredis
+from characters import refresh_characters
+from database import Base
+from page_cache import CachedPage, get_cached_page
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from upstream import close_http_client
+from upstream_stub import UpstreamStub
+
+
+async def no_cached_page(url: str, page: int) -> CachedPage | None:
+    return None
+
+
+async def refresh(engine: AsyncEngine, stub: UpstreamStub) -> tuple[float, int, int, int]:
+    """
+    Refresh the characters, returning the seconds it took, the upstream bytes, and the write statements sent to the
+    database and the rows they wrote.
+    """
+    statements = rows_written = 0
+
+    def count_rows(conn, cursor, statement, parameters, context, executemany) -> None:
+        nonlocal statements, rows_written
+        if statement.startswith(("INSERT", "UPDATE", "DELETE")):
+            statements += 1
+            rows_written += max(cursor.rowcount, 0)
+
+    bytes_sent = stub.app.state.bytes_sent
+    event.listen(engine.sync_engine, "after_cursor_execute", count_rows)
+    try:
+        async with async_sessionmaker(bind=engine, expire_on_commit=False)() as db:
+            start = time.perf_counter()
+            await refresh_characters(db)
+            elapsed = time.perf_counter() - start
+    finally:
+        event.remove(engine.sync_engine, "after_cursor_execute", count_rows)
+    return elapsed, stub.app.state.bytes_sent - bytes_sent, statements, rows_written
+
+
+async def refreshes(engine: AsyncEngine, stub: UpstreamStub) -> list[tuple[float, int, int, int]]:
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    try:
+        results = [await refresh(engine, stub), await refresh(engine, stub)]
+        stub.app.state.edited_pages.add(2)
+        results.append(await refresh(engine, stub))
+        return results
+    finally:
+        await close_http_client()
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=42, help="number of upstream pages, 42 as the upstream API")
+    parser.add_argument("--latency", type=float, default=0.05, help="upstream latency per page in seconds")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"Refreshing {args.pages} upstream pages")
+    print(f"{'':<26} {'refresh':<18} {'time':>9} {'upstream bytes':>15} {'write statements':>17} {'rows written':>13}")
+    for name, etags, page_cache in (
+        ("no page cache", True, False),
+        ("page cache, ETag", True, True),
+        ("page cache, content hash", False, True),
+    ):
+        with (
+            tempfile.TemporaryDirectory() as directory,
+            UpstreamStub(pages=args.pages, latency=args.latency, etags=etags) as stub,
+            patch("cache.redis_client", fakeredis.FakeAsyncRedis()),
+            patch("characters.BASE_URL", stub.url),
+            # The stub does not rate limit
+            patch("governor.UPSTREAM_RATE_LIMIT", 10**9),
+            patch("characters.get_cached_page", get_cached_page if page_cache else no_cached_page),
+        ):
+            engine = create_async_engine(f"sqlite+aiosqlite:///{directory}/characters.db")
+            results = asyncio.run(refreshes(engine, stub))
+        for refresh_name, (elapsed, bytes_sent, statements, rows_written) in zip(
+            ("first", "unchanged", "one page changed"), results, strict=True
+        ):
+            print(f"{name:<26} {refresh_name:<18} {elapsed:8.3f}s {bytes_sent:15,} {statements:17} {rows_written:13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Run named load scenarios against the app and compare their throughput and latency percentiles with a stored baseline:
+- cold_miss: every request finds the cache and the database empty and crawls the upstream API
+- cold_miss_throttled: the same, with the upstream API answering 429 to every `--throttle-every` request
+- redis_cold: every request finds Redis empty and restores the characters saved to the database
+- warm_hit: concurrent requests for the first page of the cached characters
+- deep_pages: concurrent requests for the last pages, served from the cache
+- deep_pages_database: concurrent requests for the last pages, queried from the database
+- sort_variants: concurrent requests for the first pages in every sort order
+- healthcheck_storm: concurrent readiness probes, served by the background health checker, and deep health checks
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/suite_benchmark.py [--scenarios warm_hit deep_pages]
+The app runs in process behind httpx.ASGITransport against the local upstream stub, Redis is an in-memory fakeredis and
+Postgres a SQLite database, so the results are reproducible without any service running.
+
+The deep health checks run as written, only the Postgres statistics they read and the Redis INFO command, which SQLite
+and fakeredis lack, are answered by stand-ins.
+
+Every run of a scenario follows sequential `/livez` requests, the reference request, and the baseline stores the
+measures of the run relative to it: the throughput in requests per reference request and the percentiles in reference
+requests. Baselines recorded on one machine remain comparable on a faster or slower one, the scenarios waiting on the
+upstream stub, whose latency is fixed, less so. Scenarios regressing by more than `--threshold` (lower throughput,
+higher p95 or p99) than in the baseline make the run fail. Record a new baseline with `--save-baseline` after a change
+expected to move the numbers.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from functools import partial
+from pathlib import Path
+from typing import NamedTuple
+from unittest.mock import patch
+
+os.environ.setdefault("OTEL_SDK_DISABLED", "true")
+
+import cache  # noqa: E402
+import fakeredis  # noqa: E402
+import httpx  # noqa: E402
+from database import Base  # noqa: E402
+from main import app, get_db  # noqa: E402
+from response_cache import clear_cached_responses  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine  # noqa: E402
+from upstream import close_http_client  # noqa: E402
+from upstream_stub import UpstreamStub  # noqa: E402
+
+BASELINE = Path(__file__).with_name("baseline.json")
+# Options the baseline was recorded with, results are only comparable when they match
+COMPARED_OPTIONS = ("pages", "latency", "throttle_every", "requests", "concurrency", "cold_requests", "repeat")
+# How often the background checker runs the deep health checks, several times during the health check storm
+HEALTH_CHECK_INTERVAL = 0.05  # seconds
+# Postgres statistics queries of the deep database check and the SQLite queries answering them
+POSTGRES_STATISTICS = {
+    "pg_database_size": "SELECT (page_count * page_size) || ' bytes' FROM pragma_page_count(), pragma_page_size()",
+    "pg_stat_activity": "SELECT 0",
+}
+
+
+async def flush_cache() -> None:
+    await cache.redis_client.flushall()
+    cache.l1_invalidate()
+    clear_cached_responses()
+
+
+def cycle(paths: list[str], requests: int) -> list[str]:
+    return [paths[number % len(paths)] for number in range(requests)]
+
+
+def last_pages(pages: int, size: int = 20) -> list[str]:
+    """Paths of the last pages of the characters crawled from `pages` upstream pages, two thirds are from Earth."""
+    last_page = max(pages * 20 * 2 // 3 // size, 1)
+    return [f"/characters?page={page}&size={size}" for page in range(max(last_page - 4, 1), last_page + 1)]
+
+
+async def cold_miss(client: httpx.AsyncClient, args: argparse.Namespace) -> list[float]:
+    latencies = []
+    for _ in range(args.cold_requests):
+        await flush_cache()
+        latencies.append(await timed_get(client, "/characters"))
+    return latencies
+
+
+async def redis_cold(client: httpx.AsyncClient, args: argparse.Namespace) -> list[float]:
+    # The first request crawls and saves the characters to the database, the next ones restore them from it
+    await timed_get(client, "/characters")
+    latencies = []
+    for _ in range(args.cold_requests):
+        await flush_cache()
+        latencies.append(await timed_get(client, "/characters"))
+    return latencies
+
+
+async def warm_hit(client: httpx.AsyncClient, args: argparse.Namespace) -> list[float]:
+    await timed_get(client, "/characters")
+    return await concurrent_gets(client, ["/characters"] * args.requests, args.concurrency)
+
+
+async def deep_pages(client: httpx.AsyncClient, args: argparse.Namespace) -> list[float]:
+    await timed_get(client, "/characters")
+    return await concurrent_gets(client, cycle(last_pages(args.pages), args.requests), args.concurrency)
+
+
+async def sort_variants(client: httpx.AsyncClient, args: argparse.Namespace) -> list[float]:
+    await timed_get(client, "/characters")
+    paths = [
+        f"/characters?order_by={order_by}&order={order}&page={page}"
+        for order_by in ("id", "name")
+        for order in ("asc", "desc")
+        for page in range(1, 6)
+    ]
+    return await concurrent_gets(client, cycle(paths, args.requests), args.concurrency)
+
+
+async def healthcheck_storm(client: httpx.AsyncClient, args: argparse.Namespace) -> list[float]:
+    return await concurrent_gets(client, cycle(["/readyz"] * 9 + ["/healthcheck"], args.requests), args.concurrency)
+
+
+async def reference(client: httpx.AsyncClient, args: argparse.Namespace) -> list[float]:
+    return [await timed_get(client, "/livez") for _ in range(args.requests)]
+
+
+def create_health_check_engine(url: str) -> AsyncEngine:
+    """
+    Create an engine on the SQLite database `url` able to run the deep database check.
+
+    Its transactions include the DDL, as in Postgres, so the temporary table of a check is dropped with its rollback,
+    and the Postgres statistics queries are answered by POSTGRES_STATISTICS.
+    """
+    engine = create_async_engine(url)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute", retval=True)
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        query = next((query for table, query in POSTGRES_STATISTICS.items() if table in statement), statement)
+        return query, parameters
+
+    return engine
+
+
+async def fakeredis_info(redis_client: fakeredis.FakeAsyncRedis, section: str | None = None) -> dict:
+    """INFO of fakeredis, which does not implement the command, reporting no memory used and no limit."""
+    await redis_client.ping()
+    return {"used_memory": 0, "maxmemory": 0}
+
+
+class Scenario(NamedTuple):
+    # Run the scenario and return its latencies
+    run: Callable[[httpx.AsyncClient, argparse.Namespace], Awaitable[list[float]]]
+    source: str = "cache"  # CHARACTERS_SOURCE
+    throttled: bool = False  # whether the upstream API throttles
+    database_fallback: bool = True  # DATABASE_FALLBACK_ENABLED
+
+
+# Sequential requests for /livez, the measures of the scenarios are stored relative to
+REFERENCE = Scenario(reference)
+
+
+SCENARIOS: dict[str, Scenario] = {
+    "cold_miss": Scenario(cold_miss, database_fallback=False),
+    "cold_miss_throttled": Scenario(cold_miss, throttled=True, database_fallback=False),
+    "redis_cold": Scenario(redis_cold),
+    "warm_hit": Scenario(warm_hit),
+    "deep_pages": Scenario(deep_pages),
+    "deep_pages_database": Scenario(deep_pages, source="database"),
+    "sort_variants": Scenario(sort_variants),
+    "healthcheck_storm": Scenario(healthcheck_storm),
+}
+
+
+async def timed_get(client: httpx.AsyncClient, path: str, expected: tuple[int, ...] = (200,)) -> float:
+    start = time.perf_counter()
+    response = await client.get(path)
+    if response.status_code not in expected:
+        raise RuntimeError(f"GET {path} answered {response.status_code}: {response.text[:200]}")
+    return time.perf_counter() - start
+
+
+async def concurrent_gets(
+    client: httpx.AsyncClient, paths: list[str], concurrency: int, expected: tuple[int, ...] = (200,)
+) -> list[float]:
+    """Request every path with at most `concurrency` requests in flight and return the latency of each."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get(path: str) -> float:
+        async with semaphore:
+            return await timed_get(client, path, expected)
+
+    return await asyncio.gather(*(get(path) for path in paths))
+
+
+async def run_scenario(scenario: Scenario, upstream_url: str, args: argparse.Namespace) -> dict[str, float]:
+    """Run a scenario against a fresh app, cache and database, and return its throughput and latency percentiles."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{directory}/characters.db")
+        health_check_engine = create_health_check_engine(f"sqlite+aiosqlite:///{directory}/characters.db")
+        SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+        async def get_test_db():
+            async with SessionLocal() as db:
+                yield db
+
+        async def create_tables():
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+
+        redis_client = fakeredis.FakeAsyncRedis()
+        app.dependency_overrides[get_db] = get_test_db
+        try:
+            with (
+                patch("cache.redis_client", redis_client),
+                patch("healthcheck.redis_client", redis_client),
+                patch.object(redis_client, "info", partial(fakeredis_info, redis_client)),
+                patch("healthcheck.engine", health_check_engine),
+                patch("healthcheck.HEALTH_CHECK_INTERVAL", HEALTH_CHECK_INTERVAL),
+                patch("main.engine", engine),
+                patch("cache.API_RATE_LIMIT", 10**9),
+                # The stub does not rate limit, the cold misses crawl as fast as it answers
+                patch("governor.UPSTREAM_RATE_LIMIT", 10**9),
+                patch("characters.BASE_URL", upstream_url),
+                patch("characters.SessionLocal", SessionLocal),
+                patch("main.create_tables", create_tables),
+                patch("main.REFRESHER_ENABLED", False),
+                patch("main.CHARACTERS_SOURCE", scenario.source),
+                patch("characters.DATABASE_FALLBACK_ENABLED", scenario.database_fallback),
+            ):
+                await flush_cache()
+                async with app.router.lifespan_context(app):
+                    transport = httpx.ASGITransport(app=app)
+                    async with httpx.AsyncClient(transport=transport, base_url="http://app", timeout=None) as client:
+                        start = time.perf_counter()
+                        latencies = await scenario.run(client, args)
+                        wall = time.perf_counter() - start
+        finally:
+            app.dependency_overrides.pop(get_db, None)
+            await close_http_client()
+            await engine.dispose()
+            await health_check_engine.dispose()
+
+    p50, p95, p99 = (statistics.quantiles(latencies, n=100, method="inclusive")[index] for index in (49, 94, 98))
+    return {"throughput": len(latencies) / wall, "p50": p50 * 1000, "p95": p95 * 1000, "p99": p99 * 1000}
+
+
+def regressions(result: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """Return the measures of `result` worse than in `baseline` by more than `threshold`."""
+    worse = []
+    if result["throughput"] < baseline["throughput"] * (1 - threshold):
+        worse.append("throughput")
+    worse.extend(measure for measure in ("p95", "p99") if result[measure] > baseline[measure] * (1 + threshold))
+    return worse
+
+
+def relative(result: dict[str, float], reference_ms: float) -> dict[str, float]:
+    """Return the measures of `result` relative to the latency of the reference request, as stored in the baseline."""
+    return {
+        measure: value * reference_ms / 1000 if measure == "throughput" else value / reference_ms
+        for measure, value in result.items()
+    }
+
+
+def change(value: float, baseline: float | None) -> str:
+    return f"{(value / baseline - 1) * 100:+6.1f}%" if baseline else ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS), help="scenarios to run")
+    parser.add_argument("--pages", type=int, default=10, help="number of upstream pages")
+    parser.add_argument("--latency", type=float, default=0.02, help="upstream latency per page in seconds")
+    parser.add_argument("--throttle-every", type=int, default=4, help="upstream requests per 429 when throttled")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight")
+    parser.add_argument("--cold-requests", type=int, default=10, help="requests of the cold miss scenarios")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every scenario to take the median of")
+    parser.add_argument("--baseline", type=Path, default=BASELINE, help="baseline to compare with")
+    parser.add_argument("--threshold", type=float, default=0.3, help="regression tolerated, as a fraction")
+    parser.add_argument("--save-baseline", action="store_true", help="record the results as the new baseline")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    options = {option: getattr(args, option) for option in COMPARED_OPTIONS}
+    stored = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    baseline = stored.get("scenarios", {}) if stored.get("options") == options else {}
+    if stored and not baseline:
+        print(f"The baseline was recorded with other options ({stored.get('options')}), not comparing", file=sys.stderr)
+
+    results = {}
+    with (
+        UpstreamStub(pages=args.pages, latency=args.latency) as stub,
+        UpstreamStub(pages=args.pages, latency=args.latency, throttle_every=args.throttle_every) as throttled_stub,
+    ):
+        print(
+            f"{'scenario':<22} {'req/s':>9} {'':>8} {'p50':>9} {'p95':>9} {'':>8} {'p99':>9} {'':>8} {'reference':>9}"
+        )
+        failed = []
+        for name in args.scenarios:
+            upstream_url = throttled_stub.url if SCENARIOS[name].throttled else stub.url
+            # Every run is compared with a reference timed right before it, on the machine as loaded as for the run
+            runs = []
+            for _ in range(args.repeat):
+                reference_ms = asyncio.run(run_scenario(REFERENCE, stub.url, args))["p50"]
+                runs.append((asyncio.run(run_scenario(SCENARIOS[name], upstream_url, args)), reference_ms))
+            # The median of every measure over the runs, a single run is too noisy to compare
+            result = {measure: statistics.median(run[measure] for run, _ in runs) for measure in runs[0][0]}
+            relative_runs = [relative(run, reference_ms) for run, reference_ms in runs]
+            compared = results[name] = {
+                measure: statistics.median(run[measure] for run in relative_runs) for measure in result
+            }
+            reference_ms = statistics.median(reference_ms for _, reference_ms in runs)
+            base = baseline.get(name, {})
+            worse = regressions(compared, base, args.threshold) if base else []
+            if worse:
+                failed.append(f"{name} ({', '.join(worse)})")
+            print(
+                f"{name:<22} {result['throughput']:9.1f} {change(compared['throughput'], base.get('throughput')):>8}",
+                f"{result['p50']:7.1f}ms {result['p95']:7.1f}ms {change(compared['p95'], base.get('p95')):>8}",
+                f"{result['p99']:7.1f}ms {change(compared['p99'], base.get('p99')):>8}",
+                f"{reference_ms:7.2f}ms",
+                "REGRESSION" if worse else "",
+            )
+
+    if args.save_baseline:
+        scenarios = {
+            **baseline,
+            **{name: {key: float(f"{value:.4g}") for key, value in result.items()} for name, result in results.items()},
+        }
+        args.baseline.write_text(json.dumps({"options": options, "scenarios": scenarios}, indent=2) + "\n")
+        print(f"Saved the baseline to {args.baseline}")
+    elif failed:
+        sys.exit(f"Regressed by more than {args.threshold:.0%}: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
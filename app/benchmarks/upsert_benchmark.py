@@ -0,0 +1,78 @@
+"""
+Compare round trips and wall time of saving characters with one session.merge per row and with the batched upsert,
+for the first load of the characters and for a refresh where nothing changed.
+
+Usage: PYTHONPATH="app/src:app/benchmarks" python app/benchmarks/upsert_benchmark.py [--url postgresql+asyncpg://...]
+The database defaults to the one configured with the POSTGRES_* environment variables.
+"""
+
+import argparse
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+
+from database import SQLALCHEMY_DATABASE_URL, Base, Character, save_characters_to_db
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from upstream_stub import make_character
+
+# Roughly the number of alive human characters from Earth in the upstream API
+REALISTIC_DATASET_SIZE = 200
+
+
+async def merge_characters_to_db(characters: list[dict], db: AsyncSession) -> None:
+    """How `save_characters_to_db` used to save the characters."""
+    for character in characters:
+        await db.merge(Character(**character))
+    await db.commit()
+
+
+async def measure(
+    engine: AsyncEngine, save: Callable[[list[dict], AsyncSession], Awaitable[object]], characters: list[dict]
+) -> tuple[float, int]:
+    round_trips = 0
+
+    def count_round_trip(*args) -> None:
+        nonlocal round_trips
+        round_trips += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_round_trip)
+    try:
+        async with async_sessionmaker(bind=engine)() as db:
+            start = time.perf_counter()
+            await save(characters, db)
+            return time.perf_counter() - start, round_trips
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", count_round_trip)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=SQLALCHEMY_DATABASE_URL, help="SQLAlchemy database URL")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 100], help="multiples of the realistic dataset")
+    args = parser.parse_args()
+
+    engine = create_async_engine(args.url)
+    print(f"{'dataset':>8} {'method':<8} {'load':>29} {'unchanged refresh':>29}")
+    for scale in args.scales:
+        characters = [
+            {**character, "created": datetime.fromisoformat(character["created"])}
+            for character in map(make_character, range(1, REALISTIC_DATASET_SIZE * scale + 1))
+        ]
+        for name, save in (("merge", merge_characters_to_db), ("upsert", save_characters_to_db)):
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.drop_all, tables=[Character.__table__])
+                await connection.run_sync(Base.metadata.create_all, tables=[Character.__table__])
+            results = [await measure(engine, save, characters) for _ in range(2)]
+            print(
+                f"{len(characters):>8} {name:<8}",
+                *(f"{elapsed:9.3f}s {round_trips:6d} round trips" for elapsed, round_trips in results),
+            )
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all, tables=[Character.__table__])
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,181 @@
+"""Local stand-in for the Rick and Morty character API used by the benchmarks."""
+
+import asyncio
+import datetime
+import hashlib
+import itertools
+import random
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, Response
+
+# Locations of the upstream API, Earth ones first as the origin of most of the characters served
+LOCATIONS = [
+    ("Earth (C-137)", 1),
+    ("Earth (Replacement Dimension)", 20),
+    ("Earth (Unknown dimension)", 30),
+    ("Earth (5-126)", 34),
+    ("Abadango", 2),
+    ("Citadel of Ricks", 3),
+    ("Worldender's lair", 4),
+    ("Anatomy Park", 5),
+    ("Interdimensional Cable", 6),
+    ("Immortality Field Resort", 7),
+    ("Post-Apocalyptic Earth", 8),
+    ("Purge Planet", 9),
+    ("Venzenulon 7", 10),
+    ("Bepis 9", 11),
+    ("Cronenberg Earth", 12),
+    ("Nuptia 4", 13),
+    ("Giant's Town", 14),
+    ("Bird World", 15),
+    ("St. Gloopy Noops Hospital", 16),
+    ("Gazorpazorp", 21),
+]
+EARTH_LOCATIONS = 4
+# Names and types the characters are made up of
+FIRST_NAMES = ["Rick", "Morty", "Summer", "Beth", "Jerry", "Abradolf", "Alan", "Albert", "Annie", "Arthricia", "Ben"]
+FIRST_NAMES += ["Bill", "Birdperson", "Bobby", "Brad", "Cynthia", "Davin", "Eric", "Ethan", "Frank", "Gene", "Jacob"]
+LAST_NAMES = ["Sanchez", "Smith", "Lincler", "Goldenfold", "Palmer", "Stoltz", "Wong", "Johnson", "Jenkins", "Lamb"]
+LAST_NAMES += ["Poopybutthole", "Xenon", "Bloodclot", "Ballsworth", "McGillicuddy", "Brown", "Harris", "Heron"]
+TYPES = ["Clone", "Cronenberg", "Human with antennae", "Robot-Humanoid", "Parasite", "Soulless Puppet", "Game"]
+# Episodes of the upstream API
+EPISODES = 51
+
+
+def make_location(index: int) -> dict:
+    name, location_id = LOCATIONS[index]
+    return {"name": name, "url": f"https://rickandmortyapi.com/api/location/{location_id}"}
+
+
+def make_character(character_id: int, status: str = "Alive") -> dict:
+    """
+    Build a character with the same shape and about the same variety as the upstream API.
+
+    Names, types, locations, episodes and creation times vary as the upstream characters do, the same for an id on
+    every call, about two characters out of three being from Earth as in the upstream API.
+    """
+    rng = random.Random(character_id)
+    origin = rng.randrange(EARTH_LOCATIONS) if character_id % 3 else rng.randrange(EARTH_LOCATIONS, len(LOCATIONS))
+    # Most characters appear in an episode or two, a few in most of them
+    episodes = sorted(rng.sample(range(1, EPISODES + 1), min(int(rng.paretovariate(1.2)), EPISODES)))
+    created = datetime.datetime(2017, 11, 4, tzinfo=datetime.UTC) + datetime.timedelta(
+        days=rng.randrange(60), seconds=rng.randrange(86400), milliseconds=rng.randrange(1000)
+    )
+    return {
+        "id": character_id,
+        "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "status": status,
+        "species": "Human",
+        "type": rng.choice(TYPES) if rng.random() < 0.2 else "",
+        "gender": rng.choice(["Male", "Male", "Female", "unknown"]),
+        "origin": make_location(origin),
+        "location": make_location(origin if rng.random() < 0.5 else rng.randrange(len(LOCATIONS))),
+        "image": f"https://rickandmortyapi.com/api/character/avatar/{character_id}.jpeg",
+        "episode": [f"https://rickandmortyapi.com/api/episode/{number}" for number in episodes],
+        "url": f"https://rickandmortyapi.com/api/character/{character_id}",
+        "created": created.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+    }
+
+
+def create_upstream_stub(
+    pages: int = 10,
+    per_page: int = 20,
+    latency: float = 0.1,
+    throttle_every: int = 0,
+    retry_after: int = 0,
+    rate_limit: float = 0,
+    etags: bool = False,
+) -> FastAPI:
+    """
+    Create an app serving `pages` pages of characters, answering each request after `latency` seconds.
+
+    With `throttle_every` every that many requests is answered 429 with a `Retry-After` of `retry_after` seconds.
+    With `rate_limit` requests beyond that many per second, bursts of as many included, are answered 429 and open a
+    penalty window of `retry_after` seconds during which every request is answered 429. `stub.state.throttled` counts
+    the 429 responses.
+
+    With `etags` pages are sent with the ETag of their body and answered 304 to requests with it in `If-None-Match`.
+    The characters of the pages in `stub.state.edited_pages` are dead. `stub.state.bytes_sent` counts the bytes of
+    the pages sent.
+    """
+    stub = FastAPI()
+    stub.state.throttled = 0
+    stub.state.edited_pages = set()
+    stub.state.bytes_sent = 0
+    requests = itertools.count(1)
+    bucket = {"tokens": rate_limit, "at": time.monotonic(), "penalty_until": 0.0}
+
+    def throttle() -> JSONResponse:
+        stub.state.throttled += 1
+        return JSONResponse({"error": "Too many requests"}, status_code=429, headers={"Retry-After": str(retry_after)})
+
+    def over_rate_limit() -> bool:
+        now = time.monotonic()
+        if now < bucket["penalty_until"]:
+            return True
+        bucket["tokens"] = min(rate_limit, bucket["tokens"] + (now - bucket["at"]) * rate_limit)
+        bucket["at"] = now
+        if bucket["tokens"] < 1:
+            bucket["penalty_until"] = now + retry_after
+            return True
+        bucket["tokens"] -= 1
+        return False
+
+    @stub.get("/api/character")
+    async def characters(request: Request, page: int = Query(default=1)):  # noqa: B008
+        if rate_limit and over_rate_limit():
+            return throttle()
+        await asyncio.sleep(latency)
+        if throttle_every and next(requests) % throttle_every == 0:
+            return throttle()
+        first_id = (page - 1) * per_page + 1
+        status = "Dead" if page in stub.state.edited_pages else "Alive"
+        body = JSONResponse(
+            {
+                "info": {"count": pages * per_page, "pages": pages},
+                "results": [
+                    make_character(character_id, status) for character_id in range(first_id, first_id + per_page)
+                ],
+            }
+        ).body
+        headers = {}
+        if etags:
+            headers["ETag"] = f'W/"{hashlib.sha1(body).hexdigest()}"'
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                return Response(status_code=304, headers=headers)
+        stub.state.bytes_sent += len(body)
+        return Response(body, media_type="application/json", headers=headers)
+
+    return stub
+
+
+class UpstreamStub:
+    """Run the upstream stub with uvicorn on a free local port in a background thread."""
+
+    def __init__(self, **options) -> None:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.app = create_upstream_stub(**options)
+        config = uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="error")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/character?species=Human&status=Alive&page="
+
+    def __enter__(self) -> "UpstreamStub":
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.should_exit = True
+        self.thread.join()
@@ -1,26 +1,445 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
 import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass, field, replace
+from typing import Any, NamedTuple
 
 import redis
+import redis.asyncio
+from utils import CACHE_LAYER_HITS
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+logger = logging.getLogger(__name__)
 
 # Connect to Redis
-redis_client = redis.Redis(host=os.getenv("REDIS_HOST", "redis"), port=int(os.getenv("REDIS_PORT", 6379)), db=0)
+redis_client = redis.asyncio.Redis(host=os.getenv("REDIS_HOST", "redis"), port=int(os.getenv("REDIS_PORT", 6379)), db=0)
 redis_ttl = int(os.getenv("REDIS_TTL", 30))
 
+# Cached characters older than the soft TTL are served stale while they are refreshed,
+# cached characters older than the hard TTL are never served
+CACHE_SOFT_TTL = int(os.getenv("CACHE_SOFT_TTL", redis_ttl))  # seconds
+CACHE_HARD_TTL = int(os.getenv("CACHE_HARD_TTL", redis_ttl * 10))  # seconds
+CHARACTERS_KEY = "characters"
+# How long a failed crawl of the upstream API is remembered, cache misses meanwhile do not crawl again, 0 disables it
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", 10))  # seconds
+# Version and fetch time of the cached characters, small enough to read on every request
+CHARACTERS_META_KEY = "characters:meta"
+
 # API Configuration
-API_RATE_LIMIT = int(os.getenv("API_RATE_LIMIT", 5))  # requests per minute
+API_RATE_LIMIT = int(os.getenv("API_RATE_LIMIT", 5))  # requests per window and client
 API_RATE_WINDOW = int(os.getenv("API_RATE_WINDOW", 60))  # seconds
+# "sliding_window" admits at most API_RATE_LIMIT requests in any API_RATE_WINDOW, "token_bucket" refills
+# API_RATE_LIMIT tokens per API_RATE_WINDOW and admits bursts of up to API_RATE_BURST requests
+API_RATE_ALGORITHM = os.getenv("API_RATE_ALGORITHM", "sliding_window")
+API_RATE_BURST = int(os.getenv("API_RATE_BURST", API_RATE_LIMIT))
 
+# Both rate limit scripts count the request and return 0 if it is admitted, else the milliseconds until it would be.
+# They read the time of the Redis server, so that every replica shares the same clock
+SLIDING_WINDOW_SCRIPT = redis_client.register_script("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) < limit then
+    redis.call('ZADD', KEYS[1], now, ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return math.max(tonumber(oldest[2]) + window - now, 1)
+""")
 
-def is_rate_limited() -> bool:
-    """Check if we're rate limited by counting requests in Redis."""
-    current = redis_client.get("api_request_count")
-    if current is None:
-        redis_client.setex("api_request_count", API_RATE_WINDOW, 1)
-        return False
+TOKEN_BUCKET_SCRIPT = redis_client.register_script("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + time[2] / 1000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or capacity
+local at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - at, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate))
+return wait
+""")
+
+
+async def rate_limit(client: str) -> float:
+    """
+    Count a request of `client` against its rate limit, in a single round trip to Redis.
+
+    Returns 0 if the request is admitted, else the seconds until a request of `client` would be.
+    """
+    key = f"rate_limit:{client}"
+    if API_RATE_ALGORITHM == "token_bucket":
+        rate = API_RATE_LIMIT / (API_RATE_WINDOW * 1000)  # tokens per millisecond
+        wait = await TOKEN_BUCKET_SCRIPT(keys=[key], args=[repr(rate), API_RATE_BURST], client=redis_client)
+    else:
+        wait = await SLIDING_WINDOW_SCRIPT(
+            keys=[key], args=[API_RATE_LIMIT, API_RATE_WINDOW * 1000, uuid.uuid4().hex], client=redis_client
+        )
+    return int(wait) / 1000
+
+
+# Single-flight refresh locks
+LOCK_TIMEOUT = int(os.getenv("LOCK_TIMEOUT", 120))  # lease in seconds
+
+# Take the lock with a new fencing token, tokens only ever grow
+ACQUIRE_LOCK_SCRIPT = redis_client.register_script("""
+local token = redis.call('INCR', KEYS[2])
+if redis.call('SET', KEYS[1], token, 'NX', 'EX', ARGV[1]) then
+    return token
+end
+return false
+""")
+
+# Delete the lock only if it is still held with the given fencing token
+RELEASE_LOCK_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# Write the values unless a newer fencing token holds the lock or already wrote them
+FENCED_SET_SCRIPT = redis_client.register_script("""
+local holder = tonumber(redis.call('GET', KEYS[1]))
+local written = tonumber(redis.call('GET', KEYS[2]))
+local token = tonumber(ARGV[1])
+if (holder and holder ~= token) or (written and written > token) then
+    return 0
+end
+redis.call('SET', KEYS[2], token)
+for i = 3, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i], 'EX', ARGV[2])
+end
+return 1
+""")
+
+
+async def acquire_lock(name: str, timeout: int = LOCK_TIMEOUT) -> int | None:
+    """Try to take the lock `name` for `timeout` seconds and return its fencing token, or None if it is held."""
+    token = await ACQUIRE_LOCK_SCRIPT(keys=[name, f"{name}:token"], args=[timeout], client=redis_client)
+    return int(token) if token else None
+
+
+async def release_lock(name: str, token: int) -> bool:
+    """Release the lock `name` if it is still held with `token`."""
+    return bool(await RELEASE_LOCK_SCRIPT(keys=[name], args=[token], client=redis_client))
+
+
+async def fenced_mset(name: str, token: int, mapping: dict[str, str | bytes], ex: int) -> bool:
+    """Atomically set the keys of `mapping`, unless a newer fencing token than `token` holds or wrote `name`."""
+    return bool(
+        await FENCED_SET_SCRIPT(
+            keys=[name, f"{name}:fence", *mapping], args=[token, ex, *mapping.values()], client=redis_client
+        )
+    )
+
+
+async def is_locked(name: str) -> bool:
+    """Check if the lock `name` is currently held."""
+    return bool(await redis_client.exists(name))
+
+
+async def cache_failure(key: str, message: str, ttl: float = NEGATIVE_CACHE_TTL) -> None:
+    """Remember a failure under `key` for `ttl` seconds, so that the failing work is not retried meanwhile."""
+    if ttl > 0:
+        await redis_client.set(key, message, px=int(ttl * 1000))
+
+
+async def get_cached_failure(key: str) -> str | None:
+    """Return the message of the failure remembered under `key`, None if there is none."""
+    message = await redis_client.get(key)
+    return message.decode("utf-8") if message is not None else None
+
+
+# Encodings of the cached characters payload
+class Codec(NamedTuple):
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes], Any]
+
+
+CODECS = {"json": Codec(lambda value: json.dumps(value).encode("utf-8"), json.loads)}
+if orjson is not None:
+    CODECS["orjson"] = Codec(orjson.dumps, orjson.loads)
+if msgpack is not None:
+    CODECS["msgpack"] = Codec(msgpack.packb, msgpack.unpackb)
+
+COMPRESSIONS = {"none": Codec(bytes, bytes), "zlib": Codec(zlib.compress, zlib.decompress)}
+# Raised when decompressing corrupted data, decode_payload raises them as ValueError like the codecs
+DECOMPRESSION_ERRORS: tuple[type[Exception], ...] = (zlib.error,)
+if zstandard is not None:
+    COMPRESSIONS["zstd"] = Codec(zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress)
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+# Every replica must be able to decode the codec and compression the others write
+CACHE_CODEC = os.getenv("CACHE_CODEC", "orjson" if orjson is not None else "json")
+CACHE_COMPRESSION = os.getenv("CACHE_COMPRESSION", "zstd" if zstandard is not None else "zlib")
+# Encoded payloads start with a NUL byte and a header line of their format version, codec and compression,
+# e.g. "1:msgpack:zstd". JSON never starts with a NUL byte, so payloads cached as plain JSON are still read
+PAYLOAD_FORMAT_VERSION = 1
+
+
+def encode_payload(value: Any, codec: str = CACHE_CODEC, compression: str = CACHE_COMPRESSION) -> bytes:
+    """Encode a value to cache with `codec` and `compression`, prefixed with the header to decode it."""
+    header = f"\0{PAYLOAD_FORMAT_VERSION}:{codec}:{compression}\n".encode()
+    return header + COMPRESSIONS[compression].dumps(CODECS[codec].dumps(value))
+
+
+def decode_payload(data: bytes) -> Any:
+    """Decode a cached value encoded by `encode_payload` or cached as plain JSON, ValueError if it cannot be."""
+    if not data.startswith(b"\0"):
+        return json.loads(data.decode("utf-8"))
+
+    header, _, body = data[1:].partition(b"\n")
+    version, codec, compression = header.decode().split(":")
+    if int(version) != PAYLOAD_FORMAT_VERSION:
+        raise ValueError(f"Unsupported cached payload format version {version}")
+    if codec not in CODECS or compression not in COMPRESSIONS:
+        raise ValueError(f"Cached payload encoded with {codec} and {compression} compression, which are not installed")
+    try:
+        body = COMPRESSIONS[compression].loads(body)
+    except DECOMPRESSION_ERRORS as e:
+        raise ValueError(f"Cached payload cannot be decompressed with {compression}: {e}") from e
+    return CODECS[codec].loads(body)
+
+
+@dataclass(frozen=True)
+class CachedCharacters:
+    characters: list[dict]
+    updated_at: float
+    # Identifies the characters, the same characters always have the same version
+    version: str | None = None
+    # Sorted copies of the characters, shared by every read of the same version
+    orderings: dict[tuple[str, bool], list[dict]] = field(default_factory=dict, repr=False, compare=False)
+    sort_keys: dict[str, list[tuple]] = field(default_factory=dict, repr=False, compare=False)
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.updated_at
+
+    @property
+    def is_stale(self) -> bool:
+        return self.age >= CACHE_SOFT_TTL
 
-    count = int(current)
-    if count >= API_RATE_LIMIT:
-        return True
+    @property
+    def is_expired(self) -> bool:
+        return self.age >= CACHE_HARD_TTL
 
-    redis_client.incr("api_request_count")
-    return False
+    @classmethod
+    def from_characters(cls, characters: list[dict]) -> "CachedCharacters":
+        return cls(characters=characters, updated_at=time.time(), version=characters_version(characters))
+
+    def sorted_by(self, order_by: str, descending: bool = False) -> list[dict]:
+        """The characters sorted by `order_by` with ties broken by id, sorted once per version."""
+        ordering = self.orderings.get((order_by, descending))
+        if ordering is None:
+            if descending:
+                ordering = self.sorted_by(order_by)[::-1]
+            else:
+                ordering = sorted(self.characters, key=lambda character: (character[order_by], character["id"]))
+            self.orderings[(order_by, descending)] = ordering
+        return ordering
+
+    def keys(self, order_by: str) -> list[tuple]:
+        """The ascending (order_by value, id) keys of `sorted_by(order_by)`."""
+        keys = self.sort_keys.get(order_by)
+        if keys is None:
+            keys = [(character[order_by], character["id"]) for character in self.sorted_by(order_by)]
+            self.sort_keys[order_by] = keys
+        return keys
+
+
+# The characters last read from Redis, reused while their version is the cached one
+_characters: CachedCharacters | None = None
+
+# In-process L1 cache of decoded values in front of Redis, served without any network round trip.
+# Writers publish the keys they change on the invalidation channel, the TTL bounds how stale an entry
+# gets if an invalidation is missed
+L1_CACHE_TTL = float(os.getenv("L1_CACHE_TTL", 5))  # seconds, 0 disables the L1 cache
+L1_CACHE_MAX_ENTRIES = int(os.getenv("L1_CACHE_MAX_ENTRIES", 16))
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+_l1: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+_invalidation_listener: asyncio.Task | None = None
+
+
+def l1_get(key: str) -> Any | None:
+    """Get the value of `key` from the L1 cache, if it is there and not older than L1_CACHE_TTL."""
+    entry = _l1.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del _l1[key]
+        return None
+    _l1.move_to_end(key)
+    return entry[1]
+
+
+def l1_set(key: str, value: Any) -> None:
+    """Put a value in the L1 cache for L1_CACHE_TTL, evicting the least recently used beyond L1_CACHE_MAX_ENTRIES."""
+    if L1_CACHE_TTL <= 0:
+        return
+    _l1[key] = (time.monotonic() + L1_CACHE_TTL, value)
+    _l1.move_to_end(key)
+    while len(_l1) > L1_CACHE_MAX_ENTRIES:
+        _l1.popitem(last=False)
+
+
+def l1_invalidate(key: str | None = None) -> None:
+    """Drop `key`, or every key, from the L1 cache."""
+    if key is None:
+        _l1.clear()
+    else:
+        _l1.pop(key, None)
+
+
+async def publish_invalidation(key: str) -> None:
+    """Drop `key` from the L1 cache of this process and of every other process."""
+    l1_invalidate(key)
+    await redis_client.publish(INVALIDATION_CHANNEL, key)
+
+
+async def _listen_for_invalidations() -> None:
+    while True:
+        try:
+            async with redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    l1_invalidate(message["data"].decode("utf-8"))
+        except redis.RedisError as e:
+            # Invalidations may be missed until the subscription is restored, don't serve from L1 meanwhile
+            logger.warning(f"Cache invalidation listener failed, retrying: {e}")
+            l1_invalidate()
+            await asyncio.sleep(1)
+
+
+def start_invalidation_listener() -> None:
+    """Listen for the keys changed by other processes in the background, to drop them from the L1 cache."""
+    global _invalidation_listener
+    if _invalidation_listener is None or _invalidation_listener.done():
+        _invalidation_listener = asyncio.create_task(_listen_for_invalidations())
+
+
+async def stop_invalidation_listener() -> None:
+    """Cancel the invalidation listener and wait for it to finish."""
+    global _invalidation_listener
+    if _invalidation_listener is not None:
+        _invalidation_listener.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _invalidation_listener
+        _invalidation_listener = None
+
+
+async def close_redis_client() -> None:
+    """Close the connections of the Redis client, it reconnects if used again."""
+    await redis_client.aclose()
+
+
+def characters_version(characters: list[dict]) -> str:
+    """Hash the characters, so that refreshing unchanged characters keeps their version."""
+    return hashlib.sha1(json.dumps(characters, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+async def get_cached_characters() -> CachedCharacters | None:
+    """Read the cached characters and when they were fetched, from the L1 cache or else from Redis."""
+    characters = l1_get(CHARACTERS_KEY)
+    if characters is not None:
+        CACHE_LAYER_HITS.labels(app_name="fastapi-app", layer="l1").inc()
+        return characters
+
+    characters = await _read_cached_characters()
+    if characters is not None:
+        CACHE_LAYER_HITS.labels(app_name="fastapi-app", layer="redis").inc()
+        if characters.version is not None:
+            l1_set(CHARACTERS_KEY, characters)
+    return characters
+
+
+async def _read_cached_characters() -> CachedCharacters | None:
+    global _characters
+    meta = await redis_client.get(CHARACTERS_META_KEY)
+    if meta:
+        meta = json.loads(meta.decode("utf-8"))
+        if _characters is not None and _characters.version == meta["version"]:
+            # Only the version is read while it does not change, not the characters
+            return replace(_characters, updated_at=meta["updated_at"])
+
+    cached = await redis_client.get(CHARACTERS_KEY)
+    if not cached:
+        return None
+
+    try:
+        payload = decode_payload(cached)
+    except ValueError as e:
+        logger.warning(f"Ignoring cached characters that cannot be decoded: {e}")
+        return None
+
+    if isinstance(payload, list):
+        # Entries written before the soft TTL existed have no timestamp, serve them as stale
+        return CachedCharacters(characters=payload, updated_at=time.time() - CACHE_SOFT_TTL)
+
+    characters = CachedCharacters(
+        characters=payload["characters"], updated_at=payload["updated_at"], version=payload.get("version")
+    )
+    if characters.version is not None:
+        _characters = characters
+    return characters
+
+
+def remember_characters(characters: CachedCharacters) -> None:
+    """Keep characters in process as if they were just read from Redis, so that the next reads do not decode them."""
+    global _characters
+    _characters = characters
+    l1_set(CHARACTERS_KEY, characters)
+
+
+async def has_cached_characters() -> bool:
+    """Check if characters are cached, without reading them."""
+    return l1_get(CHARACTERS_KEY) is not None or bool(await redis_client.exists(CHARACTERS_KEY))
+
+
+async def set_cached_characters(lock: str, token: int, characters: list[dict], updated_at: float | None = None) -> bool:
+    """
+    Cache the characters until the hard TTL, unless `token` no longer holds the refresh lock `lock`.
+
+    The characters are cached as fetched at `updated_at`, by default now.
+    """
+    updated_at = time.time() if updated_at is None else updated_at
+    version = characters_version(characters)
+    payload = encode_payload({"updated_at": updated_at, "version": version, "characters": characters})
+    meta = json.dumps({"updated_at": updated_at, "version": version})
+    if not await fenced_mset(lock, token, {CHARACTERS_KEY: payload, CHARACTERS_META_KEY: meta}, ex=CACHE_HARD_TTL):
+        return False
+    await publish_invalidation(CHARACTERS_KEY)
+    return True
@@ -1,102 +1,477 @@
-import json
+import asyncio
 import logging
+import os
 import time
+from dataclasses import dataclass
 
 import httpx
 from cache import (
-    redis_client,
-    redis_ttl,
+    CACHE_HARD_TTL,
+    CACHE_SOFT_TTL,
+    CachedCharacters,
+    acquire_lock,
+    cache_failure,
+    characters_version,
+    get_cached_characters,
+    get_cached_failure,
+    has_cached_characters,
+    is_locked,
+    release_lock,
+    remember_characters,
+    set_cached_characters,
 )
-from database import save_characters_to_db
-from exceptions import ServiceUnavailableException
+from database import SessionLocal, get_dataset, load_characters, save_characters_to_db
+from exceptions import CircuitOpenException, ServiceUnavailableException, UpstreamThrottledException
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
-from tenacity import retry, stop_after_attempt, wait_exponential
-from utils import CACHE_HITS, CACHE_MISSES, CHARACTERS_PROCESSED
+from governor import governed_request
+from page_cache import CachedPage, body_digest, get_cached_page, set_cached_page, touch_cached_page
+from redis.exceptions import RedisError
+from snapshot import SNAPSHOT_PATH, read_snapshot, write_snapshot
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from tenacity import RetryCallState, retry, retry_if_exception, stop_after_attempt, wait_exponential
+from upstream import get_http_client, upstream_breaker
+from utils import (
+    CACHE_HITS,
+    CACHE_LAYER_HITS,
+    CACHE_MISSES,
+    CACHE_STALE_SERVES,
+    CHARACTERS_PROCESSED,
+    NEGATIVE_CACHE_HITS,
+    REFRESH_DURATION,
+    UPSTREAM_PAGES,
+    UPSTREAM_RESPONSE_BYTES,
+)
 
 logger = logging.getLogger(__name__)
 
+BASE_URL = os.getenv("CHARACTERS_API_URL", "https://rickandmortyapi.com/api/character?species=Human&status=Alive&page=")
+# Maximum number of upstream pages fetched at the same time
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", 5))
+# How long a cache miss waits for another process to refresh the characters
+REFRESH_WAIT_TIMEOUT = float(os.getenv("REFRESH_WAIT_TIMEOUT", 60))  # seconds
+REFRESH_POLL_INTERVAL = float(os.getenv("REFRESH_POLL_INTERVAL", 0.1))  # seconds
+REFRESH_LOCK = "characters:refresh_lock"
+# Message of the last failed crawl, kept for NEGATIVE_CACHE_TTL
+UPSTREAM_FAILURE_KEY = "characters:upstream_failure"
+# Attempts per upstream page, waiting exponentially longer between them, or as long as a 429 response asks to
+UPSTREAM_RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", 3))
+UPSTREAM_RETRY_MIN_WAIT = float(os.getenv("UPSTREAM_RETRY_MIN_WAIT", 1))  # seconds
+UPSTREAM_RETRY_MAX_WAIT = float(os.getenv("UPSTREAM_RETRY_MAX_WAIT", 4))  # seconds
+# 429 responses asking to wait longer are not retried
+UPSTREAM_MAX_RETRY_AFTER = float(os.getenv("UPSTREAM_MAX_RETRY_AFTER", 10))  # seconds
+# Cache the characters saved to the database on a cache miss, unless they are expired, instead of crawling
+DATABASE_FALLBACK_ENABLED = os.getenv("DATABASE_FALLBACK_ENABLED", "true").lower() == "true"
+
+_background_refresh: asyncio.Task | None = None
+
 
-def get_all_characters(db: Session):
-    BASE_URL = "https://rickandmortyapi.com/api/character?species=Human&status=Alive&page="
-    all_data_results = []
-    page = 1
+async def get_all_characters(db: AsyncSession, read_only: bool = False) -> CachedCharacters:
+    """
+    Get the characters from the cache, refreshing them on a miss or in the background when stale.
 
+    A miss is served from the database if the characters saved by the last refresh are not expired, and only
+    crawls the upstream API otherwise. While the upstream API is failing, the last characters saved to the database
+    are served stale whatever their age. With `read_only` the characters are only read, leaving refreshes and
+    caching to the background refresher.
+    """
     try:
         # Check if data is already in Redis
-        cached_characters = redis_client.get("characters")
-        if cached_characters:
+        cached = await get_cached_characters()
+        if cached and not cached.is_expired:
             CACHE_HITS.labels(app_name="fastapi-app").inc()
-            return json.loads(cached_characters.decode("utf-8"))
+            if cached.is_stale:
+                CACHE_STALE_SERVES.labels(app_name="fastapi-app").inc()
+                if not read_only:
+                    refresh_in_background()
+            return cached
 
         CACHE_MISSES.labels(app_name="fastapi-app").inc()
+        if read_only:
+            # Not taking the refresh lock, which would make the background refresher skip its refresh
+            return await _read_saved_characters(db)
 
-        # Fetch the first page outside the loop to get the total number of pages
-        characters = fetch_characters(BASE_URL, page)
+        token = await acquire_lock(REFRESH_LOCK)
+        if token is None:
+            logger.info("Characters are being refreshed by another process, waiting for the result")
+            return await wait_for_characters()
 
-        total_pages = characters["info"]["pages"]
-        logger.info(f"Total pages to fetch: {total_pages}")
+        try:
+            cached = await restore_characters(db, token) if DATABASE_FALLBACK_ENABLED else None
+            if cached is None:
+                cached = await _refresh_or_restore_last_known_good(db, token)
+        finally:
+            await release_lock(REFRESH_LOCK, token)
 
-        # Process the first page
-        filtered_characters = list(filter_request(characters["results"]))
-        all_data_results.extend(filtered_characters)
-        CHARACTERS_PROCESSED.labels(app_name="fastapi-app").inc(len(filtered_characters))
-        logger.info(f"Processing page {page} from {total_pages}")
+        if cached.is_stale:
+            refresh_in_background()
+        return cached
+
+    except ServiceUnavailableException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in main processing: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+
+async def _refresh_or_restore_last_known_good(db: AsyncSession, token: int) -> CachedCharacters:
+    try:
+        return CachedCharacters.from_characters(await _refresh_characters(db, token))
+    except ServiceUnavailableException:
+        cached = await restore_characters(db, token, last_known_good=True) if DATABASE_FALLBACK_ENABLED else None
+        if cached is None:
+            raise
+        return cached
+
+
+async def _read_saved_characters(db: AsyncSession) -> CachedCharacters:
+    if DATABASE_FALLBACK_ENABLED:
+        cached = await restore_characters(db, token=None)
+        # The background refresher crawls, unless its last crawl failed
+        if cached is None and await get_cached_failure(UPSTREAM_FAILURE_KEY) is not None:
+            cached = await restore_characters(db, token=None, last_known_good=True)
+        if cached is not None:
+            return cached
+    raise ServiceUnavailableException("Characters are being refreshed, try again later")
+
+
+async def restore_characters(
+    db: AsyncSession, token: int | None, last_known_good: bool = False
+) -> CachedCharacters | None:
+    """
+    Cache the characters saved to the database by the last refresh, read in one query, as fetched at that refresh.
+
+    The caller holds the refresh lock with `token`, without a token the characters are only read and not cached.
+    None is returned if the characters saved are expired or missing.
+    With `last_known_good` they are cached whatever their age, as stale, to serve them while the upstream API fails.
+    """
+    try:
+        dataset = await get_dataset(db)
+        if dataset is None or (not last_known_good and time.time() - dataset.updated_at >= CACHE_HARD_TTL):
+            return None
+        characters = await load_characters(db)
+    except SQLAlchemyError as e:
+        logger.warning(f"Error reading the characters from the database: {str(e)}")
+        await db.rollback()
+        return None
+    # Like a snapshot, the last known good characters are served stale and refreshed
+    updated_at = max(dataset.updated_at, time.time() - CACHE_SOFT_TTL) if last_known_good else dataset.updated_at
+    cached = CachedCharacters(characters=characters, updated_at=updated_at, version=dataset.version)
+    if token is not None:
+        if not await set_cached_characters(REFRESH_LOCK, token, characters, updated_at=updated_at):
+            return None
+        logger.log(
+            logging.WARNING if last_known_good else logging.INFO,
+            f"Cached {len(characters)} characters from the database, "
+            f"fetched {time.time() - dataset.updated_at:.0f}s ago",
+        )
+        remember_characters(cached)
+
+    CACHE_LAYER_HITS.labels(app_name="fastapi-app", layer="database").inc()
+    return cached
 
-        # Iterate through the remaining pages
-        for page in range(2, total_pages + 1):
-            try:
-                characters = fetch_characters(BASE_URL, page)
-                if not characters:
-                    logger.warning(f"Failed to fetch page {page}, stopping pagination")
-                    break
-                filtered_characters = list(filter_request(characters["results"]))
-                all_data_results.extend(filtered_characters)
-                CHARACTERS_PROCESSED.labels(app_name="fastapi-app").inc(len(filtered_characters))
-                logger.info(f"Processing page {page} from {total_pages}")
-            except Exception as e:
-                logger.error(f"Error processing page {page}: {str(e)}")
-                # Continue with next page instead of failing completely
-                continue
 
+async def refresh_characters(db: AsyncSession) -> list[dict] | None:
+    """
+    Crawl the upstream API and save the characters to the database and cache.
+
+    Only the process holding the refresh lock crawls, None is returned if another process holds it.
+    """
+    token = await acquire_lock(REFRESH_LOCK)
+    if token is None:
+        return None
+
+    try:
+        return await _refresh_characters(db, token)
+    finally:
+        await release_lock(REFRESH_LOCK, token)
+
+
+async def _refresh_characters(db: AsyncSession, token: int) -> list[dict]:
+    failure = await get_cached_failure(UPSTREAM_FAILURE_KEY)
+    if failure is not None:
+        NEGATIVE_CACHE_HITS.labels(app_name="fastapi-app").inc()
+        raise ServiceUnavailableException(failure)
+
+    with REFRESH_DURATION.labels(app_name="fastapi-app").time():
+        try:
+            crawl = await crawl_pages(BASE_URL)
+        except ServiceUnavailableException as e:
+            await cache_failure(UPSTREAM_FAILURE_KEY, e.message)
+            raise
+
+        all_data_results = crawl.characters
         if not all_data_results:
             logger.info("No Earth characters found")
+        if crawl.missing:
+            logger.warning(f"{crawl.missing} pages could not be fetched, keeping the characters saved from them")
+
+        # Save to database and Redis, only the pages that changed if the database holds the cached pages
+        cached_saved = await is_saved(db, crawl.cached_characters)
+        changed = await save_characters_to_db(
+            all_data_results, db, prune=not crawl.missing, changed=crawl.changed if cached_saved else None
+        )
+        if not await set_cached_characters(REFRESH_LOCK, token, all_data_results):
+            logger.warning("Refresh lock was taken over by another process, not caching the characters")
+        elif SNAPSHOT_PATH:
+            await save_snapshot(CachedCharacters.from_characters(all_data_results))
+    logger.info(f"Successfully saved {len(all_data_results)} characters to database and cache ({changed} changed)")
+    return all_data_results
+
+
+async def is_saved(db: AsyncSession, characters: list[dict] | None) -> bool:
+    """Check if `characters` are the full set saved to the database by the last refresh."""
+    if characters is None:
+        return False
+    dataset = await get_dataset(db)
+    return dataset is not None and dataset.version == characters_version(characters)
+
+
+async def save_snapshot(cached: CachedCharacters) -> None:
+    try:
+        size = await asyncio.to_thread(write_snapshot, SNAPSHOT_PATH, cached)
+        logger.info(f"Saved a {size} bytes snapshot of the characters to {SNAPSHOT_PATH}")
+    except OSError as e:
+        logger.error(f"Error saving the snapshot of the characters: {str(e)}")
+
+
+async def bootstrap_characters(path: str | None = None, force: bool = False) -> CachedCharacters | None:
+    """
+    Cache the characters of the snapshot at `path`, by default SNAPSHOT_PATH, if no characters are cached,
+    or always with `force`.
+
+    Characters older than the soft TTL are cached as just stale, so that they are served right away while they are
+    refreshed from the upstream API. Returns the cached characters, None if the snapshot was not cached.
+    """
+    path = SNAPSHOT_PATH if path is None else path
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        if not force and await has_cached_characters():
+            return None
+        snapshot = await asyncio.to_thread(read_snapshot, path)
+
+        token = await acquire_lock(REFRESH_LOCK)
+        if token is None:
+            # Another process is refreshing the characters, they will be cached from the upstream API
+            return None
+        try:
+            updated_at = max(snapshot.updated_at, time.time() - CACHE_SOFT_TTL)
+            if not await set_cached_characters(REFRESH_LOCK, token, snapshot.characters, updated_at=updated_at):
+                return None
+        finally:
+            await release_lock(REFRESH_LOCK, token)
+    except (OSError, ValueError, RedisError) as e:
+        logger.warning(f"Not caching the snapshot of the characters at {path}: {str(e)}")
+        return None
 
-        # Save to database and Redis
-        save_characters_to_db(all_data_results, db)
-        redis_client.set("characters", json.dumps(all_data_results), ex=redis_ttl)
-        logger.info(f"Successfully saved {len(all_data_results)} characters to database and cache")
-        return all_data_results
+    cached = CachedCharacters(characters=snapshot.characters, updated_at=updated_at, version=snapshot.version)
+    remember_characters(cached)
+    logger.info(f"Cached {len(cached.characters)} characters from the snapshot at {path}")
+    return cached
 
+
+def refresh_in_background() -> None:
+    """Start refreshing stale characters unless this process is already refreshing them."""
+    global _background_refresh
+    if _background_refresh is None or _background_refresh.done():
+        _background_refresh = asyncio.create_task(_refresh_in_background())
+
+
+async def _refresh_in_background() -> None:
+    # The request session is closed once the response is sent, use a session of our own
+    try:
+        async with SessionLocal() as db:
+            await refresh_characters(db)
     except Exception as e:
-        logger.error(f"Error in main processing: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e)) from e
+        logger.error(f"Error refreshing stale characters: {str(e)}")
+
+
+async def wait_for_characters() -> CachedCharacters:
+    """Wait until the refresh lock is released and return the characters cached by its holder."""
+    deadline = time.monotonic() + REFRESH_WAIT_TIMEOUT
+    while await is_locked(REFRESH_LOCK) and time.monotonic() < deadline:
+        await asyncio.sleep(REFRESH_POLL_INTERVAL)
+
+    cached = await get_cached_characters()
+    if not cached or cached.is_expired:
+        raise ServiceUnavailableException("Characters are being refreshed, try again later")
+    return cached
+
+
+@dataclass(frozen=True)
+class Crawl:
+    """Every page of a crawl, as cached before the crawl and as crawled, None if it is missing."""
+
+    cached: list[CachedPage | None]
+    pages: list[CachedPage | None]
+
+    @property
+    def characters(self) -> list[dict]:
+        return [character for page in self.pages if page is not None for character in page.characters]
+
+    @property
+    def changed(self) -> list[dict]:
+        """Characters of the pages that changed since they were cached, unchanged pages are the cached ones."""
+        return [
+            character
+            for page, cached in zip(self.pages, self.cached, strict=True)
+            if page is not None and page is not cached
+            for character in page.characters
+        ]
+
+    @property
+    def cached_characters(self) -> list[dict] | None:
+        """Characters of the pages as cached before the crawl, None unless every page was cached."""
+        if any(page is None for page in self.cached):
+            return None
+        return [character for page in self.cached for character in page.characters]
+
+    @property
+    def missing(self) -> int:
+        return sum(page is None for page in self.pages)
+
+
+async def crawl_characters(url: str, concurrency: int = CRAWL_CONCURRENCY) -> list[dict]:
+    """Fetch and filter every page of characters, returned in page order."""
+    return (await crawl_pages(url, concurrency)).characters
+
+
+async def crawl_pages(url: str, concurrency: int = CRAWL_CONCURRENCY) -> Crawl:
+    """
+    Fetch every page of characters, revalidating the pages cached.
+
+    The first page is fetched on its own to learn the total number of pages, the remaining
+    pages are then fetched concurrently with at most `concurrency` requests in flight.
+    A remaining page that cannot be fetched is kept as cached, or missing if it is not cached.
+    """
+    first_cached = await get_cached_page(url, 1)
+    # Fetch the first page outside the loop to get the total number of pages
+    first_page = await fetch_page(url, 1, first_cached)
+
+    total_pages = first_page.pages
+    logger.info(f"Total pages to fetch: {total_pages}")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def crawl_page(page: int) -> tuple[CachedPage | None, CachedPage | None]:
+        cached = await get_cached_page(url, page)
+        async with semaphore:
+            try:
+                return cached, await fetch_page(url, page, cached)
+            except CircuitOpenException:
+                # The upstream API is failing, the remaining pages would fail as well
+                raise
+            except Exception as e:
+                UPSTREAM_PAGES.labels(app_name="fastapi-app", result="failed").inc()
+                kept = "keeping it as cached" if cached is not None else "skipping it"
+                logger.error(f"Error processing page {page}, {kept}: {str(e)}")
+                # Continue with next page instead of failing completely
+                return cached, cached
+
+    tasks = [asyncio.create_task(crawl_page(page)) for page in range(2, total_pages + 1)]
+    try:
+        remaining_pages = await asyncio.gather(*tasks)
+    except BaseException:
+        # The crawl failed, stop requesting the other pages
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    cached_pages, pages = zip((first_cached, first_page), *remaining_pages, strict=True)
+    return Crawl(cached=list(cached_pages), pages=list(pages))
+
+
+async def fetch_page(url: str, page: int, cached: CachedPage | None) -> CachedPage:
+    """
+    Fetch a page of characters, conditionally on its validators if it is `cached`.
+
+    `cached` itself is returned if the upstream API answers 304 Not Modified or the same body, without parsing it,
+    else the page is parsed, filtered and cached in its place.
+    """
+    response = await request_page(url, page, cached.validators if cached is not None else {})
+    UPSTREAM_RESPONSE_BYTES.labels(app_name="fastapi-app").inc(len(response.content))
+    digest = body_digest(response.content)
+    if cached is not None and (response.status_code == 304 or digest == cached.digest):
+        UPSTREAM_PAGES.labels(app_name="fastapi-app", result="not_modified").inc()
+        await touch_cached_page(url, page)
+        return cached
+
+    data = response.json()
+    fetched = CachedPage(
+        pages=data["info"]["pages"],
+        characters=list(filter_request(data["results"])),
+        digest=digest,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    UPSTREAM_PAGES.labels(app_name="fastapi-app", result="modified").inc()
+    CHARACTERS_PROCESSED.labels(app_name="fastapi-app").inc(len(fetched.characters))
+    logger.info(f"Processing page {page} from {fetched.pages}")
+    await set_cached_page(url, page, fetched)
+    return fetched
+
+
+def is_retryable(exception: BaseException) -> bool:
+    """Retry failed pages, unless the circuit breaker is open or a 429 response asks to wait too long."""
+    if isinstance(exception, CircuitOpenException):
+        return False
+    if isinstance(exception, UpstreamThrottledException):
+        return exception.retry_after <= UPSTREAM_MAX_RETRY_AFTER
+    return True
+
+
+def wait_before_retry(retry_state: RetryCallState) -> float:
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, UpstreamThrottledException):
+        return exception.retry_after
+    return wait_exponential(min=UPSTREAM_RETRY_MIN_WAIT, max=UPSTREAM_RETRY_MAX_WAIT)(retry_state)
 
 
 @retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
+    stop=stop_after_attempt(UPSTREAM_RETRY_ATTEMPTS),
+    wait=wait_before_retry,
+    retry=retry_if_exception(is_retryable),
     reraise=True,
 )
-def fetch_characters(url: str, page: int) -> dict | None:
+async def request_page(url: str, page: int, headers: dict[str, str] | None = None) -> httpx.Response:
     """
-    Fetch characters from the Rick and Morty API with retry logic and rate limiting.
+    Request a page of characters from the Rick and Morty API with retry logic and rate limiting.
+
+    Requests are admitted by the rate governor shared by every replica, then go through the upstream circuit breaker:
+    errors and 5xx responses count as failures, and requests are rejected with CircuitOpenException while it is open.
+    A 429 response pauses the requests of every replica for as long as its `Retry-After` asks. A 304 response to a
+    conditional request is returned as is.
     """
+    # Requests the breaker rejects take neither a token nor a slot of the governor
+    upstream_breaker.check()
+    async with governed_request(max_pause=UPSTREAM_MAX_RETRY_AFTER) as request:
+        with upstream_breaker.call():
+            try:
+                response = await get_http_client().get(url + str(page), headers=headers)
+            except httpx.RequestError as exc:
+                logger.error(f"Request error: {exc}")
+                raise ServiceUnavailableException("The Rick and Morty API is unavailable") from exc
+            if response.is_server_error:
+                raise ServiceUnavailableException("The Rick and Morty API is unavailable")
+
+        if response.status_code == 429:  # Too Many Requests
+            retry_after = float(response.headers.get("Retry-After", 60))
+            request.throttle(retry_after)
+            raise UpstreamThrottledException(retry_after=retry_after)
+    if response.status_code == 304:  # Not Modified
+        return response
     try:
-        with httpx.Client(timeout=30) as client:
-            response = client.get(url + str(page))
-            response.raise_for_status()
-            return response.json()
+        response.raise_for_status()
     except httpx.HTTPStatusError as exc:
-        if exc.response.status_code == 429:  # Too Many Requests
-            retry_after = int(exc.response.headers.get("Retry-After", 60))
-            logger.warning(f"Rate limited by API. Waiting {retry_after} seconds.")
-            time.sleep(retry_after)
-            return fetch_characters(url, page)
-        raise ServiceUnavailableException("The Rick and Morty API is unavailable") from exc
-    except httpx.RequestError as exc:
-        logger.error(f"Request error: {exc}")
         raise ServiceUnavailableException("The Rick and Morty API is unavailable") from exc
+    return response
+
+
+async def fetch_characters(url: str, page: int) -> dict:
+    """Fetch a page of characters from the Rick and Morty API, unconditionally."""
+    return (await request_page(url, page)).json()
 
 
 def filter_request(characters):
@@ -0,0 +1,149 @@
+import contextlib
+import logging
+import time
+from collections import deque
+from collections.abc import Iterator
+from enum import Enum
+
+from exceptions import CircuitOpenException
+from utils import CIRCUIT_BREAKER_REJECTIONS, CIRCUIT_BREAKER_STATE, CIRCUIT_BREAKER_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+
+class State(Enum):
+    # Values exported by the circuit_breaker_state gauge
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+# Opens once `failure_rate` of at least `minimum_calls` calls in the last `window` seconds failed, then half-opens after
+# `open_timeout` seconds and closes once its `half_open_calls` trial calls succeed. The state is held per process.
+class CircuitBreaker:
+    """Circuit breaker failing the calls to the dependency `name` fast while it is unhealthy."""
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = 0.5,
+        minimum_calls: int = 10,
+        window: float = 30,
+        open_timeout: float = 30,
+        half_open_calls: int = 1,
+    ) -> None:
+        self.name = name
+        self.failure_rate = failure_rate
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.open_timeout = open_timeout
+        self.half_open_calls = half_open_calls
+
+        self.state = State.CLOSED
+        self.opened_at = 0.0
+        # Outcomes of the calls made in the last `window` seconds while closed, as (monotonic time, failed)
+        self.outcomes: deque[tuple[float, bool]] = deque()
+        self.failures = 0
+        # Trial calls in flight and succeeded while half-open
+        self.trials = 0
+        self.trial_successes = 0
+        # Bumped on every transition, outcomes of the calls admitted before it are ignored
+        self.generation = 0
+
+    @property
+    def retry_after(self) -> float:
+        """Seconds until an open breaker admits a trial call."""
+        if self.state is not State.OPEN:
+            return 0
+        return max(self.opened_at + self.open_timeout - time.monotonic(), 0)
+
+    @contextlib.contextmanager
+    def call(self) -> Iterator[None]:
+        """
+        Admit a call, raising CircuitOpenException if the breaker rejects it, and record its outcome.
+
+        The call fails if an exception is raised from the block. A cancelled call is not recorded.
+        """
+        generation = self._admit()
+        try:
+            yield
+        except Exception:
+            self._record(generation, failed=True)
+            raise
+        except BaseException:
+            self._release(generation)
+            raise
+        self._record(generation, failed=False)
+
+    def check(self) -> None:
+        """Raise CircuitOpenException if a call would be rejected now, without admitting one."""
+        if (self.state is State.OPEN and self.retry_after > 0) or self._trials_full():
+            self._reject()
+
+    def export_state(self) -> None:
+        """
+        Export the state of the breaker, transitions export it as they happen.
+
+        Not done when the breaker is created: metrics set at import time would be written before the server clears
+        the multiprocess metrics of its previous run, and lost with them.
+        """
+        CIRCUIT_BREAKER_STATE.labels(app_name="fastapi-app", breaker=self.name).set(self.state.value)
+
+    def reset(self) -> None:
+        """Close the breaker and forget the outcomes recorded."""
+        self._transition(State.CLOSED)
+
+    def _admit(self) -> int:
+        if self.state is State.OPEN and self.retry_after <= 0:
+            self._transition(State.HALF_OPEN)
+        if self.state is State.OPEN or self._trials_full():
+            self._reject()
+        if self.state is State.HALF_OPEN:
+            self.trials += 1
+        return self.generation
+
+    def _trials_full(self) -> bool:
+        return self.state is State.HALF_OPEN and self.trials >= self.half_open_calls
+
+    def _reject(self) -> None:
+        CIRCUIT_BREAKER_REJECTIONS.labels(app_name="fastapi-app", breaker=self.name).inc()
+        raise CircuitOpenException(f"The {self.name} circuit breaker is open", retry_after=self.retry_after)
+
+    def _release(self, generation: int) -> None:
+        if generation == self.generation and self.state is State.HALF_OPEN:
+            self.trials -= 1
+
+    def _record(self, generation: int, failed: bool) -> None:
+        if generation != self.generation:
+            return
+        if self.state is State.HALF_OPEN:
+            self.trials -= 1
+            self.trial_successes += not failed
+            if failed:
+                self._transition(State.OPEN)
+            elif self.trial_successes >= self.half_open_calls:
+                self._transition(State.CLOSED)
+            return
+
+        now = time.monotonic()
+        self.outcomes.append((now, failed))
+        self.failures += failed
+        while self.outcomes and self.outcomes[0][0] <= now - self.window:
+            self.failures -= self.outcomes.popleft()[1]
+        if len(self.outcomes) >= self.minimum_calls and self.failures >= self.failure_rate * len(self.outcomes):
+            self._transition(State.OPEN)
+
+    def _transition(self, state: State) -> None:
+        if state is not self.state:
+            logger.warning(f"The {self.name} circuit breaker went from {self.state.name} to {state.name}")
+            CIRCUIT_BREAKER_TRANSITIONS.labels(
+                app_name="fastapi-app", breaker=self.name, state=state.name.lower()
+            ).inc()
+            CIRCUIT_BREAKER_STATE.labels(app_name="fastapi-app", breaker=self.name).set(state.value)
+        self.state = state
+        self.generation += 1
+        self.opened_at = time.monotonic() if state is State.OPEN else 0.0
+        self.outcomes.clear()
+        self.failures = 0
+        self.trials = 0
+        self.trial_successes = 0
@@ -1,26 +1,112 @@
 import os
-from datetime import datetime
+import time
+from datetime import UTC, datetime
 
-from pydantic import BaseModel
-from sqlalchemy import JSON, Column, DateTime, Integer, String, create_engine
+from cache import characters_version
+from pydantic import BaseModel, field_serializer
+from sqlalchemy import (
+    JSON,
+    Column,
+    DateTime,
+    Float,
+    Index,
+    Integer,
+    String,
+    Text,
+    cast,
+    delete,
+    func,
+    or_,
+    select,
+    tuple_,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from utils import DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUT_TIME, DB_POOL_CHECKOUT_TIMEOUTS, DB_POOL_OVERFLOW
 
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
+# Connections kept open, and opened on top of them under load
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", 5))
+POSTGRES_POOL_MAX_OVERFLOW = int(os.getenv("POSTGRES_POOL_MAX_OVERFLOW", 10))
+# How long a checkout waits for a connection once the pool and overflow are exhausted
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", 30))  # seconds
+# Connections older than this are replaced on checkout, before the server or a proxy drops them
+POSTGRES_POOL_RECYCLE = int(os.getenv("POSTGRES_POOL_RECYCLE", 1800))  # seconds
+# Test connections with a round trip on checkout and replace the ones that were dropped
+POSTGRES_POOL_PRE_PING = os.getenv("POSTGRES_POOL_PRE_PING", "true").lower() == "true"
+# Postgres cancels statements running longer than this, 0 disables the timeout
+POSTGRES_STATEMENT_TIMEOUT = int(os.getenv("POSTGRES_STATEMENT_TIMEOUT", 0))  # milliseconds
+# Number of characters written per INSERT statement
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 500))
+# How long the number of characters is cached in process
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", 30))  # seconds
 
 SQLALCHEMY_DATABASE_URL = (
-    f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Queue pool exporting how long checkouts take and how many connections are checked out and in overflow,
+    so time spent queueing for a connection shows apart from time spent in queries.
+    """
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            DB_POOL_CHECKOUT_TIMEOUTS.labels(app_name="fastapi-app").inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_TIME.labels(app_name="fastapi-app").observe(time.perf_counter() - start)
+        self.report_usage()
+        return connection
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self.report_usage()
+
+    def report_usage(self) -> None:
+        DB_POOL_CHECKED_OUT.labels(app_name="fastapi-app").set(self.checkedout())
+        DB_POOL_OVERFLOW.labels(app_name="fastapi-app").set(max(self.overflow(), 0))
+
+
+def create_pooled_engine(url: str) -> AsyncEngine:
+    """Create an engine with the pool configured by the POSTGRES_POOL_* settings, reporting its usage."""
+    connect_args = {}
+    if POSTGRES_STATEMENT_TIMEOUT:
+        connect_args["server_settings"] = {"statement_timeout": str(POSTGRES_STATEMENT_TIMEOUT)}
+    return create_async_engine(
+        url,
+        poolclass=InstrumentedPool,
+        pool_size=POSTGRES_POOL_SIZE,
+        max_overflow=POSTGRES_POOL_MAX_OVERFLOW,
+        pool_timeout=POSTGRES_POOL_TIMEOUT,
+        pool_recycle=POSTGRES_POOL_RECYCLE,
+        pool_pre_ping=POSTGRES_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+
+
+engine = create_pooled_engine(SQLALCHEMY_DATABASE_URL)
+# Characters are read after the session commits, don't expire them
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
+_characters_count: tuple[float, int] | None = None
+# Name of the dataset of the characters in the datasets table
+CHARACTERS_DATASET = "characters"
+
 
 class Character(Base):
     __tablename__ = "characters"
@@ -38,6 +124,19 @@ class Character(Base):
     url = Column(String)
     created = Column(DateTime)
 
+    # Lets keyset pagination by name seek straight to the (name, id) of a cursor
+    __table_args__ = (Index("ix_characters_name_id", "name", "id"),)
+
+
+class Dataset(Base):
+    """When the full set of characters saved to the database was fetched, and its version."""
+
+    __tablename__ = "datasets"
+
+    name = Column(String, primary_key=True)
+    version = Column(String)
+    updated_at = Column(Float)  # Unix time
+
 
 class LocationBase(BaseModel):
     name: str
@@ -58,35 +157,165 @@ class CharacterResponse(BaseModel):
     url: str
     created: datetime
 
+    @field_serializer("created")
+    def serialize_created(self, created: datetime) -> str:
+        # Rendered as the upstream API does, whether read from the cache or naive UTC from the database
+        return format_created(parse_created(created))
+
     class Config:
         orm_mode = True
 
 
-# Dependency
-def get_db():
-    db = SessionLocal()
+async def create_tables():
+    """Create the tables, and the indexes added to the tables since they were created."""
+    async with engine.begin() as connection:
+        await connection.run_sync(_create_tables)
+
+
+async def create_schema() -> None:
+    """Create the tables from outside the event loop serving requests, closing the connections it opened."""
     try:
-        yield db
+        await create_tables()
     finally:
-        db.close()
-
-
-def save_characters_to_db(characters: list[dict], db: Session):
-    """Save the characters to the database."""
-    for character in characters:
-        db_character = Character(
-            id=character.get("id"),
-            name=character.get("name", ""),
-            status=character.get("status", ""),
-            species=character.get("species", ""),
-            type=character.get("type", ""),
-            gender=character.get("gender", ""),
-            origin=character.get("origin", {}),
-            location=character.get("location", {}),
-            image=character.get("image", ""),
-            episode=character.get("episode", []),
-            url=character.get("url", ""),
-            created=character.get("created"),
+        await engine.dispose()
+
+
+def _create_tables(connection) -> None:
+    Base.metadata.create_all(bind=connection)
+    for index in Character.__table__.indexes:
+        index.create(bind=connection, checkfirst=True)
+
+
+# Dependency
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
+
+
+async def save_characters_to_db(
+    characters: list[dict], db: AsyncSession, prune: bool = False, changed: list[dict] | None = None
+) -> int:
+    """
+    Save the characters to the database and return how many rows were inserted, updated or deleted.
+
+    Characters are upserted in batches of multi-row INSERT ... ON CONFLICT (id) DO UPDATE statements,
+    rows whose content has not changed are left untouched. With `changed`, the other characters are known to be
+    saved already and only `changed` are upserted. With `prune`, `characters` are the full set: characters that
+    are not in it are deleted and the set is recorded as fetched now.
+    """
+    global _characters_count
+    table = Character.__table__
+    insert = postgresql.insert if db.bind.dialect.name == "postgresql" else sqlite.insert
+    rows = [
+        {
+            "id": character.get("id"),
+            "name": character.get("name", ""),
+            "status": character.get("status", ""),
+            "species": character.get("species", ""),
+            "type": character.get("type", ""),
+            "gender": character.get("gender", ""),
+            "origin": character.get("origin", {}),
+            "location": character.get("location", {}),
+            "image": character.get("image", ""),
+            "episode": character.get("episode", []),
+            "url": character.get("url", ""),
+            "created": parse_created(character.get("created")),
+        }
+        for character in (characters if changed is None else changed)
+    ]
+
+    saved = 0
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        statement = insert(table).values(rows[start : start + UPSERT_BATCH_SIZE])
+        columns = [column for column in table.columns if not column.primary_key]
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={column.name: statement.excluded[column.name] for column in columns},
+            # JSON values have no equality operator in Postgres, compare their text instead
+            where=or_(
+                *(
+                    cast(column, Text).is_distinct_from(cast(statement.excluded[column.name], Text))
+                    if isinstance(column.type, JSON)
+                    else column.is_distinct_from(statement.excluded[column.name])
+                    for column in columns
+                )
+            ),
         )
-        db.merge(db_character)
-    db.commit()
+        saved += (await db.execute(statement)).rowcount
+
+    if prune:
+        statement = delete(Character).where(Character.id.not_in([character.get("id") for character in characters]))
+        saved += (await db.execute(statement)).rowcount
+        _characters_count = None
+        await db.merge(Dataset(name=CHARACTERS_DATASET, version=characters_version(characters), updated_at=time.time()))
+    await db.commit()
+    return saved
+
+
+async def get_dataset(db: AsyncSession, name: str = CHARACTERS_DATASET) -> Dataset | None:
+    return await db.get(Dataset, name, populate_existing=True)
+
+
+async def load_characters(db: AsyncSession) -> list[dict]:
+    """Read every character saved to the database in one query, in the shape of the upstream API."""
+    table = Character.__table__
+    rows = (await db.execute(select(table).order_by(table.c.id))).mappings()
+    return [{**row, "created": format_created(row["created"])} for row in rows]
+
+
+def format_created(created: datetime | None) -> str | None:
+    """Format a creation time as the upstream API does, e.g. 2017-11-04T18:48:46.250Z."""
+    return created and created.isoformat(timespec="milliseconds") + "Z"
+
+
+def parse_created(created: str | datetime | None) -> datetime | None:
+    """
+    Parse the ISO 8601 creation time of a character into a naive UTC datetime.
+
+    asyncpg only binds datetimes to timestamp columns, where psycopg2 let Postgres parse the string.
+    """
+    if isinstance(created, str):
+        created = datetime.fromisoformat(created)
+    if created is not None and created.tzinfo is not None:
+        created = created.astimezone(UTC).replace(tzinfo=None)
+    return created
+
+
+async def get_characters_page(
+    db: AsyncSession, order_by: str, descending: bool, limit: int, offset: int
+) -> list[Character]:
+    """Get a page of characters sorted by the `order_by` column, breaking ties by id."""
+    columns = [Character.__table__.c[order_by]]
+    if order_by != "id":
+        columns.append(Character.id)
+    statement = select(Character).order_by(*(column.desc() if descending else column.asc() for column in columns))
+    return list(await db.scalars(statement.limit(limit).offset(offset)))
+
+
+async def get_characters_after(
+    db: AsyncSession, order_by: str, after: tuple | None, ascending: bool, limit: int
+) -> list[Character]:
+    """
+    Get up to `limit` characters whose (order_by value, id) key follows `after` in ascending or descending order.
+
+    This is keyset pagination: the query seeks the key in the index, so it costs the same however deep the page is.
+    """
+    column = Character.__table__.c[order_by]
+    if order_by == "id":
+        columns, key, bound = [column], column, after and after[1]
+    else:
+        columns, key, bound = [column, Character.id], tuple_(column, Character.id), after and tuple_(*after)
+
+    statement = select(Character)
+    if bound is not None:
+        statement = statement.where(key > bound if ascending else key < bound)
+    statement = statement.order_by(*(c.asc() if ascending else c.desc() for c in columns))
+    return list(await db.scalars(statement.limit(limit)))
+
+
+async def count_characters(db: AsyncSession) -> int:
+    """Count the characters, caching the count in process for COUNT_CACHE_TTL seconds."""
+    global _characters_count
+    if _characters_count is None or time.monotonic() - _characters_count[0] >= COUNT_CACHE_TTL:
+        _characters_count = (time.monotonic(), await db.scalar(select(func.count()).select_from(Character)))
+    return _characters_count[1]
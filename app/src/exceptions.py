@@ -1,3 +1,5 @@
+import math
+
 from fastapi import Request
 from fastapi.responses import JSONResponse
 
@@ -5,8 +7,9 @@ from fastapi.responses import JSONResponse
 class RateLimitException(Exception):
     """Exception raised when API rate limit is exceeded"""
 
-    def __init__(self, message: str = "Too many requests"):
+    def __init__(self, message: str = "Too many requests", retry_after: int = 60):
         self.message = message
+        self.retry_after = retry_after
 
 
 class ServiceUnavailableException(Exception):
@@ -16,6 +19,22 @@ class ServiceUnavailableException(Exception):
         self.message = message
 
 
+class CircuitOpenException(ServiceUnavailableException):
+    """Exception raised when a call to a dependency is rejected by its open circuit breaker"""
+
+    def __init__(self, message: str = "Service temporarily unavailable", retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamThrottledException(ServiceUnavailableException):
+    """Exception raised when the upstream API answers 429 Too Many Requests"""
+
+    def __init__(self, message: str = "Rate limited by the upstream API", retry_after: float = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 class BadRequestException(Exception):
     """Exception raised when request is malformed or invalid"""
 
@@ -24,12 +43,18 @@ class BadRequestException(Exception):
 
 
 async def service_unavailable_exception_handler(request: Request, exc: ServiceUnavailableException):
-    return JSONResponse(status_code=503, content={"message": exc.message})
+    retry_after = getattr(exc, "retry_after", 0)
+    headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after else None
+    return JSONResponse(status_code=503, content={"message": exc.message}, headers=headers)
 
 
 async def rate_limit_exception_handler(request: Request, exc: RateLimitException):
     return JSONResponse(
         status_code=429,
         content={"message": exc.message},
-        headers={"Retry-After": "60"},  # Retry after 60 seconds
+        headers={"Retry-After": str(exc.retry_after)},
     )
+
+
+async def bad_request_exception_handler(request: Request, exc: BadRequestException):
+    return JSONResponse(status_code=400, content={"message": exc.message})
@@ -0,0 +1,213 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import uuid
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+
+import cache
+from exceptions import CircuitOpenException, UpstreamThrottledException
+from redis.exceptions import RedisError
+from upstream import UPSTREAM_TIMEOUT
+from utils import UPSTREAM_CONCURRENCY_LIMIT, UPSTREAM_GOVERNOR_WAIT, UPSTREAM_PAUSES
+
+logger = logging.getLogger(__name__)
+
+# Rate, concurrency and pauses of the requests to the upstream API, shared by every replica in Redis
+UPSTREAM_GOVERNOR_ENABLED = os.getenv("UPSTREAM_GOVERNOR_ENABLED", "true").lower() == "true"
+UPSTREAM_RATE_LIMIT = float(os.getenv("UPSTREAM_RATE_LIMIT", 20))  # requests per second, across the replicas
+UPSTREAM_RATE_BURST = int(os.getenv("UPSTREAM_RATE_BURST", 20))
+# The concurrency limit grows by 1 / limit per response in time and is multiplied by UPSTREAM_CONCURRENCY_BACKOFF, at
+# most once per UPSTREAM_BACKOFF_INTERVAL, on a 429, an error or a response UPSTREAM_LATENCY_TOLERANCE times slower
+UPSTREAM_CONCURRENCY_INITIAL = float(os.getenv("UPSTREAM_CONCURRENCY_INITIAL", 5))
+UPSTREAM_CONCURRENCY_MIN = float(os.getenv("UPSTREAM_CONCURRENCY_MIN", 1))
+UPSTREAM_CONCURRENCY_MAX = float(os.getenv("UPSTREAM_CONCURRENCY_MAX", 20))
+UPSTREAM_CONCURRENCY_BACKOFF = float(os.getenv("UPSTREAM_CONCURRENCY_BACKOFF", 0.5))
+UPSTREAM_BACKOFF_INTERVAL = float(os.getenv("UPSTREAM_BACKOFF_INTERVAL", 1))  # seconds
+UPSTREAM_LATENCY_TOLERANCE = float(os.getenv("UPSTREAM_LATENCY_TOLERANCE", 2))
+# How often a request waiting for a free concurrency slot checks again
+UPSTREAM_GOVERNOR_POLL_INTERVAL = float(os.getenv("UPSTREAM_GOVERNOR_POLL_INTERVAL", 0.05))  # seconds
+GOVERNOR_KEY = "upstream:governor"
+IN_FLIGHT_KEY = "upstream:in_flight"
+PAUSE_KEY = "upstream:paused_until"
+# Weight of a response in the usual latency, an exponentially weighted moving average
+LATENCY_WEIGHT = 0.05
+
+# Returns {0, 0} and takes a lease if the request is admitted, else {reason, milliseconds to wait}, the reason being
+# 1 while paused, 2 while the bucket is empty and 3 while the concurrency limit is reached. Leases expire with the
+# upstream timeout, a crashed replica does not hold its requests forever
+ACQUIRE_SCRIPT = cache.redis_client.register_script("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + time[2] / 1000
+local paused_until = tonumber(redis.call('GET', KEYS[3]))
+if paused_until and paused_until > now then
+    return {1, math.ceil(paused_until - now)}
+end
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at', 'limit')
+local tokens = tonumber(state[1]) or capacity
+local at = tonumber(state[2]) or now
+local limit = tonumber(state[3]) or tonumber(ARGV[3])
+tokens = math.min(capacity, tokens + math.max(now - at, 0) * rate)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= math.max(math.floor(limit), 1) then
+    return {3, tonumber(ARGV[6])}
+end
+if tokens < 1 then
+    return {2, math.ceil((1 - tokens) / rate)}
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1))
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[4]), ARGV[5])
+return {0, 0}
+""")
+
+# Releases a lease and adapts the concurrency limit, returning the new limit
+RELEASE_SCRIPT = cache.redis_client.register_script("""
+local time = redis.call('TIME')
+local now = time[1] * 1000 + time[2] / 1000
+redis.call('ZREM', KEYS[2], ARGV[1])
+local state = redis.call('HMGET', KEYS[1], 'limit', 'decreased_at')
+local limit = tonumber(state[1]) or tonumber(ARGV[3])
+if ARGV[2] == '1' then
+    if now - (tonumber(state[2]) or 0) >= tonumber(ARGV[7]) then
+        limit = math.max(limit * tonumber(ARGV[6]), tonumber(ARGV[4]))
+        redis.call('HSET', KEYS[1], 'limit', tostring(limit), 'decreased_at', tostring(now))
+    end
+else
+    limit = math.min(limit + 1 / limit, tonumber(ARGV[5]))
+    redis.call('HSET', KEYS[1], 'limit', tostring(limit))
+end
+return tostring(limit)
+""")
+
+# Pauses every replica for the milliseconds given, unless they are already paused for longer
+PAUSE_SCRIPT = cache.redis_client.register_script("""
+local time = redis.call('TIME')
+local paused_until = time[1] * 1000 + time[2] / 1000 + tonumber(ARGV[1])
+if (tonumber(redis.call('GET', KEYS[1])) or 0) < paused_until then
+    redis.call('SET', KEYS[1], tostring(paused_until), 'PX', ARGV[1])
+end
+""")
+
+WAIT_REASONS = {1: "paused", 2: "rate", 3: "concurrency"}
+
+# Usual latency of the upstream responses seen by this process
+_latency: float | None = None
+
+
+@dataclass
+class GovernedRequest:
+    lease: str | None
+    # Seconds a 429 response asked to wait, None if the request was not throttled
+    retry_after: float | None = None
+
+    def throttle(self, retry_after: float) -> None:
+        """Report a 429 response, pausing every replica for `retry_after` seconds once the request is released."""
+        self.retry_after = retry_after
+
+
+@contextlib.asynccontextmanager
+async def governed_request(max_pause: float) -> AsyncIterator[GovernedRequest]:
+    """
+    Wait until the governor admits a request to the upstream API and report its outcome once done.
+
+    Raises UpstreamThrottledException instead of waiting if every replica is paused for longer than `max_pause`.
+    Requests are admitted ungoverned while Redis is unavailable.
+    """
+    request = GovernedRequest(lease=await acquire(max_pause) if UPSTREAM_GOVERNOR_ENABLED else None)
+    start = time.monotonic()
+    congested: bool | None = True
+    try:
+        yield request
+        congested = request.retry_after is not None or is_slow(time.monotonic() - start)
+    except CircuitOpenException:
+        # Rejected by the circuit breaker of this process, the upstream API never saw the request
+        congested = None
+        raise
+    finally:
+        if request.lease is not None:
+            await release(request.lease, congested, request.retry_after)
+
+
+async def acquire(max_pause: float) -> str | None:
+    """Wait until a request is admitted and return its lease, None if Redis is unavailable."""
+    lease = uuid.uuid4().hex
+    waited = {}
+    try:
+        while True:
+            reason, wait = await ACQUIRE_SCRIPT(
+                keys=[GOVERNOR_KEY, IN_FLIGHT_KEY, PAUSE_KEY],
+                args=[
+                    repr(UPSTREAM_RATE_LIMIT / 1000),
+                    UPSTREAM_RATE_BURST,
+                    UPSTREAM_CONCURRENCY_INITIAL,
+                    int((UPSTREAM_TIMEOUT + 1) * 1000),
+                    lease,
+                    int(UPSTREAM_GOVERNOR_POLL_INTERVAL * 1000),
+                ],
+                client=cache.redis_client,
+            )
+            if not reason:
+                break
+            wait /= 1000
+            if WAIT_REASONS[reason] == "paused" and wait > max_pause:
+                raise UpstreamThrottledException("Every replica is paused by the upstream API", retry_after=wait)
+            waited[WAIT_REASONS[reason]] = waited.get(WAIT_REASONS[reason], 0) + wait
+            await asyncio.sleep(wait)
+    except RedisError as e:
+        logger.warning(f"Upstream rate governor unavailable, requesting the upstream API ungoverned: {str(e)}")
+        return None
+    finally:
+        for reason, wait in waited.items():
+            UPSTREAM_GOVERNOR_WAIT.labels(app_name="fastapi-app", reason=reason).observe(wait)
+    return lease
+
+
+async def release(lease: str, congested: bool | None, retry_after: float | None = None) -> None:
+    """
+    Release a lease, adapting the concurrency limit, and pause every replica if the request was throttled.
+
+    A request that was not sent, `congested` None, leaves the concurrency limit as is.
+    """
+    try:
+        if retry_after:
+            await pause(retry_after)
+        if congested is None:
+            await cache.redis_client.zrem(IN_FLIGHT_KEY, lease)
+            return
+        limit = await RELEASE_SCRIPT(
+            keys=[GOVERNOR_KEY, IN_FLIGHT_KEY],
+            args=[
+                lease,
+                int(congested),
+                UPSTREAM_CONCURRENCY_INITIAL,
+                UPSTREAM_CONCURRENCY_MIN,
+                UPSTREAM_CONCURRENCY_MAX,
+                UPSTREAM_CONCURRENCY_BACKOFF,
+                int(UPSTREAM_BACKOFF_INTERVAL * 1000),
+            ],
+            client=cache.redis_client,
+        )
+    except RedisError as e:
+        logger.warning(f"Error releasing an upstream request, its lease expires with the upstream timeout: {str(e)}")
+        return
+    UPSTREAM_CONCURRENCY_LIMIT.labels(app_name="fastapi-app").set(float(limit))
+
+
+async def pause(seconds: float) -> None:
+    """Pause the requests of every replica to the upstream API for `seconds`."""
+    UPSTREAM_PAUSES.labels(app_name="fastapi-app").inc()
+    logger.warning(f"Rate limited by the upstream API, pausing every replica for {seconds} seconds")
+    await PAUSE_SCRIPT(keys=[PAUSE_KEY], args=[max(int(seconds * 1000), 1)], client=cache.redis_client)
+
+
+def is_slow(latency: float) -> bool:
+    """Check if a response took longer than tolerated compared with the usual latency, then update it."""
+    global _latency
+    slow = _latency is not None and latency > UPSTREAM_LATENCY_TOLERANCE * _latency
+    _latency = latency if _latency is None else _latency + LATENCY_WEIGHT * (latency - _latency)
+    return slow
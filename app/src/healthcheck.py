@@ -1,13 +1,27 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections.abc import Awaitable, Callable
 from datetime import datetime
 from typing import TypedDict
 
 from cache import redis_client
 from database import engine
-from psycopg2.extensions import QueryCanceledError
 from pydantic import BaseModel
 from redis.exceptions import RedisError
 from sqlalchemy import text
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+# How often the background checker runs the deep checks
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", 10))  # seconds
+# How long each component check may take before the component is reported unhealthy
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", 5))  # seconds
+# Cached results older than this are reported unhealthy, the background checker is stuck
+HEALTH_CHECK_MAX_AGE = float(os.getenv("HEALTH_CHECK_MAX_AGE", HEALTH_CHECK_INTERVAL * 3))  # seconds
 
 
 class ComponentHealth(TypedDict):
@@ -25,17 +39,27 @@ class HealthCheck(BaseModel):
     status: str
     timestamp: str
     checks: ComponentChecks
+    # Seconds since the checks ran
+    age: float = 0
+
+
+_latest_health: tuple[float, HealthCheck] | None = None
+_health_checker: asyncio.Task | None = None
 
 
-def check_database() -> ComponentHealth:
+# SQLSTATE of statements cancelled by the statement timeout
+QUERY_CANCELED = "57014"
+
+
+async def check_database() -> ComponentHealth:
     """Check database connectivity and write operations"""
     try:
-        with engine.connect() as connection:
+        async with engine.connect() as connection:
             # Test 1: Basic connectivity
-            connection.execute(text("SELECT 1"))
+            await connection.execute(text("SELECT 1"))
 
             # Test 2: Check write operation with temporary table
-            connection.execute(
+            await connection.execute(
                 text("""
                 CREATE TEMPORARY TABLE healthcheck_test (
                     id serial PRIMARY KEY,
@@ -45,27 +69,31 @@ def check_database() -> ComponentHealth:
             )
 
             # Test 3: Test write operation
-            connection.execute(text("INSERT INTO healthcheck_test (test_col) VALUES ('test_value')"))
+            await connection.execute(text("INSERT INTO healthcheck_test (test_col) VALUES ('test_value')"))
 
             # Get basic metrics
             metrics = {}
 
             # Get database size
-            db_size = connection.execute(
-                text("""
+            db_size = (
+                await connection.execute(
+                    text("""
                 SELECT pg_size_pretty(pg_database_size(current_database()))
             """)
+                )
             ).scalar()
             metrics["database_size"] = db_size
 
             # Get active write transactions
-            active_writes = connection.execute(
-                text("""
+            active_writes = (
+                await connection.execute(
+                    text("""
                 SELECT count(*)
                 FROM pg_stat_activity
                 WHERE state = 'active'
                 AND query ~* '^(insert|update|delete)'
             """)
+                )
             ).scalar()
             metrics["active_write_transactions"] = str(active_writes)
 
@@ -83,10 +111,16 @@ def check_database() -> ComponentHealth:
                 metrics=metrics,
             )
 
-    except QueryCanceledError:
+    except DBAPIError as e:
+        if getattr(e.orig, "sqlstate", None) == QUERY_CANCELED:
+            return ComponentHealth(
+                status="unhealthy",
+                message="Database query timeout",
+                metrics={},
+            )
         return ComponentHealth(
             status="unhealthy",
-            message="Database query timeout",
+            message=f"Database error: {str(e)}",
             metrics={},
         )
     except SQLAlchemyError as e:
@@ -97,11 +131,11 @@ def check_database() -> ComponentHealth:
         )
 
 
-def check_redis() -> ComponentHealth:
+async def check_redis() -> ComponentHealth:
     """Check Redis cache connectivity and operations"""
     try:
         # Check basic connectivity
-        if not redis_client.ping():
+        if not await redis_client.ping():
             return ComponentHealth(
                 status="unhealthy",
                 message="Redis ping failed",
@@ -111,7 +145,7 @@ def check_redis() -> ComponentHealth:
         # Test write operation
         test_key = "healthcheck:test"
         test_value = "test_value"
-        if not redis_client.set(test_key, test_value, ex=10):  # Expire in 10 seconds
+        if not await redis_client.set(test_key, test_value, ex=10):  # Expire in 10 seconds
             return ComponentHealth(
                 status="unhealthy",
                 message="Redis write operation failed",
@@ -119,7 +153,7 @@ def check_redis() -> ComponentHealth:
             )
 
         # Test read operation
-        read_value = redis_client.get(test_key)
+        read_value = await redis_client.get(test_key)
         if not read_value or read_value.decode("utf-8") != test_value:
             return ComponentHealth(
                 status="unhealthy",
@@ -128,7 +162,7 @@ def check_redis() -> ComponentHealth:
             )
 
         # Test delete operation
-        if not redis_client.delete(test_key):
+        if not await redis_client.delete(test_key):
             return ComponentHealth(
                 status="unhealthy",
                 message="Redis delete operation failed",
@@ -136,7 +170,7 @@ def check_redis() -> ComponentHealth:
             )
 
         # Check memory usage
-        info = redis_client.info(section="memory")
+        info = await redis_client.info(section="memory")
         used_memory_percent = (
             int(info["used_memory"]) / int(info["maxmemory"]) * 100
             if "maxmemory" in info and int(info["maxmemory"]) > 0
@@ -169,10 +203,23 @@ def check_redis() -> ComponentHealth:
         )
 
 
-def get_health() -> HealthCheck:
+async def check_with_timeout(name: str, check: Callable[[], Awaitable[ComponentHealth]]) -> ComponentHealth:
+    """Run a component check, reporting the component unhealthy if it takes longer than HEALTH_CHECK_TIMEOUT."""
+    try:
+        return await asyncio.wait_for(check(), HEALTH_CHECK_TIMEOUT)
+    except TimeoutError:
+        return ComponentHealth(
+            status="unhealthy",
+            message=f"{name} check timed out after {HEALTH_CHECK_TIMEOUT:g}s",
+            metrics={},
+        )
+
+
+async def get_health() -> HealthCheck:
     """Perform deep health checks and return overall system status"""
-    db_status = check_database()
-    cache_status = check_redis()
+    db_status, cache_status = await asyncio.gather(
+        check_with_timeout("Database", check_database), check_with_timeout("Redis", check_redis)
+    )
 
     # Determine overall status
     all_healthy = all(check["status"] == "healthy" for check in [db_status, cache_status])
@@ -184,3 +231,54 @@ def get_health() -> HealthCheck:
         timestamp=datetime.utcnow().isoformat(),
         checks=checks,
     )
+
+
+async def refresh_health() -> HealthCheck:
+    """Run the deep health checks and cache their result for `get_cached_health`."""
+    global _latest_health
+    health = await get_health()
+    _latest_health = (time.monotonic(), health)
+    return health
+
+
+def get_cached_health() -> HealthCheck | None:
+    """
+    Return the result of the last deep health checks with its age, None if they have not run yet.
+
+    Results older than HEALTH_CHECK_MAX_AGE are reported unhealthy.
+    """
+    if _latest_health is None:
+        return None
+    checked_at, health = _latest_health
+    age = time.monotonic() - checked_at
+    status = "unhealthy" if age > HEALTH_CHECK_MAX_AGE else health.status
+    return health.model_copy(update={"age": round(age, 3), "status": status})
+
+
+async def run_health_checker() -> None:
+    """Run the deep health checks right away, then every HEALTH_CHECK_INTERVAL seconds."""
+    while True:
+        try:
+            health = await refresh_health()
+            if health.status != "healthy":
+                logger.warning(f"Health check failed: {health.checks}")
+        except Exception as e:
+            logger.error(f"Error running the health checks: {str(e)}")
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+def start_health_checker() -> None:
+    """Start the background health checker task."""
+    global _health_checker
+    if _health_checker is None or _health_checker.done():
+        _health_checker = asyncio.create_task(run_health_checker())
+
+
+async def stop_health_checker() -> None:
+    """Cancel the background health checker task and wait for it to finish."""
+    global _health_checker
+    if _health_checker is not None:
+        _health_checker.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _health_checker
+        _health_checker = None
@@ -1,26 +1,74 @@
+import asyncio
+import hashlib
 import logging
+import math
 import os
+from contextlib import asynccontextmanager
 from enum import Enum
 
+import server
 import uvicorn
-from cache import is_rate_limited
-from characters import get_all_characters
-from database import Base, CharacterResponse, engine, get_db
+from cache import (
+    close_redis_client,
+    has_cached_characters,
+    rate_limit,
+    start_invalidation_listener,
+    stop_invalidation_listener,
+)
+from characters import bootstrap_characters, get_all_characters
+from database import (
+    CharacterResponse,
+    count_characters,
+    create_schema,
+    create_tables,
+    engine,
+    get_characters_after,
+    get_characters_page,
+    get_db,
+)
 from exceptions import (
+    BadRequestException,
     RateLimitException,
     ServiceUnavailableException,
+    bad_request_exception_handler,
     rate_limit_exception_handler,
     service_unavailable_exception_handler,
 )
-from fastapi import Depends, FastAPI, Query, status
-from fastapi.responses import JSONResponse
-from fastapi_pagination import Page, add_pagination, paginate
+from fastapi import Depends, FastAPI, Query, Request, status
+from fastapi.responses import JSONResponse, Response
+from fastapi_pagination import Page, Params, add_pagination, create_page, paginate
 from fastapi_pagination.utils import disable_installed_extensions_check
-from healthcheck import HealthCheck, get_health
-from sqlalchemy.orm import Session
-from utils import PrometheusMiddleware, metrics, setting_otlp
+from healthcheck import (
+    HealthCheck,
+    get_cached_health,
+    get_health,
+    refresh_health,
+    start_health_checker,
+    stop_health_checker,
+)
+from pagination import CursorPage, keyset_slice, paginate_cursor
+from pydantic import TypeAdapter
+from refresher import REFRESHER_ENABLED, is_refresher_running, start_refresher, stop_refresher
+from response_cache import cache_response, get_cached_response
+from sqlalchemy.ext.asyncio import AsyncSession
+from upstream import close_http_client, create_http_client, set_http_client, upstream_breaker
+from utils import PrometheusMiddleware, clear_multiprocess_metrics, mark_process_dead, metrics, setting_otlp
 
 OTLP_GRPC_ENDPOINT = os.environ.get("OTLP_GRPC_ENDPOINT", "http://tempo:4317")
+# Where /characters is sorted and paginated: "cache" sorts the cached characters in process,
+# "database" queries a single page from the characters table
+CHARACTERS_SOURCE = os.environ.get("CHARACTERS_SOURCE", "cache")
+# Clients sending one of the comma separated RATE_LIMIT_API_KEYS in this header are rate limited by API key,
+# other clients by IP address
+RATE_LIMIT_KEY_HEADER = os.environ.get("RATE_LIMIT_KEY_HEADER", "X-API-Key")
+# Only the hashes of the API keys are kept
+RATE_LIMIT_API_KEY_HASHES = frozenset(
+    hashlib.sha256(key.strip().encode()).hexdigest()
+    for key in os.environ.get("RATE_LIMIT_API_KEYS", "").split(",")
+    if key.strip()
+)
+# Create the tables on startup, turned off in the workers when the server created them before starting them
+CREATE_TABLES_ON_STARTUP = os.environ.get("CREATE_TABLES_ON_STARTUP", "true").lower() == "true"
 
 
 # Configure logging
@@ -33,16 +81,45 @@ class EndpointFilter(logging.Filter):
 # Filter out metrics endpoint
 logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create database tables
+    if CREATE_TABLES_ON_STARTUP:
+        await create_tables()
+    # Serve the characters of the last snapshot until they are refreshed, instead of crawling on the first request
+    await bootstrap_characters()
+    # Share one pooled upstream client for the lifetime of the app
+    set_http_client(create_http_client())
+    # Report the state of the upstream circuit breaker before its first transition
+    upstream_breaker.export_state()
+    # Drop the characters other replicas replace from the in-process L1 cache
+    start_invalidation_listener()
+    # Keep the characters cache warm out of the request path
+    if REFRESHER_ENABLED:
+        start_refresher()
+    # Run the deep health checks out of the probes
+    start_health_checker()
+    yield
+    await stop_health_checker()
+    await stop_refresher()
+    await stop_invalidation_listener()
+    await close_http_client()
+    # The server drained the requests in flight, close the connection pools
+    await close_redis_client()
+    await engine.dispose()
+    # Drop the live gauges of this worker from the metrics aggregated across workers
+    mark_process_dead(os.getpid())
+
 
 # Initialize FastAPI app
-app = FastAPI(openapi_prefix=os.getenv("ROOT_PATH", ""))
+app = FastAPI(openapi_prefix=os.getenv("ROOT_PATH", ""), lifespan=lifespan)
 add_pagination(app)
 disable_installed_extensions_check()
 # Register exception handler
 app.add_exception_handler(RateLimitException, rate_limit_exception_handler)
 app.add_exception_handler(ServiceUnavailableException, service_unavailable_exception_handler)
+app.add_exception_handler(BadRequestException, bad_request_exception_handler)
 # Configure Prometheus middleware
 app.add_middleware(PrometheusMiddleware, "app")
 app.add_route("/metrics", metrics)
@@ -50,6 +127,20 @@ app.add_route("/metrics", metrics)
 setting_otlp(app, "fastapi-app", OTLP_GRPC_ENDPOINT)
 
 
+def client_identity(request: Request) -> str:
+    """
+    Identify the client of a request for rate limiting, without keeping its API key.
+
+    Unknown API keys are ignored, so that clients cannot get a fresh limit by sending a new key with every request.
+    """
+    api_key = request.headers.get(RATE_LIMIT_KEY_HEADER)
+    if api_key:
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        if key_hash in RATE_LIMIT_API_KEY_HASHES:
+            return "key:" + key_hash
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
 class SortField(str, Enum):
     NAME = "name"
     ID = "id"
@@ -60,26 +151,85 @@ class SortOrder(str, Enum):
     DESC = "desc"
 
 
-@app.get("/characters")
+class PaginationMode(str, Enum):
+    OFFSET = "offset"
+    CURSOR = "cursor"
+
+
+CharactersPage = Page[CharacterResponse] | CursorPage[CharacterResponse]
+# Validates and renders /characters pages as FastAPI would, for the pre-rendered responses
+CHARACTERS_RESPONSE = TypeAdapter(CharactersPage)
+
+
+@app.get("/characters", response_model=CharactersPage)
 async def get_characters(
+    request: Request,
     order_by: SortField = Query(default=SortField.ID, description="Field to sort by"),  # noqa: B008
     order: SortOrder = Query(default=SortOrder.ASC, description="Sort order"),  # noqa: B008
-    db: Session = Depends(get_db),  # noqa: B008
-) -> Page[CharacterResponse]:
-    if is_rate_limited():
-        raise RateLimitException()
+    pagination: PaginationMode = Query(  # noqa: B008
+        default=PaginationMode.OFFSET, description="Paginate by page number or by the cursors of the previous page"
+    ),
+    cursor: str | None = Query(default=None, description="Cursor of the page to get, implies cursor pagination"),
+    params: Params = Depends(),  # noqa: B008
+    db: AsyncSession = Depends(get_db),  # noqa: B008
+) -> CharactersPage | Response:
+    retry_after = await rate_limit(client_identity(request))
+    if retry_after:
+        raise RateLimitException(retry_after=math.ceil(retry_after))
+
+    by_cursor = pagination == PaginationMode.CURSOR or cursor is not None
+
+    if CHARACTERS_SOURCE == "database":
+        # Make sure the characters were fetched, the table is kept in sync with the cache
+        if not await has_cached_characters():
+            await get_all_characters(db, read_only=is_refresher_running())
+
+        if by_cursor:
+            return await paginate_cursor(
+                lambda after, ascending, limit: get_characters_after(db, order_by.value, after, ascending, limit),
+                lambda character: (getattr(character, order_by.value), character.id),
+                order_by.value,
+                order.value,
+                params.size,
+                cursor,
+            )
+
+        raw_params = params.to_raw_params()
+        characters = await get_characters_page(
+            db, order_by.value, order == SortOrder.DESC, limit=raw_params.limit, offset=raw_params.offset
+        )
+        return create_page(characters, total=await count_characters(db), params=params)
 
     # Get characters (either from cache or by fetching)
-    characters = get_all_characters(db)
+    cached = await get_all_characters(db, read_only=is_refresher_running())
 
-    # Sort the characters based on the parameters
-    sorted_characters = sorted(
-        characters,
-        key=lambda x: x[order_by.value],
-        reverse=(order == SortOrder.DESC),
-    )
+    # Pages of a dataset version never change, serve them as rendered the first time
+    response_key = (order_by, order, by_cursor, params.page, params.size, cursor if by_cursor else None)
+    body = get_cached_response(cached.version, response_key)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+
+    if by_cursor:
+
+        async def slice_characters(after: tuple | None, ascending: bool, limit: int) -> list[dict]:
+            return keyset_slice(cached.sorted_by(order_by.value), cached.keys(order_by.value), after, ascending, limit)
 
-    return paginate(sorted_characters)
+        # Cursors break ties by id, so pages stay stable when characters share a name
+        page = await paginate_cursor(
+            slice_characters,
+            lambda character: (character[order_by.value], character["id"]),
+            order_by.value,
+            order.value,
+            params.size,
+            cursor,
+        )
+    else:
+        # The characters are sorted once per dataset, a page is a slice of the sorted characters
+        page = paginate(cached.sorted_by(order_by.value, order == SortOrder.DESC), params)
+
+    body = CHARACTERS_RESPONSE.dump_json(CHARACTERS_RESPONSE.validate_python(page.model_dump()))
+    cache_response(cached.version, response_key, body)
+    return Response(content=body, media_type="application/json")
 
 
 @app.get(
@@ -90,7 +240,31 @@ async def get_characters(
     response_model=HealthCheck,
 )
 async def healthcheck():
-    health_result = get_health()
+    health_result = await get_health()
+    status_code = status.HTTP_200_OK if health_result.status == "healthy" else status.HTTP_503_SERVICE_UNAVAILABLE
+    return JSONResponse(status_code=status_code, content=health_result.__dict__)
+
+
+@app.get(
+    "/livez",
+    tags=["healthcheck"],
+    summary="Check that the process is alive",
+    response_description="Return HTTP Status Code 200 (OK) while the process serves requests",
+)
+async def livez():
+    return {"status": "alive"}
+
+
+@app.get(
+    "/readyz",
+    tags=["healthcheck"],
+    summary="Check that the service is ready to serve requests",
+    response_description="Return HTTP Status Code 200 (OK) if the last background health check was healthy, 503 if not",
+    response_model=HealthCheck,
+)
+async def readyz():
+    # Served from the background checks, only the first probe of the process waits for them
+    health_result = get_cached_health() or await refresh_health()
     status_code = status.HTTP_200_OK if health_result.status == "healthy" else status.HTTP_503_SERVICE_UNAVAILABLE
     return JSONResponse(status_code=status_code, content=health_result.__dict__)
 
@@ -102,4 +276,10 @@ if __name__ == "__main__":
         "%(asctime)s %(levelname)s [%(name)s] [%(filename)s:%(lineno)d] "
         "[trace_id=%(otelTraceID)s span_id=%(otelSpanID)s resource.service.name=%(otelServiceName)s] - %(message)s"
     )
-    uvicorn.run(app, host="0.0.0.0", port="8000", log_config=log_config)
+    # Start the workers with no metrics left by the workers of the previous run, no metric is set at import time
+    clear_multiprocess_metrics()
+    # Create the tables once here instead of in every worker
+    asyncio.run(create_schema())
+    os.environ["CREATE_TABLES_ON_STARTUP"] = "false"
+    CREATE_TABLES_ON_STARTUP = False
+    server.run(app, "main:app", log_config)
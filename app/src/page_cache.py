@@ -0,0 +1,71 @@
+import hashlib
+import logging
+import os
+from dataclasses import asdict, dataclass
+
+import cache
+from cache import decode_payload, encode_payload
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Upstream pages are cached one by one with the validators of their response, crawls request them conditionally and
+# reuse those answered 304 Not Modified or with the same body. Each is kept this long after it was last fetched or
+# revalidated
+UPSTREAM_PAGE_TTL = int(os.getenv("UPSTREAM_PAGE_TTL", 24 * 60 * 60))  # seconds
+
+
+@dataclass(frozen=True)
+class CachedPage:
+    # Number of pages the upstream API had when the page was fetched
+    pages: int
+    # Earth characters of the page
+    characters: list[dict]
+    # SHA-1 of the response body
+    digest: str
+    etag: str | None = None
+    last_modified: str | None = None
+
+    @property
+    def validators(self) -> dict[str, str]:
+        """Headers making a request conditional on the page having changed since it was cached."""
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+def page_key(url: str, page: int) -> str:
+    return f"upstream:page:{hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]}:{page}"
+
+
+def body_digest(body: bytes) -> str:
+    return hashlib.sha1(body).hexdigest()
+
+
+async def get_cached_page(url: str, page: int) -> CachedPage | None:
+    """Read page `page` of `url` from the page cache, None if it is not cached or cannot be read."""
+    try:
+        data = await cache.redis_client.get(page_key(url, page))
+        return CachedPage(**decode_payload(data)) if data else None
+    except (RedisError, ValueError, TypeError) as e:
+        logger.warning(f"Not reading page {page} from the page cache: {str(e)}")
+        return None
+
+
+async def set_cached_page(url: str, page: int, cached: CachedPage) -> None:
+    """Cache page `page` of `url` for UPSTREAM_PAGE_TTL."""
+    try:
+        await cache.redis_client.set(page_key(url, page), encode_payload(asdict(cached)), ex=UPSTREAM_PAGE_TTL)
+    except RedisError as e:
+        logger.warning(f"Not caching page {page}: {str(e)}")
+
+
+async def touch_cached_page(url: str, page: int) -> None:
+    """Keep page `page` of `url` cached for another UPSTREAM_PAGE_TTL, once revalidated."""
+    try:
+        await cache.redis_client.expire(page_key(url, page), UPSTREAM_PAGE_TTL)
+    except RedisError as e:
+        logger.warning(f"Not extending the TTL of page {page}: {str(e)}")
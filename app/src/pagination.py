@@ -0,0 +1,101 @@
+import base64
+import json
+from bisect import bisect_left, bisect_right
+from collections.abc import Awaitable, Callable, Sequence
+from typing import Any, Generic, NamedTuple, TypeVar
+
+from exceptions import BadRequestException
+from pydantic import BaseModel, ConfigDict
+
+T = TypeVar("T")
+
+
+class CursorPage(BaseModel, Generic[T]):
+    # No defaults, so cursor pages and offset pages are never mistaken for one another in the /characters response
+    model_config = ConfigDict(extra="forbid")
+
+    items: list[T]
+    size: int
+    next_page: str | None
+    previous_page: str | None
+
+
+class Cursor(NamedTuple):
+    order_by: str
+    order: str
+    value: int | str
+    id: int
+    backwards: bool
+
+
+def encode_cursor(cursor: Cursor) -> str:
+    """Encode a cursor as an opaque URL-safe string."""
+    return base64.urlsafe_b64encode(json.dumps(list(cursor)).encode()).decode()
+
+
+def decode_cursor(cursor: str, order_by: str, order: str) -> Cursor:
+    """Decode a cursor, checking it was created for the requested sort order."""
+    try:
+        decoded = Cursor(*json.loads(base64.urlsafe_b64decode(cursor.encode())))
+    except (ValueError, TypeError) as e:
+        raise BadRequestException("Invalid cursor") from e
+    # Booleans are ints to isinstance, the exact types are checked
+    if type(decoded.value) not in (int, str) or type(decoded.id) is not int or type(decoded.backwards) is not bool:
+        raise BadRequestException("Invalid cursor")
+
+    if (decoded.order_by, decoded.order) != (order_by, order):
+        raise BadRequestException("Cursor was created for a different sort order")
+    # Sort values are compared with the ids when sorting by id, and with strings otherwise
+    if (type(decoded.value) is int) != (order_by == "id"):
+        raise BadRequestException("Invalid cursor")
+    return decoded
+
+
+async def paginate_cursor(
+    fetch: Callable[[tuple | None, bool, int], Awaitable[Sequence[T]]],
+    key: Callable[[T], tuple],
+    order_by: str,
+    order: str,
+    size: int,
+    cursor: str | None = None,
+) -> CursorPage[T]:
+    """
+    Create a page of `size` items following (or preceding, for a previous page cursor) `cursor`.
+
+    `fetch(after, ascending, limit)` returns up to `limit` items whose (order_by value, id) key follows `after`
+    in ascending or descending key order, and `key` returns the (order_by value, id) key of an item.
+    """
+    current = decode_cursor(cursor, order_by, order) if cursor else None
+    backwards = current is not None and current.backwards
+    after = (current.value, current.id) if current else None
+
+    # Walking a descending order forwards is walking the keys backwards, and vice versa
+    items = list(await fetch(after, (order == "desc") == backwards, size + 1))
+    has_more = len(items) > size
+    items = items[:size]
+    if backwards:
+        items.reverse()
+
+    def page_cursor(item: T, backwards: bool) -> str:
+        return encode_cursor(Cursor(order_by, order, *key(item), backwards))
+
+    has_next = current is not None if backwards else has_more
+    has_previous = has_more if backwards else current is not None
+    return CursorPage[Any](
+        items=items,
+        size=size,
+        next_page=page_cursor(items[-1], False) if items and has_next else None,
+        previous_page=page_cursor(items[0], True) if items and has_previous else None,
+    )
+
+
+def keyset_slice(
+    items: Sequence[T], keys: Sequence[tuple], after: tuple | None, ascending: bool, limit: int
+) -> list[T]:
+    """Get up to `limit` items following the key `after`, from `items` sorted by their ascending `keys`."""
+    if ascending:
+        start = bisect_right(keys, tuple(after)) if after else 0
+        return list(items[start : start + limit])
+
+    end = bisect_left(keys, tuple(after)) if after else len(items)
+    return list(items[max(end - limit, 0) : end][::-1])
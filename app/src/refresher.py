@@ -0,0 +1,83 @@
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import time
+
+from cache import CACHE_SOFT_TTL, get_cached_characters
+from characters import refresh_characters
+from database import SessionLocal
+from utils import REFRESH_FAILURES, REFRESH_INTERVAL_SECONDS, REFRESH_LAST_SUCCESS
+
+logger = logging.getLogger(__name__)
+
+# Background refresher configuration
+REFRESHER_ENABLED = os.getenv("REFRESHER_ENABLED", "true").lower() == "true"
+# Refresh before the cached characters go stale. Exported as characters_refresh_interval_seconds, the
+# CharactersRefreshStale alert fires when no refresh succeeded for 3 intervals
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", CACHE_SOFT_TTL * 0.8))  # seconds
+REFRESH_JITTER = float(os.getenv("REFRESH_JITTER", 0.1))  # fraction of the interval
+# Wait before retrying a refresh that failed, or was skipped while the refresh lock was held
+REFRESH_RETRY_INTERVAL = float(os.getenv("REFRESH_RETRY_INTERVAL", 5))  # seconds
+
+_refresher: asyncio.Task | None = None
+
+
+async def refresh_once() -> bool:
+    """
+    Refresh the cached characters unless another replica refreshed them during the current interval.
+
+    Returns False if the characters are still to be refreshed, because the refresh failed or the refresh lock was
+    held. The holder may be a replica whose crawl then fails, the characters are checked again soon.
+    """
+    cached = await get_cached_characters()
+    if cached and cached.age < REFRESH_INTERVAL:
+        logger.debug(f"Characters refreshed {cached.age:.1f}s ago, skipping refresh")
+        return True
+
+    try:
+        async with SessionLocal() as db:
+            characters = await refresh_characters(db)
+    except Exception as e:
+        REFRESH_FAILURES.labels(app_name="fastapi-app").inc()
+        logger.error(f"Error refreshing characters: {str(e)}")
+        return False
+
+    if characters is None:
+        logger.debug("Characters are being refreshed by another replica, checking again shortly")
+        return False
+    REFRESH_LAST_SUCCESS.labels(app_name="fastapi-app").set(time.time())
+    return True
+
+
+async def run_refresher() -> None:
+    """Warm the cache right away, then refresh it every interval, spreading replicas apart with jitter."""
+    REFRESH_INTERVAL_SECONDS.labels(app_name="fastapi-app").set(REFRESH_INTERVAL)
+    while True:
+        if await refresh_once():
+            delay = REFRESH_INTERVAL * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)
+        else:
+            delay = REFRESH_RETRY_INTERVAL
+        await asyncio.sleep(delay)
+
+
+def start_refresher() -> None:
+    """Start the background refresher task."""
+    global _refresher
+    if _refresher is None or _refresher.done():
+        _refresher = asyncio.create_task(run_refresher())
+
+
+async def stop_refresher() -> None:
+    """Cancel the background refresher task and wait for it to finish."""
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _refresher
+        _refresher = None
+
+
+def is_refresher_running() -> bool:
+    return _refresher is not None and not _refresher.done()
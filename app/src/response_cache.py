@@ -0,0 +1,53 @@
+import os
+from collections import OrderedDict
+from collections.abc import Hashable
+
+from utils import RESPONSE_CACHE_BYTES, RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES
+
+# Memory bound of the pre-rendered responses, the least recently used responses are evicted first
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# Rendered response bodies of the current dataset version, in least recently used order
+_responses: OrderedDict[Hashable, bytes] = OrderedDict()
+_responses_bytes = 0
+_responses_version: str | None = None
+
+
+def get_cached_response(version: str | None, key: Hashable) -> bytes | None:
+    """Get the response body rendered for `key` from the dataset `version`, if it is cached."""
+    body = _responses.get(key) if version is not None and version == _responses_version else None
+    if body is None:
+        RESPONSE_CACHE_MISSES.labels(app_name="fastapi-app").inc()
+        return None
+
+    RESPONSE_CACHE_HITS.labels(app_name="fastapi-app").inc()
+    _responses.move_to_end(key)
+    return body
+
+
+def cache_response(version: str | None, key: Hashable, body: bytes) -> None:
+    """Cache the response body rendered for `key` from the dataset `version`, dropping those of other versions."""
+    global _responses_bytes, _responses_version
+    if version is None or len(body) > RESPONSE_CACHE_MAX_BYTES:
+        return
+
+    if version != _responses_version:
+        clear_cached_responses()
+        _responses_version = version
+
+    previous = _responses.pop(key, None)
+    if previous is not None:
+        _responses_bytes -= len(previous)
+    _responses[key] = body
+    _responses_bytes += len(body)
+    while _responses_bytes > RESPONSE_CACHE_MAX_BYTES:
+        _responses_bytes -= len(_responses.popitem(last=False)[1])
+    RESPONSE_CACHE_BYTES.labels(app_name="fastapi-app").set(_responses_bytes)
+
+
+def clear_cached_responses() -> None:
+    global _responses_bytes, _responses_version
+    _responses.clear()
+    _responses_bytes = 0
+    _responses_version = None
+    RESPONSE_CACHE_BYTES.labels(app_name="fastapi-app").set(0)
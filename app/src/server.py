@@ -0,0 +1,93 @@
+import importlib.util
+import logging
+import math
+import os
+
+import uvicorn
+from starlette.types import ASGIApp
+
+logger = logging.getLogger(__name__)
+
+# Server configuration
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
+# Worker processes, 0 starts one per CPU the container may use, or a single one without PROMETHEUS_MULTIPROC_DIR
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 0))
+# Keep idle client connections open longer than the load balancer in front does
+SERVER_KEEPALIVE_TIMEOUT = int(os.getenv("SERVER_KEEPALIVE_TIMEOUT", 5))  # seconds
+# Connections waiting to be accepted while the workers are busy
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", 2048))
+# How long a stopping worker waits for the requests in flight, below the pod termination grace period
+SERVER_GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_SHUTDOWN_TIMEOUT", 25))  # seconds
+# Comma separated addresses of the proxies trusted to set X-Forwarded-For and X-Forwarded-Proto, "*" trusts any
+SERVER_FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def read_file(path: str) -> str:
+    with open(path) as file:
+        return file.read().strip()
+
+
+def cpu_quota() -> float | None:
+    """Return the CPUs the cgroup CPU quota of the container allows, None without a quota."""
+    try:
+        quota, period = read_file(CGROUP_V2_CPU_MAX).split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        quota = int(read_file(CGROUP_V1_CPU_QUOTA))
+        return None if quota <= 0 else quota / int(read_file(CGROUP_V1_CPU_PERIOD))
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    """Return the CPUs this process may run on, rounded up from the CPU quota when there is one."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    quota = cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(cpus, 1)
+
+
+def get_workers() -> int:
+    """Return SERVER_WORKERS, else one worker per CPU if their metrics can be aggregated, else a single worker."""
+    if SERVER_WORKERS:
+        return SERVER_WORKERS
+    return available_cpus() if os.getenv("PROMETHEUS_MULTIPROC_DIR") else 1
+
+
+def run(app: ASGIApp, app_import: str, log_config: dict) -> None:
+    """
+    Serve `app` with uvicorn, in as many worker processes as SERVER_WORKERS.
+
+    Workers import the app from `app_import`, a single worker serves `app` from this process.
+    uvloop and httptools are used when they are installed.
+    """
+    workers = get_workers()
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    if workers > 1 and not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        logger.warning("PROMETHEUS_MULTIPROC_DIR is not set, /metrics only reports the worker answering the scrape")
+    logger.info(f"Starting {workers} workers with the {loop} event loop and the {http} HTTP parser")
+
+    uvicorn.run(
+        app if workers == 1 else app_import,
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=SERVER_KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_SHUTDOWN_TIMEOUT,
+        proxy_headers=True,
+        forwarded_allow_ips=SERVER_FORWARDED_ALLOW_IPS,
+        log_config=log_config,
+    )
@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from cache import CACHE_CODEC, CACHE_COMPRESSION, CODECS, COMPRESSIONS, CachedCharacters, get_cached_characters
+
+# Where the snapshot is written after every refresh and read on startup if no characters are cached, unset disables it
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH")
+
+# A snapshot is a preamble, a JSON header with the offset of every column and the SHA-256 of the body, and a body of
+# one compressed column per character field, so that similar values compress together
+SNAPSHOT_MAGIC = b"RMCHARS\0"
+SNAPSHOT_FORMAT_VERSION = 1
+# Magic bytes, format version and header length
+PREAMBLE = struct.Struct("<8sHI")
+
+
+def write_snapshot(
+    path: str, cached: CachedCharacters, codec: str = CACHE_CODEC, compression: str = CACHE_COMPRESSION
+) -> int:
+    """Write the characters to a snapshot at `path`, replacing it atomically, and return the snapshot size."""
+    characters = cached.characters
+    fields = list(characters[0]) if characters else []
+    body = bytearray()
+    columns = {}
+    for name in fields:
+        column = COMPRESSIONS[compression].dumps(CODECS[codec].dumps([character.get(name) for character in characters]))
+        columns[name] = [len(body), len(column)]
+        body += column
+
+    header = json.dumps(
+        {
+            "version": cached.version,
+            "updated_at": cached.updated_at,
+            "count": len(characters),
+            "codec": codec,
+            "compression": compression,
+            "columns": columns,
+            "sha256": hashlib.sha256(body).hexdigest(),
+        }
+    ).encode("utf-8")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".snapshot-", delete=False) as file:
+        try:
+            file.write(PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, len(header)))
+            file.write(header)
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+        except BaseException:
+            os.unlink(file.name)
+            raise
+    os.replace(file.name, path)
+    return PREAMBLE.size + len(header) + len(body)
+
+
+def read_snapshot(path: str) -> CachedCharacters:
+    """Read the characters of the snapshot at `path`, raising ValueError if it is not a valid snapshot."""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < PREAMBLE.size:
+            raise ValueError(f"{path} is too short to be a snapshot")
+        # Only the checksum and the decoded columns go through the process memory
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            return _read_snapshot(view)
+
+
+def _read_snapshot(view: memoryview) -> CachedCharacters:
+    magic, format_version, header_length = PREAMBLE.unpack_from(view)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not a characters snapshot")
+    if format_version != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version {format_version}")
+
+    header_end = PREAMBLE.size + header_length
+    header = json.loads(bytes(view[PREAMBLE.size : header_end]))
+    codec, compression = header["codec"], header["compression"]
+    if codec not in CODECS or compression not in COMPRESSIONS:
+        raise ValueError(f"Snapshot encoded with {codec} and {compression} compression, which are not installed")
+
+    # Slices of the memory map are released explicitly, it cannot be closed while they are alive
+    with view[header_end:] as body:
+        if hashlib.sha256(body).hexdigest() != header["sha256"]:
+            raise ValueError("Snapshot checksum mismatch, the snapshot is corrupted")
+
+        columns = {}
+        for name, (offset, length) in header["columns"].items():
+            with body[offset : offset + length] as column:
+                columns[name] = CODECS[codec].loads(COMPRESSIONS[compression].loads(column))
+    if any(len(values) != header["count"] for values in columns.values()):
+        raise ValueError("Snapshot columns do not have one value per character")
+    characters = [dict(zip(columns, values, strict=True)) for values in zip(*columns.values(), strict=True)]
+    return CachedCharacters(characters=characters, updated_at=header["updated_at"], version=header["version"])
+
+
+async def export_snapshot(path: str) -> int | None:
+    """Write the cached characters to a snapshot at `path`, returning its size, None if no characters are cached."""
+    cached = await get_cached_characters()
+    if cached is None:
+        return None
+    return await asyncio.to_thread(write_snapshot, path, cached)
+
+
+if __name__ == "__main__":
+    from characters import bootstrap_characters
+
+    parser = argparse.ArgumentParser(description="Export the cached characters to a snapshot, or cache a snapshot.")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", nargs="?", default=SNAPSHOT_PATH, help="snapshot file, defaults to SNAPSHOT_PATH")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("no snapshot path given and SNAPSHOT_PATH is not set")
+
+    if args.command == "export":
+        size = asyncio.run(export_snapshot(args.path))
+        print("No characters are cached, nothing exported" if size is None else f"Exported {size} bytes")
+    else:
+        cached = asyncio.run(bootstrap_characters(args.path, force=True))
+        print(f"Cached {len(cached.characters)} characters" if cached else "The characters were not cached")
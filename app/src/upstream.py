@@ -0,0 +1,75 @@
+import importlib.util
+import logging
+import os
+
+import httpx
+from circuit_breaker import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+# Upstream HTTP client configuration
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", 30))  # seconds
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 20))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", 10))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 30))  # seconds
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+# The circuit breaker opens when UPSTREAM_BREAKER_FAILURE_RATE of at least UPSTREAM_BREAKER_MINIMUM_CALLS requests
+# made in the last UPSTREAM_BREAKER_WINDOW failed, rejects every request for UPSTREAM_BREAKER_OPEN_TIMEOUT,
+# then closes again once UPSTREAM_BREAKER_HALF_OPEN_CALLS trial requests succeed
+UPSTREAM_BREAKER_FAILURE_RATE = float(os.getenv("UPSTREAM_BREAKER_FAILURE_RATE", 0.5))
+UPSTREAM_BREAKER_MINIMUM_CALLS = int(os.getenv("UPSTREAM_BREAKER_MINIMUM_CALLS", 10))
+UPSTREAM_BREAKER_WINDOW = float(os.getenv("UPSTREAM_BREAKER_WINDOW", 30))  # seconds
+UPSTREAM_BREAKER_OPEN_TIMEOUT = float(os.getenv("UPSTREAM_BREAKER_OPEN_TIMEOUT", 30))  # seconds
+UPSTREAM_BREAKER_HALF_OPEN_CALLS = int(os.getenv("UPSTREAM_BREAKER_HALF_OPEN_CALLS", 1))
+
+upstream_breaker = CircuitBreaker(
+    "rickandmorty",
+    failure_rate=UPSTREAM_BREAKER_FAILURE_RATE,
+    minimum_calls=UPSTREAM_BREAKER_MINIMUM_CALLS,
+    window=UPSTREAM_BREAKER_WINDOW,
+    open_timeout=UPSTREAM_BREAKER_OPEN_TIMEOUT,
+    half_open_calls=UPSTREAM_BREAKER_HALF_OPEN_CALLS,
+)
+
+_http_client: httpx.AsyncClient | None = None
+
+
+def create_http_client(**kwargs) -> httpx.AsyncClient:
+    """Create a pooled client for the upstream API, keeping connections alive between requests."""
+    http2 = UPSTREAM_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("UPSTREAM_HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1")
+        http2 = False
+
+    return httpx.AsyncClient(
+        timeout=UPSTREAM_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        http2=http2,
+        **kwargs,
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared upstream client, creating it on first use outside the application lifespan."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = create_http_client()
+    return _http_client
+
+
+def set_http_client(client: httpx.AsyncClient | None) -> None:
+    """Replace the shared upstream client, e.g. with one using a mock transport in tests."""
+    global _http_client
+    _http_client = client
+
+
+async def close_http_client() -> None:
+    """Close the shared upstream client and its pooled connections."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
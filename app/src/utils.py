@@ -1,4 +1,9 @@
+import glob
+import os
+import re
 import time
+from collections import OrderedDict
+from typing import NamedTuple
 
 from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
@@ -7,16 +12,23 @@ from opentelemetry.instrumentation.logging import LoggingInstrumentor
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
 from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST, generate_latest
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
 from starlette.requests import Request
 from starlette.responses import Response
 from starlette.routing import Match
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-INFO = Gauge("fastapi_app_info", "FastAPI application information.", ["app_name"])
+# Number of (method, path) pairs whose route template is kept by the Prometheus middleware
+ROUTE_CACHE_MAX_ENTRIES = int(os.getenv("ROUTE_CACHE_MAX_ENTRIES", 1024))
+# Directory where the worker processes write their metrics for /metrics to aggregate, unset for a single process.
+# prometheus_client reads it when imported, so it must be set in the environment before the app starts.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Files of the live gauges of a process, removed once the process is dead
+LIVE_GAUGE_FILE = re.compile(r"gauge_live\w+?_(\d+)\.db")
+
+INFO = Gauge("fastapi_app_info", "FastAPI application information.", ["app_name"], multiprocess_mode="livemax")
 REQUESTS = Counter(
     "fastapi_requests_total", "Total count of requests by method and path.", ["method", "path", "app_name"]
 )
@@ -39,66 +51,281 @@ REQUESTS_IN_PROGRESS = Gauge(
     "fastapi_requests_in_progress",
     "Gauge of requests by method and path currently being processed",
     ["method", "path", "app_name"],
+    multiprocess_mode="livesum",
 )
 CACHE_HITS = Counter("cache_hits_total", "Total number of cache hits", ["app_name"])
 CACHE_MISSES = Counter("cache_misses_total", "Total number of cache misses", ["app_name"])
+CACHE_LAYER_HITS = Counter(
+    "cache_layer_hits_total",
+    "Total number of cached characters reads by serving cache layer",
+    ["app_name", "layer"],
+)
 CHARACTERS_PROCESSED = Counter("characters_processed_total", "Total number of characters processed", ["app_name"])
+CACHE_STALE_SERVES = Counter(
+    "cache_stale_serves_total", "Total number of cache hits served stale while being refreshed", ["app_name"]
+)
+REFRESH_DURATION = Histogram(
+    "characters_refresh_duration_seconds",
+    "Histogram of the time taken to crawl and save the characters (in seconds)",
+    ["app_name"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+REFRESH_LAST_SUCCESS = Gauge(
+    "characters_refresh_last_success_timestamp_seconds",
+    "Unix time of the last successful background refresh of the characters",
+    ["app_name"],
+    multiprocess_mode="max",
+)
+REFRESH_INTERVAL_SECONDS = Gauge(
+    "characters_refresh_interval_seconds",
+    "Seconds between two background refreshes of the characters",
+    ["app_name"],
+    multiprocess_mode="livemax",
+)
+REFRESH_FAILURES = Counter(
+    "characters_refresh_failures_total", "Total number of failed background refreshes of the characters", ["app_name"]
+)
+RESPONSE_CACHE_HITS = Counter(
+    "response_cache_hits_total", "Total number of responses served pre-rendered from the response cache", ["app_name"]
+)
+RESPONSE_CACHE_MISSES = Counter(
+    "response_cache_misses_total", "Total number of responses rendered on a response cache miss", ["app_name"]
+)
+RESPONSE_CACHE_BYTES = Gauge(
+    "response_cache_bytes",
+    "Size of the pre-rendered responses held by the response cache",
+    ["app_name"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_CHECKOUT_TIME = Histogram(
+    "db_pool_checkout_duration_seconds",
+    "Histogram of the time taken to check out a database connection from the pool (in seconds)",
+    ["app_name"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DB_POOL_CHECKOUT_TIMEOUTS = Counter(
+    "db_pool_checkout_timeouts_total",
+    "Total number of database connection checkouts that timed out waiting for the pool",
+    ["app_name"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out_connections",
+    "Number of database connections currently checked out",
+    ["app_name"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow_connections",
+    "Number of database connections open beyond the pool size",
+    ["app_name"],
+    multiprocess_mode="livesum",
+)
+CIRCUIT_BREAKER_STATE = Gauge(
+    "circuit_breaker_state",
+    "State of the circuit breaker of a dependency: 0 closed, 1 half-open, 2 open",
+    ["app_name", "breaker"],
+    multiprocess_mode="livemax",
+)
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "circuit_breaker_transitions_total",
+    "Total number of transitions of the circuit breaker of a dependency by state entered",
+    ["app_name", "breaker", "state"],
+)
+CIRCUIT_BREAKER_REJECTIONS = Counter(
+    "circuit_breaker_rejections_total",
+    "Total number of calls to a dependency rejected by its open circuit breaker",
+    ["app_name", "breaker"],
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "upstream_concurrency_limit",
+    "Adaptive limit of the requests to the upstream API in flight across every replica",
+    ["app_name"],
+    multiprocess_mode="mostrecent",
+)
+UPSTREAM_GOVERNOR_WAIT = Histogram(
+    "upstream_governor_wait_seconds",
+    "Histogram of the time requests to the upstream API waited for the rate governor by reason (in seconds)",
+    ["app_name", "reason"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+UPSTREAM_PAUSES = Counter(
+    "upstream_pauses_total",
+    "Total number of times every replica was paused by a 429 response of the upstream API",
+    ["app_name"],
+)
+NEGATIVE_CACHE_HITS = Counter(
+    "negative_cache_hits_total",
+    "Total number of cache misses not crawling the upstream API because its last crawl failed recently",
+    ["app_name"],
+)
+UPSTREAM_PAGES = Counter(
+    "upstream_pages_total",
+    "Total number of upstream pages crawled by result: modified, not_modified or failed",
+    ["app_name", "result"],
+)
+UPSTREAM_RESPONSE_BYTES = Counter(
+    "upstream_response_bytes_total", "Total number of bytes of the upstream responses bodies", ["app_name"]
+)
 
 
-class PrometheusMiddleware(BaseHTTPMiddleware):
+class RequestMetrics(NamedTuple):
+    """Label children of the metrics recorded for every request to one route and method."""
+
+    requests: Counter
+    in_progress: Gauge
+    processing_time: Histogram
+
+
+class PrometheusMiddleware:
+    """
+    Pure ASGI middleware recording the requests, responses, exceptions and processing time of every route.
+
+    The route template of a path and the label children of a route are resolved once and reused, and responses are
+    passed through as they are sent, so streaming responses are timed until their last chunk.
+    """
+
     def __init__(self, app: ASGIApp, app_name: str = "fastapi-app") -> None:
-        super().__init__(app)
+        self.app = app
         self.app_name = app_name
         INFO.labels(app_name=self.app_name).inc()
+        # (method, path) -> route template, None for paths no route handles
+        self.route_templates: OrderedDict[tuple[str, str], str | None] = OrderedDict()
+        self.request_metrics: dict[tuple[str, str], RequestMetrics] = {}
+        self.status_metrics: dict[tuple[str, str, int], tuple[Counter, Counter | None]] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        method = request.method
-        path, is_handled_path = self.get_path(request)
+        method = scope["method"]
+        path = self.get_path(scope)
+        if path is None:
+            await self.app(scope, receive, send)
+            return
 
-        if not is_handled_path:
-            return await call_next(request)
+        request_metrics = self.get_request_metrics(method, path)
+        request_metrics.in_progress.inc()
+        request_metrics.requests.inc()
+        status_code = HTTP_500_INTERNAL_SERVER_ERROR
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
 
-        REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).inc()
-        REQUESTS.labels(method=method, path=path, app_name=self.app_name).inc()
         before_time = time.perf_counter()
         try:
-            response = await call_next(request)
-        except BaseException as e:
+            await self.app(scope, receive, send_with_status)
+        except BaseException:
             status_code = HTTP_500_INTERNAL_SERVER_ERROR
-            EXCEPTIONS.labels(method=method, path=path, status_code=str(status_code), app_name=self.app_name).inc()
-            raise e from None
+            raise
         else:
-            status_code = response.status_code
             after_time = time.perf_counter()
             # retrieve trace id for exemplar
             span = trace.get_current_span()
             trace_id = trace.format_trace_id(span.get_span_context().trace_id)
 
-            REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=self.app_name).observe(
-                after_time - before_time, exemplar={"TraceID": trace_id}
-            )
+            request_metrics.processing_time.observe(after_time - before_time, exemplar={"TraceID": trace_id})
         finally:
-            RESPONSES.labels(method=method, path=path, status_code=status_code, app_name=self.app_name).inc()
-
-            if 400 <= status_code < 600:  # Track only error responses
-                EXCEPTIONS.labels(method=method, path=path, status_code=str(status_code), app_name=self.app_name).inc()
+            responses, exceptions = self.get_status_metrics(method, path, status_code)
+            responses.inc()
+            if exceptions is not None:  # Track only error responses
+                exceptions.inc()
 
-            REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).dec()
+            request_metrics.in_progress.dec()
 
-        return response
+    def get_path(self, scope: Scope) -> str | None:
+        """Return the template of the route handling the request, None if no route handles it."""
+        key = (scope["method"], scope["path"])
+        try:
+            self.route_templates.move_to_end(key)
+            return self.route_templates[key]
+        except KeyError:
+            pass
 
-    @staticmethod
-    def get_path(request: Request) -> tuple[str, bool]:
-        for route in request.app.routes:
-            match, child_scope = route.matches(request.scope)
+        template = None
+        for route in scope["app"].routes:
+            match, _ = route.matches(scope)
             if match == Match.FULL:
-                return route.path, True
+                template = route.path
+                break
+
+        self.route_templates[key] = template
+        # Paths no route handles are unbounded, keep the most recently requested ones
+        if len(self.route_templates) > ROUTE_CACHE_MAX_ENTRIES:
+            self.route_templates.popitem(last=False)
+        return template
 
-        return request.url.path, False
+    def get_request_metrics(self, method: str, path: str) -> RequestMetrics:
+        request_metrics = self.request_metrics.get((method, path))
+        if request_metrics is None:
+            labels = {"method": method, "path": path, "app_name": self.app_name}
+            request_metrics = RequestMetrics(
+                requests=REQUESTS.labels(**labels),
+                in_progress=REQUESTS_IN_PROGRESS.labels(**labels),
+                processing_time=REQUESTS_PROCESSING_TIME.labels(**labels),
+            )
+            self.request_metrics[(method, path)] = request_metrics
+        return request_metrics
+
+    def get_status_metrics(self, method: str, path: str, status_code: int) -> tuple[Counter, Counter | None]:
+        status_metrics = self.status_metrics.get((method, path, status_code))
+        if status_metrics is None:
+            labels = {"method": method, "path": path, "status_code": str(status_code), "app_name": self.app_name}
+            exceptions = EXCEPTIONS.labels(**labels) if 400 <= status_code < 600 else None
+            status_metrics = (RESPONSES.labels(**labels), exceptions)
+            self.status_metrics[(method, path, status_code)] = status_metrics
+        return status_metrics
 
 
 def metrics(request: Request) -> Response:
-    return Response(generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Aggregate the metrics written by every worker process, not only the one answering the scrape
+        remove_dead_process_metrics()
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=PROMETHEUS_MULTIPROC_DIR)
+    return Response(generate_latest(registry), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+def clear_multiprocess_metrics() -> None:
+    """
+    Remove the metrics left by the worker processes of a previous run, before the workers start.
+
+    Metrics this process set before are removed too, and the values it sets after are written to removed files.
+    """
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, "*.db")):
+        os.remove(path)
+
+
+def mark_process_dead(pid: int) -> None:
+    """Stop reporting the live gauges of a worker process that exited, its counters and histograms are kept."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, PROMETHEUS_MULTIPROC_DIR)
+
+
+def remove_dead_process_metrics() -> None:
+    """Stop reporting the live gauges of the worker processes that died without marking themselves dead."""
+    for path in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+        match = LIVE_GAUGE_FILE.fullmatch(path)
+        if match and not is_process_alive(int(match.group(1))):
+            mark_process_dead(int(match.group(1)))
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
 
 
 def setting_otlp(app: ASGIApp, app_name: str, endpoint: str, log_correlation: bool = True) -> None:
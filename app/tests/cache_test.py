@@ -1,36 +1,280 @@
+import asyncio
+import json
+import time
 from unittest.mock import patch
 
-from app.src.cache import API_RATE_LIMIT, API_RATE_WINDOW, is_rate_limited
+import pytest
+from cache import (
+    API_RATE_LIMIT,
+    API_RATE_WINDOW,
+    CACHE_SOFT_TTL,
+    CODECS,
+    COMPRESSIONS,
+    INVALIDATION_CHANNEL,
+    CachedCharacters,
+    acquire_lock,
+    decode_payload,
+    encode_payload,
+    fenced_mset,
+    get_cached_characters,
+    is_locked,
+    l1_get,
+    l1_set,
+    rate_limit,
+    release_lock,
+    set_cached_characters,
+    start_invalidation_listener,
+    stop_invalidation_listener,
+)
 
 
-@patch("app.src.cache.redis_client")
-def test_is_rate_limited_no_existing_key(mock_redis_client):
-    """Test when no key exists in Redis."""
-    mock_redis_client.get.return_value = None
+@pytest.mark.anyio
+async def test_rate_limit_admits_up_to_limit(fake_redis):
+    """Test that requests are admitted up to the limit, then told how long to wait."""
+    assert all([await rate_limit("ip:1") == 0 for _ in range(API_RATE_LIMIT)])
 
-    result = is_rate_limited()
+    wait = await rate_limit("ip:1")
 
-    mock_redis_client.setex.assert_called_once_with("api_request_count", API_RATE_WINDOW, 1)
-    assert result is False
+    assert 0 < wait <= API_RATE_WINDOW
+    # Other clients have limits of their own
+    assert await rate_limit("ip:2") == 0
 
 
-@patch("app.src.cache.redis_client")
-def test_is_rate_limited_below_limit(mock_redis_client):
-    """Test when the request count is below the rate limit."""
-    mock_redis_client.get.return_value = b"3"
+@pytest.mark.anyio
+async def test_rate_limit_sliding_window(fake_redis):
+    """Test that requests are admitted again once earlier requests leave the window."""
+    with patch("cache.API_RATE_LIMIT", 2), patch("cache.API_RATE_WINDOW", 0.05):
+        assert [await rate_limit("ip:1") == 0 for _ in range(3)] == [True, True, False]
+        await asyncio.sleep(0.06)
+        assert await rate_limit("ip:1") == 0
 
-    result = is_rate_limited()
 
-    mock_redis_client.incr.assert_called_once_with("api_request_count")
-    assert result is False
+@pytest.mark.anyio
+async def test_rate_limit_token_bucket_burst(fake_redis):
+    """Test that the token bucket admits a burst, then requests at the refill rate."""
+    with (
+        patch("cache.API_RATE_ALGORITHM", "token_bucket"),
+        patch("cache.API_RATE_LIMIT", 1),
+        patch("cache.API_RATE_WINDOW", 0.05),
+        patch("cache.API_RATE_BURST", 3),
+    ):
+        assert [await rate_limit("ip:1") == 0 for _ in range(4)] == [True, True, True, False]
+        await asyncio.sleep(0.06)
+        assert [await rate_limit("ip:1") == 0 for _ in range(2)] == [True, False]
 
 
-@patch("app.src.cache.redis_client")
-def test_is_rate_limited_at_limit(mock_redis_client):
-    """Test when the request count is at the rate limit."""
-    mock_redis_client.get.return_value = str(API_RATE_LIMIT).encode()
+@pytest.mark.parametrize("algorithm", ["sliding_window", "token_bucket"])
+@pytest.mark.anyio
+async def test_rate_limit_is_exact_under_concurrency(fake_redis, algorithm):
+    """Test that concurrent requests never admit more than the limit."""
+    with (
+        patch("cache.API_RATE_ALGORITHM", algorithm),
+        patch("cache.API_RATE_LIMIT", 10),
+        patch("cache.API_RATE_BURST", 10),
+    ):
+        waits = await asyncio.gather(*(rate_limit("ip:1") for _ in range(100)))
 
-    result = is_rate_limited()
+    assert waits.count(0) == 10
 
-    assert result is True
-    mock_redis_client.incr.assert_not_called()
+
+@pytest.mark.anyio
+async def test_acquire_lock_is_exclusive(fake_redis):
+    """Test that a held lock cannot be taken again and tokens keep growing."""
+    token = await acquire_lock("lock", timeout=10)
+
+    assert token is not None
+    assert await is_locked("lock")
+    assert await acquire_lock("lock", timeout=10) is None
+
+    await release_lock("lock", token)
+
+    assert not await is_locked("lock")
+    assert await acquire_lock("lock", timeout=10) > token
+
+
+@pytest.mark.anyio
+async def test_release_lock_with_stale_token(fake_redis):
+    """Test that a lock is not released by a holder whose lease was taken over."""
+    stale_token = await acquire_lock("lock", timeout=10)
+    await fake_redis.delete("lock")  # Simulate lease expiry
+    token = await acquire_lock("lock", timeout=10)
+
+    assert await release_lock("lock", stale_token) is False
+    assert await is_locked("lock")
+    assert await release_lock("lock", token) is True
+
+
+@pytest.mark.anyio
+async def test_fenced_mset_rejects_stale_token(fake_redis):
+    """Test that a holder whose lease was taken over cannot overwrite newer data, even once the lock is released."""
+    stale_token = await acquire_lock("lock", timeout=10)
+    await fake_redis.delete("lock")  # Simulate lease expiry
+    token = await acquire_lock("lock", timeout=10)
+
+    assert await fenced_mset("lock", token, {"key": "new", "meta": "new"}, ex=10) is True
+    assert await fenced_mset("lock", stale_token, {"key": "stale", "meta": "stale"}, ex=10) is False
+    await release_lock("lock", token)
+    assert await fenced_mset("lock", stale_token, {"key": "stale", "meta": "stale"}, ex=10) is False
+    assert await fake_redis.mget("key", "meta") == [b"new", b"new"]
+
+
+@pytest.mark.anyio
+async def test_set_cached_characters_rejects_stale_token(fake_redis):
+    """Test that characters cached by a refresh whose lease was taken over are not cached."""
+    stale_token = await acquire_lock("lock", timeout=10)
+    await fake_redis.delete("lock")  # Simulate lease expiry
+    token = await acquire_lock("lock", timeout=10)
+
+    assert await set_cached_characters("lock", token, [{"id": 1, "name": "Rick Sanchez"}]) is True
+    assert await set_cached_characters("lock", stale_token, [{"id": 2, "name": "Morty Smith"}]) is False
+    assert (await get_cached_characters()).characters == [{"id": 1, "name": "Rick Sanchez"}]
+
+
+@pytest.mark.anyio
+async def test_cached_characters_round_trip(fake_redis):
+    """Test that cached characters are read back fresh with their timestamp."""
+    characters = [{"id": 1, "name": "Rick Sanchez"}]
+    token = await acquire_lock("lock", timeout=10)
+
+    assert await set_cached_characters("lock", token, characters) is True
+
+    cached = await get_cached_characters()
+    assert cached.characters == characters
+    assert cached.age < 1
+    assert not cached.is_stale
+    assert not cached.is_expired
+
+
+@pytest.mark.anyio
+async def test_get_cached_characters_legacy_entry_is_stale(fake_redis):
+    """Test that entries cached without a timestamp are served as stale."""
+    await fake_redis.set("characters", json.dumps([{"id": 1, "name": "Rick Sanchez"}]))
+
+    cached = await get_cached_characters()
+
+    assert cached.characters == [{"id": 1, "name": "Rick Sanchez"}]
+    assert cached.is_stale
+    assert not cached.is_expired
+    assert time.time() - cached.updated_at >= CACHE_SOFT_TTL
+
+
+@pytest.mark.anyio
+async def test_get_cached_characters_reuses_unchanged_version(fake_redis):
+    """Test that characters are only read again, and sorted again, once their version changes."""
+    token = await acquire_lock("lock", timeout=10)
+    await set_cached_characters("lock", token, [{"id": 2, "name": "Morty Smith"}, {"id": 1, "name": "Rick Sanchez"}])
+    first = await get_cached_characters()
+    sorted_characters = first.sorted_by("id")
+
+    # Refreshing unchanged characters keeps their version
+    await set_cached_characters("lock", token, [{"id": 2, "name": "Morty Smith"}, {"id": 1, "name": "Rick Sanchez"}])
+    with patch.object(fake_redis, "get", wraps=fake_redis.get) as mock_get:
+        second = await get_cached_characters()
+    assert [c.args for c in mock_get.call_args_list] == [("characters:meta",)]
+    assert second.version == first.version
+    assert second.updated_at >= first.updated_at
+    assert second.sorted_by("id") is sorted_characters
+
+    await set_cached_characters("lock", token, [{"id": 3, "name": "Summer Smith"}])
+    third = await get_cached_characters()
+    assert third.version != first.version
+    assert third.sorted_by("id") == [{"id": 3, "name": "Summer Smith"}]
+
+
+def test_cached_characters_sorted_by():
+    """Test that characters are sorted with ties broken by id, descending orders reversing ascending ones."""
+    names = {1: "Morty Smith", 2: "Beth Smith", 3: "Rick Sanchez", 4: "Beth Smith"}
+    cached = CachedCharacters.from_characters([{"id": id_, "name": name} for id_, name in names.items()])
+
+    assert [character["id"] for character in cached.sorted_by("name")] == [2, 4, 1, 3]
+    assert [character["id"] for character in cached.sorted_by("name", descending=True)] == [3, 1, 4, 2]
+    assert [character["id"] for character in cached.sorted_by("id", descending=True)] == [4, 3, 2, 1]
+    assert cached.keys("name") == [("Beth Smith", 2), ("Beth Smith", 4), ("Morty Smith", 1), ("Rick Sanchez", 3)]
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+@pytest.mark.parametrize("compression", sorted(COMPRESSIONS))
+def test_payload_codecs_round_trip(codec, compression):
+    """Test that payloads decode to what was encoded with every installed codec and compression."""
+    payload = {"updated_at": 1.5, "version": "v1", "characters": [{"id": 1, "name": "Rick Sanchez", "episode": []}]}
+
+    encoded = encode_payload(payload, codec=codec, compression=compression)
+
+    assert encoded.startswith(b"\x00" + f"1:{codec}:{compression}\n".encode())
+    assert decode_payload(encoded) == payload
+
+
+def test_decode_payload_plain_json():
+    """Test that payloads cached as plain JSON are still decoded."""
+    assert decode_payload(json.dumps({"characters": []}).encode("utf-8")) == {"characters": []}
+
+
+@pytest.mark.parametrize("compression", sorted(set(COMPRESSIONS) - {"none"}))
+def test_decode_payload_corrupted(compression):
+    """Test that payloads whose compressed body is truncated cannot be decoded."""
+    encoded = encode_payload({"characters": [{"id": 1, "name": "Rick Sanchez"}]}, compression=compression)
+
+    with pytest.raises(ValueError, match="cannot be decompressed"):
+        decode_payload(encoded[: len(encoded) // 2 + 8])
+
+
+@pytest.mark.anyio
+async def test_get_cached_characters_corrupted(fake_redis):
+    """Test that characters whose payload is truncated are treated as a miss."""
+    await fake_redis.set("characters", encode_payload([{"id": 1}], compression="zlib")[:-4])
+
+    assert await get_cached_characters() is None
+
+
+@pytest.mark.anyio
+async def test_get_cached_characters_unknown_codec(fake_redis):
+    """Test that characters encoded with a codec that is not installed are treated as a miss."""
+    await fake_redis.set("characters", b"\x001:unknown:none\n[]")
+
+    assert await get_cached_characters() is None
+
+
+@pytest.mark.anyio
+async def test_get_cached_characters_from_l1(fake_redis):
+    """Test that characters read once are served from the L1 cache without reading Redis."""
+    token = await acquire_lock("lock", timeout=10)
+    await set_cached_characters("lock", token, [{"id": 1, "name": "Rick Sanchez"}])
+    first = await get_cached_characters()
+
+    with patch.object(fake_redis, "get", wraps=fake_redis.get) as mock_get:
+        assert await get_cached_characters() is first
+    mock_get.assert_not_called()
+
+
+def test_l1_ttl_and_size_bound():
+    """Test that L1 entries expire after L1_CACHE_TTL and the least recently used are evicted."""
+    with patch("cache.L1_CACHE_MAX_ENTRIES", 2):
+        l1_set("a", 1)
+        l1_set("b", 2)
+        l1_get("a")
+        l1_set("c", 3)
+    assert (l1_get("a"), l1_get("b"), l1_get("c")) == (1, None, 3)
+
+    with patch("cache.L1_CACHE_TTL", 0.01):
+        l1_set("a", 1)
+    time.sleep(0.02)
+    assert l1_get("a") is None
+
+
+@pytest.mark.anyio
+async def test_l1_invalidated_by_other_processes(fake_redis):
+    """Test that a key published on the invalidation channel is dropped from the L1 cache."""
+    start_invalidation_listener()
+    # Let the listener subscribe before publishing
+    await asyncio.sleep(0.05)
+    try:
+        l1_set("characters", "cached")
+        # Written by another process
+        await fake_redis.publish(INVALIDATION_CHANNEL, "characters")
+
+        deadline = time.monotonic() + 2
+        while l1_get("characters") is not None and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        assert l1_get("characters") is None
+    finally:
+        await stop_invalidation_listener()
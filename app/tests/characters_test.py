@@ -1,30 +1,56 @@
+import asyncio
 import json
-from unittest.mock import MagicMock, patch
+import time
+from hashlib import sha1
+from unittest.mock import AsyncMock, MagicMock, call, patch
 
+import characters
+import governor
+import httpx
 import pytest
-from characters import get_all_characters  # Replace with actual module name
+from cache import CACHE_HARD_TTL, CACHE_SOFT_TTL, characters_version, decode_payload, l1_invalidate
+from characters import Crawl, crawl_characters, crawl_pages, fetch_characters, get_all_characters
+from circuit_breaker import CircuitBreaker, State
+from database import Dataset
+from exceptions import CircuitOpenException, ServiceUnavailableException, UpstreamThrottledException
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from page_cache import CachedPage
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from upstream import set_http_client
 
 
 @pytest.fixture
 def db_session():
-    """Fixture to create a mock database session."""
-    return MagicMock(spec=Session)
+    """Fixture to create a mock database session, with no characters saved."""
+    session = MagicMock(spec=AsyncSession)
+    session.get = AsyncMock(return_value=None)
+    return session
 
 
 @pytest.fixture
 def mock_redis():
     """Mock Redis client."""
-    with patch("characters.redis_client") as mock_redis:
+    with patch("cache.redis_client", new_callable=AsyncMock) as mock_redis:
+        l1_invalidate()
         yield mock_redis
+        l1_invalidate()
 
 
 @pytest.fixture
-def mock_fetch_characters():
-    """Mock API fetch function."""
-    with patch("characters.fetch_characters") as mock_fetch:
-        yield mock_fetch
+def mock_request_page():
+    """Mock upstream page requests."""
+    with patch("characters.request_page") as mock_request:
+        yield mock_request
+
+
+def page_response(data: dict, **headers) -> httpx.Response:
+    return httpx.Response(200, json=data, headers=headers)
+
+
+def crawled(characters: list[dict]) -> Crawl:
+    """A crawl of a single page of `characters`, not cached before."""
+    return Crawl(cached=[None], pages=[CachedPage(pages=1, characters=characters, digest="")])
 
 
 @pytest.fixture
@@ -34,20 +60,24 @@ def mock_save_characters_to_db():
         yield mock_save
 
 
-def test_get_characters_from_cache(mock_redis, db_session):
+@pytest.mark.anyio
+async def test_get_characters_from_cache(mock_redis, db_session):
     """Test when characters are already in the Redis cache."""
     cached_data = [{"id": 1, "name": "Rick Sanchez", "origin": {"name": "Earth"}}]
-    mock_redis.get.return_value = json.dumps(cached_data).encode("utf-8")
+    cached = json.dumps({"updated_at": time.time(), "characters": cached_data}).encode("utf-8")
+    mock_redis.get.side_effect = lambda key: cached if key == "characters" else None
 
-    result = get_all_characters(db_session)
+    with patch("characters.refresh_in_background") as mock_refresh_in_background:
+        result = await get_all_characters(db_session)
 
-    assert result == cached_data
-    mock_redis.get.assert_called_once_with("characters")
+    assert result.characters == cached_data
+    assert mock_redis.get.call_args_list == [call("characters:meta"), call("characters")]
+    mock_refresh_in_background.assert_not_called()
 
 
-def test_get_characters_from_api(mock_redis, mock_fetch_characters, mock_save_characters_to_db, db_session):
+@pytest.mark.anyio
+async def test_get_characters_from_api(fake_redis, mock_request_page, mock_save_characters_to_db, db_session):
     """Test when characters are fetched from the API and stored in the cache."""
-    mock_redis.get.return_value = None  # Simulate cache miss
     api_response = {
         "info": {"pages": 1},
         "results": [
@@ -55,24 +85,512 @@ def test_get_characters_from_api(mock_redis, mock_fetch_characters, mock_save_ch
             {"id": 2, "name": "Morty Smith", "origin": {"name": "Earth"}},
         ],
     }
-    mock_fetch_characters.return_value = api_response
+    mock_request_page.return_value = page_response(api_response)
 
-    result = get_all_characters(db_session)
+    result = await get_all_characters(db_session)
 
-    assert len(result) == 2
-    assert result[0]["name"] == "Rick Sanchez"
-    mock_fetch_characters.assert_called_once_with(
-        "https://rickandmortyapi.com/api/character?species=Human&status=Alive&page=", 1
+    assert len(result.characters) == 2
+    assert result.characters[0]["name"] == "Rick Sanchez"
+    mock_request_page.assert_called_once_with(
+        "https://rickandmortyapi.com/api/character?species=Human&status=Alive&page=", 1, {}
     )
     mock_save_characters_to_db.assert_called_once()
+    assert decode_payload(await fake_redis.get("characters"))["characters"] == result.characters
+    assert not await fake_redis.exists("characters:refresh_lock")
 
 
-def test_get_characters_api_failure(mock_redis, mock_fetch_characters, db_session):
+@pytest.mark.anyio
+async def test_get_characters_api_failure(fake_redis, mock_request_page, db_session):
     """Test API failure scenario."""
-    mock_redis.get.return_value = None  # Simulate cache miss
-    mock_fetch_characters.side_effect = HTTPException(status_code=500)
+    mock_request_page.side_effect = HTTPException(status_code=500)
 
     with pytest.raises(HTTPException) as exc_info:
-        get_all_characters(db_session)
+        await get_all_characters(db_session)
 
     assert exc_info.value.status_code == 500
+    assert not await fake_redis.exists("characters:refresh_lock")
+
+
+@pytest.mark.anyio
+async def test_get_characters_stale_served_while_refreshing(fake_redis, mock_save_characters_to_db, db_session):
+    """Test that stale characters are served immediately while one background refresh runs."""
+    stale_data = [{"id": 1, "name": "Rick Sanchez", "origin": {"name": "Earth"}}]
+    fresh_data = [{"id": 2, "name": "Morty Smith", "origin": {"name": "Earth"}}]
+    await fake_redis.set(
+        "characters", json.dumps({"updated_at": time.time() - CACHE_SOFT_TTL, "characters": stale_data})
+    )
+
+    async def crawl(url):
+        await asyncio.sleep(0.01)
+        return crawled(fresh_data)
+
+    with (
+        patch("characters.crawl_pages", side_effect=crawl) as mock_crawl,
+        patch("characters.SessionLocal", return_value=db_session),
+    ):
+        results = await asyncio.gather(*(get_all_characters(db_session) for _ in range(5)))
+        # Let the background refresh finish
+        await characters._background_refresh
+
+    assert all(result.characters == stale_data for result in results)
+    assert mock_crawl.call_count == 1
+    assert decode_payload(await fake_redis.get("characters"))["characters"] == fresh_data
+
+
+@pytest.mark.anyio
+async def test_get_characters_expired_not_served(fake_redis, mock_request_page, mock_save_characters_to_db, db_session):
+    """Test that characters older than the hard TTL are refreshed before responding."""
+    expired_data = [{"id": 1, "name": "Rick Sanchez", "origin": {"name": "Earth"}}]
+    await fake_redis.set(
+        "characters", json.dumps({"updated_at": time.time() - CACHE_HARD_TTL, "characters": expired_data})
+    )
+    mock_request_page.return_value = page_response(
+        {"info": {"pages": 1}, "results": [{"id": 2, "name": "Morty Smith", "origin": {"name": "Earth"}}]}
+    )
+
+    result = await get_all_characters(db_session)
+
+    assert [character["id"] for character in result.characters] == [2]
+
+
+@pytest.mark.anyio
+async def test_get_characters_read_only_miss(fake_redis, mock_request_page, db_session):
+    """Test that a read-only cache miss does not crawl and reports the service unavailable."""
+    with pytest.raises(ServiceUnavailableException):
+        await get_all_characters(db_session, read_only=True)
+
+    mock_request_page.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_characters_restored_from_database(fake_redis, mock_request_page, db_session):
+    """Test that a cache miss is served from the characters saved to the database, without crawling."""
+    saved = [{"id": 1, "name": "Rick Sanchez", "origin": {"name": "Earth"}}]
+    updated_at = time.time() - CACHE_SOFT_TTL / 2
+    dataset = Dataset(name="characters", version="v1", updated_at=updated_at)
+    db_session.get.return_value = dataset
+
+    with patch("characters.load_characters", return_value=saved) as mock_load:
+        result = await get_all_characters(db_session)
+
+    mock_load.assert_awaited_once_with(db_session)
+    mock_request_page.assert_not_called()
+    assert (result.characters, result.updated_at, result.version) == (saved, updated_at, "v1")
+    cached = decode_payload(await fake_redis.get("characters"))
+    assert (cached["characters"], cached["updated_at"]) == (saved, updated_at)
+    assert not await fake_redis.exists("characters:refresh_lock")
+
+
+@pytest.mark.anyio
+async def test_get_characters_read_only_miss_read_from_database(fake_redis, mock_request_page, db_session):
+    """Test that a read-only cache miss reads the characters saved to the database without the refresh lock."""
+    saved = [{"id": 1, "name": "Rick Sanchez", "origin": {"name": "Earth"}}]
+    db_session.get.return_value = Dataset(name="characters", version="v1", updated_at=time.time())
+
+    with (
+        patch("characters.load_characters", return_value=saved),
+        patch("characters.acquire_lock") as mock_acquire_lock,
+    ):
+        result = await get_all_characters(db_session, read_only=True)
+
+    assert result.characters == saved
+    mock_acquire_lock.assert_not_called()
+    mock_request_page.assert_not_called()
+    # Caching is left to the background refresher
+    assert not await fake_redis.exists("characters")
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "dataset",
+    [None, Dataset(name="characters", version="v1", updated_at=time.time() - CACHE_HARD_TTL)],
+)
+async def test_get_characters_crawled_without_database_characters(
+    fake_redis, mock_request_page, mock_save_characters_to_db, db_session, dataset
+):
+    """Test that a cache miss crawls when no characters are saved to the database or they are expired."""
+    db_session.get.return_value = dataset
+    mock_request_page.return_value = page_response(
+        {"info": {"pages": 1}, "results": [{"id": 2, "name": "Morty Smith", "origin": {"name": "Earth"}}]}
+    )
+
+    with patch("characters.load_characters") as mock_load:
+        result = await get_all_characters(db_session)
+
+    mock_load.assert_not_called()
+    assert [character["id"] for character in result.characters] == [2]
+
+
+@pytest.mark.anyio
+async def test_get_characters_crawled_on_database_error(
+    fake_redis, mock_request_page, mock_save_characters_to_db, db_session
+):
+    """Test that a database error while restoring the characters falls back to crawling."""
+    db_session.get.side_effect = OperationalError("SELECT", {}, Exception("connection refused"))
+    mock_request_page.return_value = page_response(
+        {"info": {"pages": 1}, "results": [{"id": 2, "name": "Morty Smith", "origin": {"name": "Earth"}}]}
+    )
+
+    result = await get_all_characters(db_session)
+
+    db_session.rollback.assert_awaited_once()
+    assert [character["id"] for character in result.characters] == [2]
+
+
+@pytest.mark.anyio
+async def test_concurrent_cache_misses_crawl_once(fake_redis, mock_save_characters_to_db, db_session):
+    """Test that many concurrent cache misses trigger exactly one upstream crawl."""
+    characters = [{"id": 1, "name": "Rick Sanchez", "origin": {"name": "Earth"}}]
+
+    async def crawl(url):
+        await asyncio.sleep(0.05)
+        return crawled(characters)
+
+    with (
+        patch("characters.crawl_pages", side_effect=crawl) as mock_crawl,
+        patch("characters.REFRESH_POLL_INTERVAL", 0.01),
+    ):
+        results = await asyncio.gather(*(get_all_characters(db_session) for _ in range(20)))
+
+    assert mock_crawl.call_count == 1
+    mock_save_characters_to_db.assert_called_once()
+    assert all(result.characters == characters for result in results)
+
+
+@pytest.mark.anyio
+async def test_crawl_characters_keeps_page_order(fake_redis, mock_request_page):
+    """Test that pages fetched concurrently are returned in page order."""
+
+    async def fetch(url, page, headers):
+        # Later pages answer first
+        await asyncio.sleep(0.01 * (4 - page))
+        return page_response(
+            {"info": {"pages": 3}, "results": [{"id": page, "name": f"Page {page}", "origin": {"name": "Earth"}}]}
+        )
+
+    mock_request_page.side_effect = fetch
+
+    result = await crawl_characters("url", concurrency=3)
+
+    assert [character["id"] for character in result] == [1, 2, 3]
+
+
+@pytest.mark.anyio
+async def test_crawl_characters_respects_concurrency_limit(fake_redis, mock_request_page):
+    """Test that no more than `concurrency` pages are fetched at the same time."""
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fetch(url, page, headers):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return page_response({"info": {"pages": 10}, "results": []})
+
+    mock_request_page.side_effect = fetch
+
+    await crawl_characters("url", concurrency=2)
+
+    assert mock_request_page.call_count == 10
+    assert max_in_flight == 2
+
+
+@pytest.mark.anyio
+async def test_crawl_pages_cancels_other_pages_on_failure(fake_redis, mock_request_page):
+    """Test that the requests of the other pages are cancelled once a page fails the crawl."""
+    cancelled = []
+
+    async def fetch(url, page, headers):
+        if page == 2:
+            raise CircuitOpenException("The circuit breaker is open", retry_after=1)
+        try:
+            await asyncio.sleep(10 if page > 2 else 0)
+        except asyncio.CancelledError:
+            cancelled.append(page)
+            raise
+        return page_response({"info": {"pages": 4}, "results": []})
+
+    mock_request_page.side_effect = fetch
+
+    with pytest.raises(CircuitOpenException):
+        await asyncio.wait_for(crawl_pages("url"), 1)
+
+    assert sorted(cancelled) == [3, 4]
+
+
+class VersionedUpstream:
+    """Upstream pages of one Earth character each, answering 304 to requests with the ETag of the page if `etags`."""
+
+    def __init__(self, pages: int = 3, etags: bool = True) -> None:
+        self.names = {page: f"Page {page}" for page in range(1, pages + 1)}
+        self.etags = etags
+        self.failing: set[int] = set()
+        self.requests: list[tuple[int, dict]] = []
+
+    def __call__(self, url: str, page: int, headers: dict) -> httpx.Response:
+        self.requests.append((page, headers))
+        if page in self.failing:
+            raise ServiceUnavailableException("The Rick and Morty API is unavailable")
+        etag = f'W/"{page}-{self.names[page]}"'
+        if self.etags and headers.get("If-None-Match") == etag:
+            return httpx.Response(304)
+        data = {
+            "info": {"pages": len(self.names)},
+            "results": [{"id": page, "name": self.names[page], "origin": {"name": "Earth"}}],
+        }
+        return page_response(data, **({"ETag": etag} if self.etags else {}))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("etags", [True, False])
+async def test_crawl_pages_reuses_unchanged_pages(fake_redis, mock_request_page, etags):
+    """Test that cached pages are revalidated, by their ETag or their content, and only changed pages are parsed."""
+    mock_request_page.side_effect = upstream = VersionedUpstream(etags=etags)
+    first = await crawl_pages("url")
+    assert [character["id"] for character in first.changed] == [1, 2, 3]
+
+    upstream.names[2] = "Page 2, edited"
+    upstream.requests.clear()
+    with patch("characters.filter_request", wraps=characters.filter_request) as mock_filter:
+        second = await crawl_pages("url")
+
+    assert [character["name"] for character in second.changed] == ["Page 2, edited"]
+    assert [character["name"] for character in second.characters] == ["Page 1", "Page 2, edited", "Page 3"]
+    assert second.cached_characters == first.characters
+    assert mock_filter.call_count == 1
+    if etags:
+        assert upstream.requests[0] == (1, {"If-None-Match": 'W/"1-Page 1"'})
+    assert 0 < await fake_redis.ttl(f"upstream:page:{sha1(b'url').hexdigest()[:16]}:2") <= 24 * 60 * 60
+
+
+@pytest.mark.anyio
+async def test_crawl_pages_keeps_failed_pages_as_cached(fake_redis, mock_request_page):
+    """Test that a page failing is kept as cached, and is only missing if it is not cached."""
+    mock_request_page.side_effect = upstream = VersionedUpstream()
+    upstream.failing = {2}
+    first = await crawl_pages("url")
+    assert [character["id"] for character in first.characters] == [1, 3]
+    assert first.missing == 1
+
+    upstream.failing = set()
+    await crawl_pages("url")
+    upstream.failing = {2, 3}
+    crawl = await crawl_pages("url")
+
+    assert [character["id"] for character in crawl.characters] == [1, 2, 3]
+    assert (crawl.missing, crawl.changed) == (0, [])
+
+
+@pytest.mark.anyio
+async def test_refresh_saves_only_changed_pages(fake_redis, mock_request_page, mock_save_characters_to_db, db_session):
+    """Test that a refresh upserts only the changed pages once the database holds the cached pages."""
+    mock_request_page.side_effect = upstream = VersionedUpstream()
+    with patch("characters.BASE_URL", "url"):
+        first = await characters.refresh_characters(db_session)
+        mock_save_characters_to_db.assert_called_once_with(first, db_session, prune=True, changed=None)
+
+        db_session.get.return_value = Dataset(
+            name="characters", version=characters_version(first), updated_at=time.time()
+        )
+        upstream.names[3] = "Page 3, edited"
+        second = await characters.refresh_characters(db_session)
+        mock_save_characters_to_db.assert_called_with(second, db_session, prune=True, changed=[second[2]])
+
+        # The characters of a missing page are neither pruned nor cached
+        await fake_redis.delete(f"upstream:page:{sha1(b'url').hexdigest()[:16]}:2")
+        upstream.failing = {2}
+        third = await characters.refresh_characters(db_session)
+    mock_save_characters_to_db.assert_called_with(third, db_session, prune=False, changed=None)
+    assert [character["id"] for character in third] == [1, 3]
+
+
+def test_fetch_characters_uses_shared_client():
+    """Test that pages are fetched through the injected shared client."""
+    requested_urls = []
+
+    def handler(request):
+        requested_urls.append(str(request.url))
+        return httpx.Response(200, json={"info": {"pages": 1}, "results": []})
+
+    set_http_client(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    try:
+        result = asyncio.run(fetch_characters("https://example.com/api/character?page=", 2))
+    finally:
+        set_http_client(None)
+
+    assert result == {"info": {"pages": 1}, "results": []}
+    assert requested_urls == ["https://example.com/api/character?page=2"]
+
+
+class FaultyUpstream:
+    """
+    Upstream API stand-in injecting faults: each request takes the next of `faults`, else `fault`.
+
+    A fault is an exception raised as the transport error, or a status code. No fault serves one page of characters.
+    """
+
+    def __init__(self) -> None:
+        self.fault: int | Exception | None = None
+        self.faults: list[int | Exception | None] = []
+        self.retry_after = "0"
+        self.requests = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        fault = self.faults.pop(0) if self.faults else self.fault
+        if isinstance(fault, Exception):
+            raise fault
+        if fault:
+            return httpx.Response(fault, headers={"Retry-After": self.retry_after})
+        return httpx.Response(
+            200,
+            json={"info": {"pages": 1}, "results": [{"id": 3, "name": "Summer Smith", "origin": {"name": "Earth"}}]},
+        )
+
+
+@pytest.fixture
+def faulty_upstream(fake_redis):
+    """Fault-injecting upstream behind a breaker and a rate governor of its own, retried without waiting."""
+    upstream = FaultyUpstream()
+    set_http_client(httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    with (
+        patch("characters.upstream_breaker", CircuitBreaker("test-upstream", minimum_calls=4, open_timeout=0.05)),
+        patch("characters.UPSTREAM_RETRY_MIN_WAIT", 0),
+        patch("characters.UPSTREAM_RETRY_MAX_WAIT", 0),
+    ):
+        yield upstream
+    set_http_client(None)
+
+
+@pytest.mark.anyio
+async def test_fetch_characters_fails_fast_once_breaker_opens(faulty_upstream):
+    """Test that failing requests open the breaker, which then rejects requests without sending them."""
+    faulty_upstream.fault = httpx.ConnectTimeout("timed out")
+
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailableException):
+            await fetch_characters("https://example.com/api/character?page=", 1)
+
+    # The second fetch stopped retrying once the fourth request failed
+    assert characters.upstream_breaker.state is State.OPEN
+    assert faulty_upstream.requests == 4
+    with pytest.raises(CircuitOpenException):
+        await fetch_characters("https://example.com/api/character?page=", 1)
+    assert faulty_upstream.requests == 4
+
+
+@pytest.mark.anyio
+async def test_breaker_rejections_do_not_take_governor_leases(fake_redis, faulty_upstream):
+    """Test that requests rejected by the open breaker take no lease or token and leave the shared limit as is."""
+    faulty_upstream.fault = httpx.ConnectTimeout("timed out")
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailableException):
+            await fetch_characters("https://example.com/api/character?page=", 1)
+    assert characters.upstream_breaker.state is State.OPEN
+    limit = await fake_redis.hget(governor.GOVERNOR_KEY, "limit")
+    tokens = await fake_redis.hget(governor.GOVERNOR_KEY, "tokens")
+
+    for _ in range(4):
+        with pytest.raises(CircuitOpenException):
+            await fetch_characters("https://example.com/api/character?page=", 1)
+
+    assert await fake_redis.hget(governor.GOVERNOR_KEY, "limit") == limit
+    assert await fake_redis.hget(governor.GOVERNOR_KEY, "tokens") == tokens
+    assert await fake_redis.zcard(governor.IN_FLIGHT_KEY) == 0
+
+
+@pytest.mark.anyio
+async def test_fetch_characters_breaker_closes_on_recovery(faulty_upstream):
+    """Test that a request succeeding after the open timeout closes the breaker again."""
+    faulty_upstream.fault = 503
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailableException):
+            await fetch_characters("https://example.com/api/character?page=", 1)
+    assert characters.upstream_breaker.state is State.OPEN
+
+    faulty_upstream.fault = None
+    await asyncio.sleep(0.06)
+
+    assert (await fetch_characters("https://example.com/api/character?page=", 1))["info"]["pages"] == 1
+    assert characters.upstream_breaker.state is State.CLOSED
+
+
+@pytest.mark.anyio
+async def test_fetch_characters_retries_after_429(faulty_upstream):
+    """Test that a 429 response is retried after its Retry-After and does not count as a failure."""
+    faulty_upstream.faults = [429]
+    faulty_upstream.retry_after = "0.05"
+
+    with patch("governor.pause", wraps=governor.pause) as mock_pause:
+        result = await fetch_characters("https://example.com/api/character?page=", 1)
+
+    assert result["info"]["pages"] == 1
+    assert faulty_upstream.requests == 2
+    assert characters.upstream_breaker.failures == 0
+    # Every replica was paused
+    mock_pause.assert_awaited_once_with(0.05)
+
+
+@pytest.mark.anyio
+async def test_fetch_characters_429_waiting_too_long_not_retried(faulty_upstream):
+    """Test that a 429 response asking to wait longer than UPSTREAM_MAX_RETRY_AFTER fails right away."""
+    faulty_upstream.fault = 429
+    faulty_upstream.retry_after = "3600"
+
+    with pytest.raises(UpstreamThrottledException) as exc_info:
+        await fetch_characters("https://example.com/api/character?page=", 1)
+
+    assert exc_info.value.retry_after == 3600
+    assert faulty_upstream.requests == 1
+
+
+@pytest.mark.anyio
+async def test_failed_crawl_is_negatively_cached(fake_redis, faulty_upstream, mock_save_characters_to_db, db_session):
+    """Test that cache misses following a failed crawl fail fast without crawling again."""
+    faulty_upstream.fault = 500
+
+    with pytest.raises(ServiceUnavailableException):
+        await get_all_characters(db_session)
+    requests = faulty_upstream.requests
+
+    faulty_upstream.fault = None
+    with pytest.raises(ServiceUnavailableException):
+        await get_all_characters(db_session)
+
+    assert faulty_upstream.requests == requests == 3
+    assert 0 < await fake_redis.pttl("characters:upstream_failure") <= 10_000
+
+    await fake_redis.delete("characters:upstream_failure")
+    assert [character["id"] for character in (await get_all_characters(db_session)).characters] == [3]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("read_only", [False, True])
+async def test_last_known_good_served_while_upstream_fails(
+    fake_redis, faulty_upstream, mock_save_characters_to_db, db_session, read_only
+):
+    """Test that expired characters saved to the database are served stale while the upstream API fails."""
+    saved = [{"id": 1, "name": "Rick Sanchez", "origin": {"name": "Earth"}}]
+    db_session.get.return_value = Dataset(name="characters", version="v1", updated_at=time.time() - 2 * CACHE_HARD_TTL)
+    faulty_upstream.fault = 503
+    if read_only:
+        # The background refresher failed to crawl
+        await fake_redis.set("characters:upstream_failure", "The Rick and Morty API is unavailable")
+
+    with (
+        patch("characters.load_characters", return_value=saved),
+        patch("characters.SessionLocal", return_value=db_session),
+    ):
+        result = await get_all_characters(db_session, read_only=read_only)
+        if characters._background_refresh:
+            await characters._background_refresh
+
+    assert result.characters == saved
+    assert result.is_stale and not result.is_expired
+    mock_save_characters_to_db.assert_not_called()
+    if read_only:
+        assert not await fake_redis.exists("characters")
+    else:
+        assert decode_payload(await fake_redis.get("characters"))["characters"] == saved
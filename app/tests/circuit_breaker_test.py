@@ -0,0 +1,165 @@
+import time
+
+import pytest
+from circuit_breaker import CircuitBreaker, State
+from exceptions import CircuitOpenException
+from prometheus_client import REGISTRY
+
+
+def sample(name: str, **labels) -> float | None:
+    return REGISTRY.get_sample_value(name, {"app_name": "fastapi-app", **labels})
+
+
+def call(breaker: CircuitBreaker, fail: bool = False) -> None:
+    with breaker.call():
+        if fail:
+            raise ConnectionError("upstream down")
+
+
+def trip(breaker: CircuitBreaker) -> None:
+    for _ in range(breaker.minimum_calls):
+        with pytest.raises(ConnectionError):
+            call(breaker, fail=True)
+
+
+def test_opens_at_failure_rate():
+    """Test that the breaker opens once enough calls were made and enough of them failed."""
+    breaker = CircuitBreaker("rate-test", failure_rate=0.5, minimum_calls=4)
+
+    call(breaker)
+    call(breaker)
+    with pytest.raises(ConnectionError):
+        call(breaker, fail=True)
+    assert breaker.state is State.CLOSED
+
+    with pytest.raises(ConnectionError):
+        call(breaker, fail=True)
+    assert breaker.state is State.OPEN
+
+
+def test_minimum_calls():
+    """Test that failures below the minimum number of calls do not open the breaker."""
+    breaker = CircuitBreaker("minimum-test", minimum_calls=3)
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            call(breaker, fail=True)
+
+    assert breaker.state is State.CLOSED
+
+
+def test_failures_outside_window_are_forgotten():
+    """Test that only the outcomes of the last `window` seconds count."""
+    breaker = CircuitBreaker("window-test", minimum_calls=2, window=0.05)
+
+    with pytest.raises(ConnectionError):
+        call(breaker, fail=True)
+    time.sleep(0.06)
+    call(breaker)
+
+    assert breaker.state is State.CLOSED
+    assert len(breaker.outcomes) == 1
+
+
+def test_open_rejects_fast():
+    """Test that an open breaker rejects calls without running them and says when to retry."""
+    breaker = CircuitBreaker("reject-test", minimum_calls=2, open_timeout=30)
+    trip(breaker)
+    rejections = sample("circuit_breaker_rejections_total", breaker="reject-test") or 0
+
+    with pytest.raises(CircuitOpenException) as exc_info:
+        call(breaker)
+
+    assert 29 < exc_info.value.retry_after <= 30
+    assert sample("circuit_breaker_rejections_total", breaker="reject-test") == rejections + 1
+
+
+def test_check_rejects_without_admitting():
+    """Test that checking a breaker rejects like a call would, without taking a trial slot."""
+    breaker = CircuitBreaker("check-test", minimum_calls=2, open_timeout=0.05, half_open_calls=1)
+    breaker.check()
+    trip(breaker)
+
+    with pytest.raises(CircuitOpenException):
+        breaker.check()
+
+    time.sleep(0.06)
+    breaker.check()
+    with breaker.call(), pytest.raises(CircuitOpenException):
+        breaker.check()
+    assert breaker.state is State.CLOSED
+
+
+def test_half_open_trial_success_closes():
+    """Test that a successful trial call after the open timeout closes the breaker."""
+    breaker = CircuitBreaker("close-test", minimum_calls=2, open_timeout=0.05, half_open_calls=1)
+    trip(breaker)
+    time.sleep(0.06)
+
+    with breaker.call():
+        assert breaker.state is State.HALF_OPEN
+        # Only the trial call is admitted while half-open
+        with pytest.raises(CircuitOpenException):
+            call(breaker)
+
+    assert breaker.state is State.CLOSED
+    assert len(breaker.outcomes) == 0
+
+
+def test_half_open_trial_failure_reopens():
+    """Test that a failed trial call opens the breaker again for another open timeout."""
+    breaker = CircuitBreaker("reopen-test", minimum_calls=2, open_timeout=0.05)
+    trip(breaker)
+    time.sleep(0.06)
+
+    with pytest.raises(ConnectionError):
+        call(breaker, fail=True)
+
+    assert breaker.state is State.OPEN
+    assert breaker.retry_after > 0.04
+
+
+def test_cancelled_trial_frees_its_slot():
+    """Test that a trial call interrupted without an outcome lets another trial call in."""
+    breaker = CircuitBreaker("cancel-test", minimum_calls=2, open_timeout=0.05)
+    trip(breaker)
+    time.sleep(0.06)
+
+    with pytest.raises(KeyboardInterrupt), breaker.call():
+        raise KeyboardInterrupt
+
+    call(breaker)
+    assert breaker.state is State.CLOSED
+
+
+def test_outcomes_of_calls_admitted_before_a_transition_are_ignored():
+    """Test that a call admitted while closed does not count once the breaker opened meanwhile."""
+    breaker = CircuitBreaker("generation-test", minimum_calls=2, open_timeout=0.05)
+
+    with breaker.call():
+        trip(breaker)
+        time.sleep(0.06)
+        # The slow call succeeding must not close the breaker, only a trial call can
+    assert breaker.state is State.OPEN
+
+    call(breaker)
+    assert breaker.state is State.CLOSED
+
+
+def test_state_and_transitions_are_exported():
+    """Test that the state gauge and the transition counter follow the breaker."""
+    breaker = CircuitBreaker("metrics-test", minimum_calls=2, open_timeout=0.05)
+    # Nothing is exported when the breaker is created, at import time
+    assert sample("circuit_breaker_state", breaker="metrics-test") is None
+    breaker.export_state()
+    assert sample("circuit_breaker_state", breaker="metrics-test") == 0
+
+    trip(breaker)
+    assert sample("circuit_breaker_state", breaker="metrics-test") == 2
+    time.sleep(0.06)
+    with breaker.call():
+        assert sample("circuit_breaker_state", breaker="metrics-test") == 1
+    assert sample("circuit_breaker_state", breaker="metrics-test") == 0
+
+    for state in ("open", "half_open", "closed"):
+        assert sample("circuit_breaker_transitions_total", breaker="metrics-test", state=state) == 1
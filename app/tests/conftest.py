@@ -0,0 +1,22 @@
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+from cache import l1_invalidate
+
+
+@pytest.fixture
+def anyio_backend():
+    """Run the async tests on asyncio."""
+    return "asyncio"
+
+
+@pytest.fixture
+async def fake_redis():
+    """In-memory Redis supporting the Lua scripts."""
+    fake_redis = fakeredis.FakeAsyncRedis()
+    with patch("cache.redis_client", fake_redis):
+        # Nothing is cached in process either
+        l1_invalidate()
+        yield fake_redis
+        l1_invalidate()
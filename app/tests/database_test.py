@@ -1,27 +1,54 @@
+import time
 from datetime import datetime
+from unittest.mock import patch
 
 import pytest
-from database import Base, Character, save_characters_to_db
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from cache import characters_version
+from database import (
+    Base,
+    Character,
+    InstrumentedPool,
+    count_characters,
+    create_pooled_engine,
+    get_characters_after,
+    get_characters_page,
+    get_dataset,
+    load_characters,
+    save_characters_to_db,
+)
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from utils import DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUT_TIME, DB_POOL_CHECKOUT_TIMEOUTS, DB_POOL_OVERFLOW
 
 # Create an in-memory SQLite database for testing
-TEST_DATABASE_URL = "sqlite:///:memory:"
-engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+# Every connection must see the same in-memory database
+engine = create_async_engine(TEST_DATABASE_URL, poolclass=StaticPool)
+TestingSessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+pytestmark = pytest.mark.anyio
 
 
 @pytest.fixture
-def db_session():
+async def db_session():
     """Fixture to create a new database session for each test."""
-    Base.metadata.create_all(bind=engine)
-    db = TestingSessionLocal()
-    yield db
-    db.close()
-    Base.metadata.drop_all(bind=engine)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    async with TestingSessionLocal() as db:
+        yield db
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+    # The StaticPool connection belongs to this test's event loop
+    await engine.dispose()
+
 
+async def count_rows(db_session) -> int:
+    return await db_session.scalar(select(func.count()).select_from(Character))
 
-def test_save_characters_to_db(db_session):
+
+async def test_save_characters_to_db(db_session):
     """Test saving characters to the database."""
     characters = [
         {
@@ -40,10 +67,10 @@ def test_save_characters_to_db(db_session):
         }
     ]
 
-    save_characters_to_db(characters, db_session)
+    await save_characters_to_db(characters, db_session)
 
     # Fetch character from DB
-    saved_character = db_session.query(Character).filter_by(id=1).first()
+    saved_character = await db_session.get(Character, 1)
 
     # Assertions
     assert saved_character is not None
@@ -57,3 +84,233 @@ def test_save_characters_to_db(db_session):
     assert saved_character.episode == ["https://rickandmortyapi.com/api/episode/1"]
     assert saved_character.url == "https://rickandmortyapi.com/api/character/1"
     assert saved_character.created == datetime(2017, 11, 4, 18, 48, 46)
+
+
+async def test_save_characters_to_db_parses_created(db_session):
+    """Test that the ISO 8601 creation time sent by the API is stored as a naive UTC datetime."""
+    character = make_character(1, "Rick Sanchez")
+    character["created"] = "2017-11-04T18:48:46.250Z"
+
+    await save_characters_to_db([character], db_session)
+
+    saved_character = await db_session.get(Character, 1)
+    assert saved_character.created == datetime(2017, 11, 4, 18, 48, 46, 250000)
+
+
+def make_character(character_id: int, name: str) -> dict:
+    return {
+        "id": character_id,
+        "name": name,
+        "status": "Alive",
+        "species": "Human",
+        "type": "",
+        "gender": "Male",
+        "origin": {"name": "Earth", "url": "https://rickandmortyapi.com/api/location/1"},
+        "location": {"name": "Earth", "url": "https://rickandmortyapi.com/api/location/1"},
+        "image": f"https://rickandmortyapi.com/api/character/avatar/{character_id}.jpeg",
+        "episode": ["https://rickandmortyapi.com/api/episode/1"],
+        "url": f"https://rickandmortyapi.com/api/character/{character_id}",
+        "created": datetime(2017, 11, 4, 18, 48, 46),
+    }
+
+
+async def test_save_characters_to_db_skips_unchanged(db_session):
+    """Test that saving the same characters again writes nothing and changed characters are updated."""
+    characters = [make_character(1, "Rick Sanchez"), make_character(2, "Morty Smith")]
+
+    assert await save_characters_to_db(characters, db_session) == 2
+    assert await save_characters_to_db(characters, db_session) == 0
+
+    characters[1]["location"] = {"name": "Citadel of Ricks", "url": "https://rickandmortyapi.com/api/location/3"}
+    assert await save_characters_to_db(characters, db_session) == 1
+
+    saved_character = await db_session.get(Character, 2)
+    assert saved_character.location["name"] == "Citadel of Ricks"
+    assert await count_rows(db_session) == 2
+
+
+async def test_save_characters_to_db_in_batches(db_session):
+    """Test that characters are written in batches of UPSERT_BATCH_SIZE."""
+    characters = [make_character(character_id, f"Character {character_id}") for character_id in range(1, 8)]
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record_statement)
+    try:
+        with patch("database.UPSERT_BATCH_SIZE", 3):
+            assert await save_characters_to_db(characters, db_session) == 7
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record_statement)
+
+    assert len([statement for statement in statements if statement.startswith("INSERT")]) == 3
+    assert await count_rows(db_session) == 7
+
+
+async def test_save_characters_to_db_prune(db_session):
+    """Test that pruning deletes the characters that are no longer fetched."""
+    await save_characters_to_db([make_character(1, "Rick Sanchez"), make_character(2, "Morty Smith")], db_session)
+
+    assert await save_characters_to_db([make_character(1, "Rick Sanchez")], db_session, prune=True) == 1
+
+    assert list(await db_session.scalars(select(Character.id))) == [1]
+
+
+async def test_save_characters_to_db_only_changed(db_session):
+    """Test that only the changed characters are upserted, while the full set is pruned against and recorded."""
+    characters = [make_character(1, "Rick Sanchez"), make_character(2, "Morty Smith"), make_character(3, "Summer")]
+    await save_characters_to_db(characters, db_session, prune=True)
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record_statement)
+    try:
+        assert await save_characters_to_db(characters[:2], db_session, prune=True, changed=[]) == 1
+        assert not [statement for statement in statements if statement.startswith("INSERT")]
+
+        characters[0]["name"] = "Rick C-137"
+        assert await save_characters_to_db(characters[:2], db_session, prune=True, changed=characters[:1]) == 1
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record_statement)
+
+    assert (await db_session.get(Character, 1)).name == "Rick C-137"
+    assert sorted(await db_session.scalars(select(Character.id))) == [1, 2]
+    assert (await get_dataset(db_session)).version == characters_version(characters[:2])
+
+
+async def test_save_characters_to_db_prune_records_dataset(db_session):
+    """Test that saving the full set of characters records when it was fetched and its version."""
+    characters = [make_character(1, "Rick Sanchez")]
+    assert await get_dataset(db_session) is None
+
+    await save_characters_to_db(characters, db_session)
+    assert await get_dataset(db_session) is None
+
+    before = time.time()
+    await save_characters_to_db(characters, db_session, prune=True)
+
+    dataset = await get_dataset(db_session)
+    assert dataset.version == characters_version(characters)
+    assert before <= dataset.updated_at <= time.time()
+
+
+async def test_load_characters_round_trip(db_session):
+    """Test that the characters read back in one query are in the shape the upstream API sent them."""
+    characters = [make_character(2, "Morty Smith"), make_character(1, "Rick Sanchez")]
+    for character in characters:
+        character["created"] = "2017-11-04T18:48:46.250Z"
+    await save_characters_to_db(characters, db_session)
+
+    assert await load_characters(db_session) == [characters[1], characters[0]]
+
+
+@pytest.mark.parametrize(
+    ("order_by", "descending", "expected_ids"),
+    [
+        ("id", False, [1, 2, 3, 4]),
+        ("id", True, [4, 3, 2, 1]),
+        ("name", False, [2, 4, 1, 3]),
+        ("name", True, [3, 1, 4, 2]),
+    ],
+)
+async def test_get_characters_page_order(db_session, order_by, descending, expected_ids):
+    """Test that characters are sorted by the requested column with ties broken by id."""
+    names = {1: "Morty Smith", 2: "Beth Smith", 3: "Rick Sanchez", 4: "Beth Smith"}
+    await save_characters_to_db(
+        [make_character(character_id, name) for character_id, name in names.items()], db_session
+    )
+
+    characters = await get_characters_page(db_session, order_by, descending, limit=10, offset=0)
+
+    assert [character.id for character in characters] == expected_ids
+
+
+async def test_get_characters_page_limit_offset(db_session):
+    """Test that only the requested page is returned."""
+    characters = [make_character(character_id, f"Character {character_id}") for character_id in range(1, 8)]
+    await save_characters_to_db(characters, db_session)
+
+    page = await get_characters_page(db_session, "id", False, limit=3, offset=3)
+
+    assert [character.id for character in page] == [4, 5, 6]
+
+
+async def test_count_characters_is_cached(db_session):
+    """Test that the count is cached until the characters are pruned."""
+    await save_characters_to_db([make_character(1, "Rick Sanchez")], db_session, prune=True)
+    assert await count_characters(db_session) == 1
+
+    await save_characters_to_db([make_character(2, "Morty Smith")], db_session)
+    assert await count_characters(db_session) == 1
+
+    await save_characters_to_db(
+        [make_character(1, "Rick Sanchez"), make_character(2, "Morty Smith")], db_session, prune=True
+    )
+    assert await count_characters(db_session) == 2
+
+
+@pytest.mark.parametrize(
+    ("order_by", "after", "ascending", "expected_ids"),
+    [
+        ("id", None, True, [1, 2]),
+        ("id", (2, 2), True, [3, 4]),
+        ("id", (3, 3), False, [2, 1]),
+        ("name", None, False, [3, 1]),
+        ("name", ("Beth Smith", 2), True, [4, 1]),
+        ("name", ("Morty Smith", 1), False, [4, 2]),
+    ],
+)
+async def test_get_characters_after(db_session, order_by, after, ascending, expected_ids):
+    """Test that characters following a (value, id) key are returned with ties broken by id."""
+    names = {1: "Morty Smith", 2: "Beth Smith", 3: "Rick Sanchez", 4: "Beth Smith"}
+    await save_characters_to_db(
+        [make_character(character_id, name) for character_id, name in names.items()], db_session
+    )
+
+    characters = await get_characters_after(db_session, order_by, after, ascending, limit=2)
+
+    assert [character.id for character in characters] == expected_ids
+
+
+async def test_pooled_engine_reports_pool_usage(tmp_path):
+    """Test that checked out and overflow connections, checkout time and checkout timeouts are exported."""
+    with (
+        patch("database.POSTGRES_POOL_SIZE", 1),
+        patch("database.POSTGRES_POOL_MAX_OVERFLOW", 1),
+        patch("database.POSTGRES_POOL_TIMEOUT", 0.05),
+    ):
+        pooled_engine = create_pooled_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}")
+    checkout_time = DB_POOL_CHECKOUT_TIME.labels(app_name="fastapi-app")._sum.get()
+    timeouts = DB_POOL_CHECKOUT_TIMEOUTS.labels(app_name="fastapi-app")._value.get()
+
+    try:
+        async with pooled_engine.connect(), pooled_engine.connect():
+            assert DB_POOL_CHECKED_OUT.labels(app_name="fastapi-app")._value.get() == 2
+            assert DB_POOL_OVERFLOW.labels(app_name="fastapi-app")._value.get() == 1
+
+            with pytest.raises(PoolTimeoutError):
+                await pooled_engine.connect().start()
+    finally:
+        await pooled_engine.dispose()
+
+    assert DB_POOL_CHECKED_OUT.labels(app_name="fastapi-app")._value.get() == 0
+    assert DB_POOL_CHECKOUT_TIMEOUTS.labels(app_name="fastapi-app")._value.get() == timeouts + 1
+    # The timed out checkout waited for the pool timeout
+    assert DB_POOL_CHECKOUT_TIME.labels(app_name="fastapi-app")._sum.get() - checkout_time >= 0.05
+
+
+def test_pooled_engine_statement_timeout():
+    """Test that the statement timeout is set on the server for every connection, and only when configured."""
+    with patch("database.create_async_engine", wraps=create_async_engine) as mock_create_async_engine:
+        create_pooled_engine("sqlite+aiosqlite://")
+        with patch("database.POSTGRES_STATEMENT_TIMEOUT", 5000):
+            create_pooled_engine("sqlite+aiosqlite://")
+
+    assert [call.kwargs["connect_args"] for call in mock_create_async_engine.call_args_list] == [
+        {},
+        {"server_settings": {"statement_timeout": "5000"}},
+    ]
+    assert mock_create_async_engine.call_args.kwargs["poolclass"] is InstrumentedPool
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+from exceptions import CircuitOpenException, UpstreamThrottledException
+from governor import GOVERNOR_KEY, IN_FLIGHT_KEY, PAUSE_KEY, acquire, governed_request, pause, release
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def no_latency():
+    """Start every test without the latencies observed by the previous ones."""
+    with patch("governor._latency", None):
+        yield
+
+
+async def limit(fake_redis) -> float:
+    return float(await fake_redis.hget(GOVERNOR_KEY, "limit"))
+
+
+async def test_rate_limit_shared_by_every_request(fake_redis):
+    """Test that a burst is admitted right away and the next requests wait for tokens."""
+    with (
+        patch("governor.UPSTREAM_RATE_LIMIT", 20),
+        patch("governor.UPSTREAM_RATE_BURST", 3),
+        patch("governor.UPSTREAM_CONCURRENCY_INITIAL", 10),
+    ):
+        start = time.monotonic()
+        for _ in range(3):
+            await acquire(max_pause=1)
+        burst = time.monotonic() - start
+        await acquire(max_pause=1)
+        throttled = time.monotonic() - start - burst
+
+    assert burst < 0.03
+    assert 0.03 < throttled < 0.2
+
+
+async def test_concurrency_limit_waits_for_a_release(fake_redis):
+    """Test that requests over the concurrency limit wait until a request in flight is released."""
+    with patch("governor.UPSTREAM_CONCURRENCY_INITIAL", 1), patch("governor.UPSTREAM_GOVERNOR_POLL_INTERVAL", 0.01):
+        lease = await acquire(max_pause=1)
+        waiting = asyncio.create_task(acquire(max_pause=1))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        await release(lease, congested=False)
+        await asyncio.wait_for(waiting, 1)
+
+    assert await fake_redis.zcard(IN_FLIGHT_KEY) == 1
+
+
+async def test_leases_expire(fake_redis):
+    """Test that the requests of a crashed replica stop counting once their lease expired."""
+    with patch("governor.UPSTREAM_CONCURRENCY_INITIAL", 1), patch("governor.UPSTREAM_TIMEOUT", -0.95):
+        await acquire(max_pause=1)
+        await asyncio.sleep(0.06)
+        await asyncio.wait_for(acquire(max_pause=1), 0.04)
+
+
+async def test_additive_increase(fake_redis):
+    """Test that requests answered in time raise the concurrency limit by about 1 per limit requests."""
+    with patch("governor.UPSTREAM_CONCURRENCY_INITIAL", 4):
+        for _ in range(4):
+            await release(await acquire(max_pause=1), congested=False)
+
+    assert 4.9 < await limit(fake_redis) < 5
+
+
+async def test_multiplicative_decrease_once_per_interval(fake_redis):
+    """Test that congestion halves the concurrency limit, once for a burst of congested requests."""
+    with patch("governor.UPSTREAM_CONCURRENCY_INITIAL", 8), patch("governor.UPSTREAM_BACKOFF_INTERVAL", 0.05):
+        leases = [await acquire(max_pause=1) for _ in range(3)]
+        for lease in leases[:2]:
+            await release(lease, congested=True)
+        assert await limit(fake_redis) == 4
+
+        await asyncio.sleep(0.06)
+        await release(leases[2], congested=True)
+        assert await limit(fake_redis) == 2
+
+        with patch("governor.UPSTREAM_CONCURRENCY_MIN", 1.5):
+            await asyncio.sleep(0.06)
+            await release(await acquire(max_pause=1), congested=True)
+        assert await limit(fake_redis) == 1.5
+
+
+async def test_slow_responses_are_congestion(fake_redis):
+    """Test that a response much slower than usual counts as congestion."""
+    with patch("governor.UPSTREAM_CONCURRENCY_INITIAL", 4):
+        async with governed_request(max_pause=1):
+            await asyncio.sleep(0.01)
+        assert await limit(fake_redis) > 4
+
+        async with governed_request(max_pause=1):
+            await asyncio.sleep(0.05)
+        assert await limit(fake_redis) < 3
+
+
+async def test_circuit_breaker_rejections_leave_the_limit(fake_redis):
+    """Test that requests rejected by the circuit breaker free their lease without adapting the limit."""
+    with patch("governor.UPSTREAM_CONCURRENCY_INITIAL", 4):
+        await release(await acquire(max_pause=1), congested=False)
+        adapted = await limit(fake_redis)
+        for _ in range(4):
+            with pytest.raises(CircuitOpenException):
+                async with governed_request(max_pause=1):
+                    raise CircuitOpenException("The circuit breaker is open", retry_after=1)
+
+        assert await limit(fake_redis) == adapted
+    assert await fake_redis.zcard(IN_FLIGHT_KEY) == 0
+
+
+async def test_throttled_request_pauses_every_replica(fake_redis):
+    """Test that a 429 response pauses the requests of every replica for its Retry-After."""
+    with pytest.raises(RuntimeError):
+        async with governed_request(max_pause=1) as request:
+            request.throttle(0.5)
+            raise RuntimeError("429 Too Many Requests")
+
+    assert 0 < await fake_redis.pttl(PAUSE_KEY) <= 500
+    start = time.monotonic()
+    await acquire(max_pause=1)
+    assert 0.2 < time.monotonic() - start < 0.6
+
+
+async def test_longer_pause_kept(fake_redis):
+    """Test that a shorter pause does not cut a longer one short."""
+    await pause(10)
+    await pause(0.1)
+
+    assert await fake_redis.pttl(PAUSE_KEY) > 9000
+
+
+async def test_pause_longer_than_max_fails_fast(fake_redis):
+    """Test that a request fails instead of waiting out a pause longer than `max_pause`."""
+    await pause(30)
+
+    with pytest.raises(UpstreamThrottledException) as exc_info:
+        await acquire(max_pause=10)
+
+    assert 29 < exc_info.value.retry_after <= 30
+
+
+async def test_ungoverned_without_redis():
+    """Test that requests are admitted ungoverned while Redis is unavailable."""
+    server = fakeredis.FakeServer()
+    server.connected = False
+
+    with patch("cache.redis_client", fakeredis.FakeAsyncRedis(server=server)):
+        async with governed_request(max_pause=1) as request:
+            assert request.lease is None
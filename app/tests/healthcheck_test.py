@@ -1,26 +1,46 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
-from healthcheck import check_database, check_redis, get_health  # Replace with actual module name
-from psycopg2.extensions import QueryCanceledError
+from healthcheck import (  # Replace with actual module name
+    QUERY_CANCELED,
+    ComponentChecks,
+    ComponentHealth,
+    HealthCheck,
+    check_database,
+    check_redis,
+    check_with_timeout,
+    get_cached_health,
+    get_health,
+    refresh_health,
+    start_health_checker,
+    stop_health_checker,
+)
 from redis.exceptions import RedisError
-from sqlalchemy.engine import Connection
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+
+
+class QueryCanceled(Exception):
+    """Driver error of a statement cancelled by the statement timeout."""
+
+    sqlstate = QUERY_CANCELED
 
 
 @pytest.fixture
 def mock_db_connection():
     """Mock database connection."""
-    with patch("healthcheck.engine.connect") as mock_connect:
-        mock_conn = MagicMock(spec=Connection)
-        mock_connect.return_value.__enter__.return_value = mock_conn
+    with patch("healthcheck.engine") as mock_engine:
+        mock_conn = MagicMock()
+        mock_conn.execute = AsyncMock(return_value=MagicMock())
+        mock_engine.connect.return_value.__aenter__.return_value = mock_conn
         yield mock_conn
 
 
 @pytest.fixture
 def mock_redis():
     """Mock Redis client."""
-    with patch("healthcheck.redis_client") as mock_redis:
+    with patch("healthcheck.redis_client", new_callable=AsyncMock) as mock_redis:
         yield mock_redis
 
 
@@ -28,7 +48,7 @@ def test_check_database_success(mock_db_connection):
     """Test database health check when everything is working."""
     mock_db_connection.execute.return_value.scalar.side_effect = ["10MB", 5]
 
-    result = check_database()
+    result = asyncio.run(check_database())
 
     assert result["status"] == "healthy"
     assert "Database write operations successfully checked" in result["message"]
@@ -40,7 +60,7 @@ def test_check_database_high_active_writes(mock_db_connection):
     """Test database health check when active write transactions exceed threshold."""
     mock_db_connection.execute.return_value.scalar.side_effect = ["10MB", 100]
 
-    result = check_database()
+    result = asyncio.run(check_database())
 
     assert result["status"] == "unhealthy"
     assert "High number of active write transactions" in result["message"]
@@ -48,9 +68,9 @@ def test_check_database_high_active_writes(mock_db_connection):
 
 def test_check_database_query_timeout(mock_db_connection):
     """Test database health check when a query times out."""
-    mock_db_connection.execute.side_effect = QueryCanceledError()
+    mock_db_connection.execute.side_effect = DBAPIError("SELECT 1", {}, QueryCanceled())
 
-    result = check_database()
+    result = asyncio.run(check_database())
 
     assert result["status"] == "unhealthy"
     assert "Database query timeout" in result["message"]
@@ -60,7 +80,7 @@ def test_check_database_sqlalchemy_error(mock_db_connection):
     """Test database health check when a SQLAlchemy error occurs."""
     mock_db_connection.execute.side_effect = SQLAlchemyError("DB error")
 
-    result = check_database()
+    result = asyncio.run(check_database())
 
     assert result["status"] == "unhealthy"
     assert "Database error: DB error" in result["message"]
@@ -74,7 +94,7 @@ def test_check_redis_success(mock_redis):
     mock_redis.delete.return_value = True
     mock_redis.info.return_value = {"used_memory": 5000000, "maxmemory": 100000000}
 
-    result = check_redis()
+    result = asyncio.run(check_redis())
 
     assert result["status"] == "healthy"
     assert "Redis connection and operations successfully checked" in result["message"]
@@ -85,7 +105,7 @@ def test_check_redis_ping_failure(mock_redis):
     """Test Redis health check when ping fails."""
     mock_redis.ping.return_value = False
 
-    result = check_redis()
+    result = asyncio.run(check_redis())
 
     assert result["status"] == "unhealthy"
     assert "Redis ping failed" in result["message"]
@@ -96,7 +116,7 @@ def test_check_redis_write_failure(mock_redis):
     mock_redis.ping.return_value = True
     mock_redis.set.return_value = False
 
-    result = check_redis()
+    result = asyncio.run(check_redis())
 
     assert result["status"] == "unhealthy"
     assert "Redis write operation failed" in result["message"]
@@ -110,7 +130,7 @@ def test_check_redis_high_memory_usage(mock_redis):
     mock_redis.delete.return_value = True
     mock_redis.info.return_value = {"used_memory": 95000000, "maxmemory": 100000000}
 
-    result = check_redis()
+    result = asyncio.run(check_redis())
 
     assert result["status"] == "unhealthy"
     assert "Redis memory usage critical" in result["message"]
@@ -120,7 +140,7 @@ def test_check_redis_exception(mock_redis):
     """Test Redis health check when an exception occurs."""
     mock_redis.ping.side_effect = RedisError("Redis failure")
 
-    result = check_redis()
+    result = asyncio.run(check_redis())
 
     assert result["status"] == "unhealthy"
     assert "Redis error: Redis failure" in result["message"]
@@ -135,7 +155,7 @@ def test_get_health_all_healthy(mock_db_connection, mock_redis):
     mock_redis.delete.return_value = True
     mock_redis.info.return_value = {"used_memory": 5000000, "maxmemory": 100000000}
 
-    result = get_health()
+    result = asyncio.run(get_health())
 
     assert result.status == "healthy"
     assert isinstance(result.timestamp, str)
@@ -152,9 +172,86 @@ def test_get_health_unhealthy(mock_db_connection, mock_redis):
     mock_redis.delete.return_value = True
     mock_redis.info.return_value = {"used_memory": 5000000, "maxmemory": 100000000}
 
-    result = get_health()
+    result = asyncio.run(get_health())
 
     assert result.status == "unhealthy"
     assert isinstance(result.timestamp, str)
     assert result.checks["database"]["status"] == "unhealthy"
     assert result.checks["cache"]["status"] == "healthy"
+
+
+def make_health(status: str = "healthy") -> HealthCheck:
+    component = ComponentHealth(status=status, message="", metrics={})
+    return HealthCheck(status=status, timestamp="", checks=ComponentChecks(database=component, cache=component))
+
+
+@pytest.fixture
+def no_cached_health():
+    """Forget the result of earlier health checks."""
+    with patch("healthcheck._latest_health", None):
+        yield
+
+
+def test_check_with_timeout():
+    """Test that a component check taking longer than the timeout reports the component unhealthy."""
+
+    async def slow_check():
+        await asyncio.sleep(1)
+
+    with patch("healthcheck.HEALTH_CHECK_TIMEOUT", 0.01):
+        result = asyncio.run(check_with_timeout("Database", slow_check))
+
+    assert result["status"] == "unhealthy"
+    assert result["message"] == "Database check timed out after 0.01s"
+
+
+def test_get_health_runs_checks_concurrently():
+    """Test that the component checks run at the same time."""
+
+    async def slow_check():
+        await asyncio.sleep(0.1)
+        return ComponentHealth(status="healthy", message="", metrics={})
+
+    with patch("healthcheck.check_database", slow_check), patch("healthcheck.check_redis", slow_check):
+        start = time.perf_counter()
+        result = asyncio.run(get_health())
+
+    assert result.status == "healthy"
+    assert time.perf_counter() - start < 0.19
+
+
+def test_get_cached_health(no_cached_health):
+    """Test that the last result is served with its age, and reported unhealthy once too old."""
+    assert get_cached_health() is None
+
+    with patch("healthcheck.get_health", return_value=make_health()):
+        asyncio.run(refresh_health())
+    cached = get_cached_health()
+    assert cached.status == "healthy"
+    assert 0 <= cached.age < 1
+
+    with patch("healthcheck.HEALTH_CHECK_MAX_AGE", 0):
+        time.sleep(0.01)
+        assert get_cached_health().status == "unhealthy"
+
+
+def test_health_checker_runs_in_background(no_cached_health):
+    """Test that the health checker runs the checks right away, is started once and stops cleanly."""
+
+    async def start_and_stop():
+        start_health_checker()
+        # Already running, not started again
+        start_health_checker()
+        await asyncio.sleep(0.01)
+        await stop_health_checker()
+        # No checks run once stopped
+        await asyncio.sleep(0.05)
+
+    with (
+        patch("healthcheck.HEALTH_CHECK_INTERVAL", 0.02),
+        patch("healthcheck.get_health", return_value=make_health("unhealthy")) as mock_get_health,
+    ):
+        asyncio.run(start_and_stop())
+
+    mock_get_health.assert_called_once()
+    assert get_cached_health().status == "unhealthy"
@@ -1,15 +1,25 @@
+import asyncio
+import hashlib
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 
 # Create mock engine and connection
 mock_engine = MagicMock()
 mock_engine.connect.return_value = MagicMock()
+mock_engine.dispose = AsyncMock()
 
-# Mock both database engine creation and metadata creation
-with patch("database.create_engine", return_value=mock_engine), patch("database.Base.metadata.create_all"):
+# Mock the database engine creation, tables are only created by the lifespan
+with patch("database.create_async_engine", return_value=mock_engine):
+    from cache import CachedCharacters
+    from database import Base, Character, save_characters_to_db
+    from exceptions import CircuitOpenException
+    from healthcheck import ComponentChecks, ComponentHealth, HealthCheck
     from main import app, get_db
+    from response_cache import clear_cached_responses
 
 
 # Create a test database session
@@ -24,10 +34,10 @@ client = TestClient(app)
 
 
 @pytest.fixture
-def mock_is_rate_limited():
-    """Mock the is_rate_limited function."""
-    with patch("main.is_rate_limited", new_callable=AsyncMock, return_value=False) as mock_rate_limited:
-        yield mock_rate_limited
+def mock_rate_limit():
+    """Mock the rate_limit function."""
+    with patch("main.rate_limit", return_value=0) as mock_rate_limit:
+        yield mock_rate_limit
 
 
 @pytest.fixture
@@ -41,9 +51,299 @@ def mock_get_characters():
         yield mock_get_characters
 
 
-def test_rate_limited_endpoint(mock_is_rate_limited, mock_get_characters):
-    # Set the mock to return True (rate limited)
-    mock_is_rate_limited.return_value = True
+def test_rate_limited_endpoint(mock_rate_limit, mock_get_characters):
+    # Set the mock to return a wait (rate limited)
+    mock_rate_limit.return_value = 12.3
 
-    response = client.get("/characters")
+    with patch("main.RATE_LIMIT_API_KEY_HASHES", {hashlib.sha256(b"secret").hexdigest()}):
+        response = client.get("/characters", headers={"X-API-Key": "secret"})
     assert response.status_code == 429
+    assert response.headers["Retry-After"] == "13"
+    # Clients are identified by a hash of their API key
+    client_id = mock_rate_limit.call_args.args[0]
+    assert client_id.startswith("key:")
+    assert "secret" not in client_id
+
+
+def test_unknown_api_keys_limited_by_ip(mock_rate_limit, mock_get_characters):
+    """Test that clients sending an API key that is not configured are rate limited by IP address."""
+    mock_rate_limit.return_value = 1
+
+    with patch("main.RATE_LIMIT_API_KEY_HASHES", {hashlib.sha256(b"secret").hexdigest()}):
+        for api_key in ("random-1", "random-2"):
+            assert client.get("/characters", headers={"X-API-Key": api_key}).status_code == 429
+
+    assert [call.args[0] for call in mock_rate_limit.call_args_list] == ["ip:testclient", "ip:testclient"]
+
+
+def test_circuit_open_answers_retry_after(mock_rate_limit):
+    """Test that characters rejected by the open upstream circuit breaker answer 503 with a Retry-After."""
+    with patch("main.get_all_characters", side_effect=CircuitOpenException("The circuit breaker is open", 12.3)):
+        response = client.get("/characters")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "13"
+
+
+def test_characters_from_database():
+    """Test that only the requested page is queried from the database in database mode."""
+    characters = [
+        Character(
+            id=character_id,
+            name=name,
+            status="Alive",
+            species="Human",
+            type="",
+            gender="Male",
+            origin={"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+            location={"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+            image=f"https://rickandmortyapi.com/api/character/avatar/{character_id}.jpeg",
+            episode=["https://rickandmortyapi.com/api/episode/1"],
+            url=f"https://rickandmortyapi.com/api/character/{character_id}",
+            created="2017-11-04T18:48:46.250Z",
+        )
+        for character_id, name in [(1, "Rick Sanchez"), (2, "Morty Smith")]
+    ]
+
+    with (
+        patch("main.CHARACTERS_SOURCE", "database"),
+        patch("main.REFRESHER_ENABLED", False),
+        patch("main.create_tables"),
+        patch("main.rate_limit", return_value=0),
+        patch("main.has_cached_characters", return_value=True),
+        patch("main.get_characters_page", return_value=characters) as mock_get_characters_page,
+        patch("main.count_characters", return_value=12),
+        # Run the lifespan so that pagination is set up
+        TestClient(app) as lifespan_client,
+    ):
+        response = lifespan_client.get("/characters?order_by=name&order=desc&page=2&size=2")
+
+    assert response.status_code == 200
+    assert response.json()["total"] == 12
+    assert response.json()["page"] == 2
+    assert [character["name"] for character in response.json()["items"]] == ["Rick Sanchez", "Morty Smith"]
+    mock_get_characters_page.assert_called_once()
+    assert mock_get_characters_page.call_args.args[1:] == ("name", True)
+    assert mock_get_characters_page.call_args.kwargs == {"limit": 2, "offset": 2}
+
+
+def test_characters_by_cursor():
+    """Test that cursor pages link to the next page and that invalid cursors are rejected."""
+    characters = [
+        {
+            "id": character_id,
+            "name": name,
+            "status": "Alive",
+            "species": "Human",
+            "type": "",
+            "gender": "Male",
+            "origin": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+            "location": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+            "image": f"https://rickandmortyapi.com/api/character/avatar/{character_id}.jpeg",
+            "episode": ["https://rickandmortyapi.com/api/episode/1"],
+            "url": f"https://rickandmortyapi.com/api/character/{character_id}",
+            "created": "2017-11-04T18:48:46.250Z",
+        }
+        for character_id, name in [(1, "Rick Sanchez"), (2, "Morty Smith"), (3, "Summer Smith")]
+    ]
+
+    with (
+        patch("main.REFRESHER_ENABLED", False),
+        patch("main.create_tables"),
+        patch("main.rate_limit", return_value=0),
+        patch("main.get_all_characters", new_callable=AsyncMock, return_value=CachedCharacters(characters, 0)),
+        TestClient(app) as lifespan_client,
+    ):
+        first = lifespan_client.get("/characters?order_by=name&pagination=cursor&size=2").json()
+        second = lifespan_client.get(f"/characters?order_by=name&cursor={first['next_page']}&size=2").json()
+        invalid = lifespan_client.get("/characters?order_by=id&cursor=" + first["next_page"])
+        # A cursor of the id order whose sort value is an object
+        crafted = lifespan_client.get("/characters?order_by=id&cursor=WyJpZCIsICJhc2MiLCB7ImEiOiAxfSwgMSwgZmFsc2Vd")
+
+    assert [character["id"] for character in first["items"]] == [2, 1]
+    assert first["previous_page"] is None
+    assert [character["id"] for character in second["items"]] == [3]
+    assert second["next_page"] is None
+    assert second["previous_page"] is not None
+    assert invalid.status_code == crafted.status_code == 400
+
+
+def test_characters_pages_are_cached_per_version():
+    """Test that a page of a cached version is rendered once and served as rendered after."""
+    characters = CachedCharacters.from_characters(
+        [
+            {
+                "id": 1,
+                "name": "Rick Sanchez",
+                "status": "Alive",
+                "species": "Human",
+                "type": "",
+                "gender": "Male",
+                "origin": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+                "location": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+                "image": "https://rickandmortyapi.com/api/character/avatar/1.jpeg",
+                "episode": ["https://rickandmortyapi.com/api/episode/1"],
+                "url": "https://rickandmortyapi.com/api/character/1",
+                "created": "2017-11-04T18:48:46.250Z",
+            }
+        ]
+    )
+
+    with (
+        patch("main.REFRESHER_ENABLED", False),
+        patch("main.create_tables"),
+        patch("main.rate_limit", return_value=0),
+        patch("main.get_all_characters", new_callable=AsyncMock, return_value=characters),
+        patch.object(CachedCharacters, "sorted_by", wraps=characters.sorted_by) as mock_sorted_by,
+        TestClient(app) as lifespan_client,
+    ):
+        clear_cached_responses()
+        first = lifespan_client.get("/characters?order_by=name&size=10")
+        second = lifespan_client.get("/characters?order_by=name&size=10")
+
+    assert first.status_code == second.status_code == 200
+    assert first.content == second.content
+    assert first.json()["total"] == 1
+    assert first.json()["items"][0]["created"] == "2017-11-04T18:48:46.250Z"
+    mock_sorted_by.assert_called_once()
+
+
+def test_characters_pages_are_cached_per_pagination_mode():
+    """Test that offset and cursor pages of the same size are cached apart."""
+    characters = CachedCharacters.from_characters(
+        [
+            {
+                "id": 1,
+                "name": "Rick Sanchez",
+                "status": "Alive",
+                "species": "Human",
+                "type": "",
+                "gender": "Male",
+                "origin": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+                "location": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+                "image": "https://rickandmortyapi.com/api/character/avatar/1.jpeg",
+                "episode": ["https://rickandmortyapi.com/api/episode/1"],
+                "url": "https://rickandmortyapi.com/api/character/1",
+                "created": "2017-11-04T18:48:46.250Z",
+            }
+        ]
+    )
+
+    with (
+        patch("main.REFRESHER_ENABLED", False),
+        patch("main.create_tables"),
+        patch("main.rate_limit", return_value=0),
+        patch("main.get_all_characters", new_callable=AsyncMock, return_value=characters),
+        TestClient(app) as lifespan_client,
+    ):
+        clear_cached_responses()
+        responses = [
+            lifespan_client.get(f"/characters?pagination={pagination}&page=1&size=10").json()
+            for pagination in ("offset", "cursor", "offset", "cursor")
+        ]
+
+    for offset_page in responses[::2]:
+        assert offset_page["total"] == 1 and "next_page" not in offset_page
+    for cursor_page in responses[1::2]:
+        assert "next_page" in cursor_page and "total" not in cursor_page
+
+
+def test_characters_pages_are_the_same_from_cache_and_database(tmp_path):
+    """Test that a page served from the cache is the page served from the database."""
+    characters = [
+        {
+            "id": character_id,
+            "name": name,
+            "status": "Alive",
+            "species": "Human",
+            "type": "",
+            "gender": "Male",
+            "origin": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+            "location": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+            "image": f"https://rickandmortyapi.com/api/character/avatar/{character_id}.jpeg",
+            "episode": ["https://rickandmortyapi.com/api/episode/1"],
+            "url": f"https://rickandmortyapi.com/api/character/{character_id}",
+            "created": "2017-11-04T18:48:46.250Z",
+        }
+        for character_id, name in [(1, "Rick Sanchez"), (2, "Morty Smith"), (3, "Summer Smith")]
+    ]
+    # Connections are not shared between the event loops of the setup and of the test client
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/characters.db", poolclass=NullPool)
+    SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    async def save_characters():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        async with SessionLocal() as db:
+            await save_characters_to_db(characters, db, prune=True)
+
+    async def get_test_db():
+        async with SessionLocal() as db:
+            yield db
+
+    asyncio.run(save_characters())
+    paths = ["/characters?order_by=name&size=2", "/characters?order_by=name&pagination=cursor&size=2"]
+    bodies = {}
+    for source in ("cache", "database"):
+        with (
+            patch.dict(app.dependency_overrides, {get_db: get_test_db}),
+            patch("main.CHARACTERS_SOURCE", source),
+            patch("main.REFRESHER_ENABLED", False),
+            patch("main.create_tables"),
+            patch("main.rate_limit", return_value=0),
+            patch("main.has_cached_characters", return_value=True),
+            patch("main.get_all_characters", new_callable=AsyncMock, return_value=CachedCharacters(characters, 0)),
+            TestClient(app) as lifespan_client,
+        ):
+            clear_cached_responses()
+            bodies[source] = [lifespan_client.get(path).json() for path in paths]
+
+    assert bodies["cache"] == bodies["database"]
+    assert bodies["cache"][0]["items"][0]["created"] == "2017-11-04T18:48:46.250Z"
+
+
+@pytest.mark.parametrize("create_tables_on_startup", [True, False])
+def test_lifespan_creates_tables_unless_created_by_the_server(create_tables_on_startup):
+    """Test that the workers skip creating the tables once the server created them."""
+    with (
+        patch("main.CREATE_TABLES_ON_STARTUP", create_tables_on_startup),
+        patch("main.REFRESHER_ENABLED", False),
+        patch("main.create_tables") as mock_create_tables,
+        TestClient(app),
+    ):
+        pass
+
+    assert mock_create_tables.called == create_tables_on_startup
+
+
+def test_livez():
+    """Test that liveness only depends on the process serving requests."""
+    with patch("main.get_health") as mock_get_health:
+        response = client.get("/livez")
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "alive"}
+    mock_get_health.assert_not_called()
+
+
+@pytest.mark.parametrize(("health_status", "status_code"), [("healthy", 200), ("unhealthy", 503)])
+def test_readyz_serves_cached_health(health_status, status_code):
+    """Test that readiness is served from the last background health check, with its age."""
+    component = ComponentHealth(status=health_status, message="", metrics={})
+    health = HealthCheck(
+        status=health_status,
+        timestamp="2025-01-01T00:00:00",
+        checks=ComponentChecks(database=component, cache=component),
+        age=4.2,
+    )
+
+    with (
+        patch("main.get_cached_health", return_value=health),
+        patch("main.refresh_health") as mock_refresh_health,
+    ):
+        response = client.get("/readyz")
+
+    assert response.status_code == status_code
+    assert response.json()["age"] == 4.2
+    assert response.json()["checks"]["database"]["status"] == health_status
+    mock_refresh_health.assert_not_called()
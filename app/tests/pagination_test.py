@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from exceptions import BadRequestException
+from pagination import Cursor, decode_cursor, encode_cursor, keyset_slice, paginate_cursor
+
+NAMES = ["Beth Smith", "Beth Smith", "Morty Smith", "Rick Sanchez", "Summer Smith"]
+CHARACTERS = [{"id": character_id, "name": name} for character_id, name in enumerate(NAMES, start=1)]
+
+
+def paginate_characters(order: str, size: int, cursor: str | None = None):
+    keys = [(character["name"], character["id"]) for character in CHARACTERS]
+
+    async def fetch(after: tuple | None, ascending: bool, limit: int) -> list[dict]:
+        return keyset_slice(CHARACTERS, keys, after, ascending, limit)
+
+    return asyncio.run(
+        paginate_cursor(fetch, lambda character: (character["name"], character["id"]), "name", order, size, cursor)
+    )
+
+
+def test_cursor_round_trip():
+    """Test that a cursor decodes to what was encoded."""
+    cursor = Cursor("name", "asc", "Rick Sanchez", 1, False)
+
+    assert decode_cursor(encode_cursor(cursor), "name", "asc") == cursor
+
+
+@pytest.mark.parametrize(
+    ("cursor", "order_by", "order"),
+    [
+        ("not a cursor", "name", "asc"),
+        (encode_cursor(Cursor("name", "asc", "Rick Sanchez", 1, False)), "name", "desc"),
+        (encode_cursor(Cursor("name", "asc", "Rick Sanchez", 1, False)), "id", "asc"),
+        # Sort value that is neither an int nor a string
+        ("WyJpZCIsICJhc2MiLCB7ImEiOiAxfSwgMSwgZmFsc2Vd", "id", "asc"),
+        (encode_cursor(Cursor("name", "asc", "Rick Sanchez", "1", False)), "name", "asc"),
+        (encode_cursor(Cursor("name", "asc", "Rick Sanchez", 1, 0)), "name", "asc"),
+        (encode_cursor(Cursor("id", "asc", "1", 1, False)), "id", "asc"),
+        (encode_cursor(Cursor("name", "asc", 1, 1, False)), "name", "asc"),
+    ],
+)
+def test_decode_invalid_cursor(cursor, order_by, order):
+    """Test that malformed cursors and cursors of another sort order are rejected."""
+    with pytest.raises(BadRequestException):
+        decode_cursor(cursor, order_by, order)
+
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_paginate_cursor_forwards_and_backwards(order):
+    """Test walking all pages forwards and back again by cursor."""
+    expected_ids = [1, 2, 3, 4, 5] if order == "asc" else [5, 4, 3, 2, 1]
+
+    pages = [paginate_characters(order, 2)]
+    while pages[-1].next_page:
+        pages.append(paginate_characters(order, 2, pages[-1].next_page))
+
+    assert [[character["id"] for character in page.items] for page in pages] == [
+        expected_ids[0:2],
+        expected_ids[2:4],
+        expected_ids[4:],
+    ]
+    assert pages[0].previous_page is None
+
+    previous = paginate_characters(order, 2, pages[-1].previous_page)
+    assert [character["id"] for character in previous.items] == expected_ids[2:4]
+    first = paginate_characters(order, 2, previous.previous_page)
+    assert [character["id"] for character in first.items] == expected_ids[0:2]
+    assert first.previous_page is None
+    assert first.next_page is not None
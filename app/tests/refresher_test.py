@@ -0,0 +1,88 @@
+import asyncio
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from exceptions import ServiceUnavailableException
+from refresher import REFRESH_INTERVAL, is_refresher_running, refresh_once, start_refresher, stop_refresher
+from utils import REFRESH_FAILURES, REFRESH_INTERVAL_SECONDS, REFRESH_LAST_SUCCESS
+
+
+@pytest.fixture
+def mock_session():
+    """Mock the sessions opened by the refresher."""
+    with patch("refresher.SessionLocal", return_value=MagicMock()) as mock_session:
+        yield mock_session
+
+
+@pytest.fixture
+def mock_refresh_characters():
+    """Mock the single-flight refresh."""
+    with patch("refresher.refresh_characters") as mock_refresh:
+        yield mock_refresh
+
+
+@pytest.mark.anyio
+async def test_refresh_once_skips_recently_refreshed(fake_redis, mock_session, mock_refresh_characters):
+    """Test that a replica skips the refresh when another one refreshed during the interval."""
+    await fake_redis.set("characters", json.dumps({"updated_at": time.time(), "characters": []}))
+
+    assert await refresh_once() is True
+
+    mock_refresh_characters.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_refresh_once_refreshes_old_characters(fake_redis, mock_session, mock_refresh_characters):
+    """Test that characters older than the interval are refreshed and the success is recorded."""
+    await fake_redis.set("characters", json.dumps({"updated_at": time.time() - REFRESH_INTERVAL, "characters": []}))
+    mock_refresh_characters.return_value = [{"id": 1}]
+
+    assert await refresh_once() is True
+
+    mock_refresh_characters.assert_called_once_with(mock_session.return_value.__aenter__.return_value)
+    mock_session.return_value.__aexit__.assert_called_once()
+    assert REFRESH_LAST_SUCCESS.labels(app_name="fastapi-app")._value.get() == pytest.approx(time.time(), abs=5)
+
+
+@pytest.mark.anyio
+async def test_refresh_once_failure(fake_redis, mock_session, mock_refresh_characters):
+    """Test that a failed refresh is counted."""
+    mock_refresh_characters.side_effect = ServiceUnavailableException()
+    failures = REFRESH_FAILURES.labels(app_name="fastapi-app")._value.get()
+
+    assert await refresh_once() is False
+
+    assert REFRESH_FAILURES.labels(app_name="fastapi-app")._value.get() == failures + 1
+    mock_session.return_value.__aexit__.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_refresher_warms_cache_at_start(fake_redis, mock_session, mock_refresh_characters):
+    """Test that the refresher refreshes right away when started, exports its interval and stops cleanly."""
+
+    start_refresher()
+    await asyncio.sleep(0.01)
+    assert is_refresher_running()
+    await stop_refresher()
+
+    assert not is_refresher_running()
+    mock_refresh_characters.assert_called_once()
+    assert REFRESH_INTERVAL_SECONDS.labels(app_name="fastapi-app")._value.get() == REFRESH_INTERVAL
+
+
+@pytest.mark.anyio
+async def test_refresher_retries_soon_while_the_lock_is_held(fake_redis, mock_session, mock_refresh_characters):
+    """Test that a refresh skipped for a lock holder that does not refresh the characters is retried soon."""
+    # The lock holder leaves the cache empty
+    mock_refresh_characters.side_effect = [None, [{"id": 1}]]
+    failures = REFRESH_FAILURES.labels(app_name="fastapi-app")._value.get()
+
+    with patch("refresher.REFRESH_RETRY_INTERVAL", 0.01):
+        start_refresher()
+        await asyncio.sleep(0.05)
+        await stop_refresher()
+
+    assert mock_refresh_characters.call_count == 2
+    assert REFRESH_FAILURES.labels(app_name="fastapi-app")._value.get() == failures
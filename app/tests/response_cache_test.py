@@ -0,0 +1,45 @@
+from unittest.mock import patch
+
+import pytest
+import response_cache
+from response_cache import cache_response, clear_cached_responses, get_cached_response
+
+
+@pytest.fixture(autouse=True)
+def empty_response_cache():
+    """Start every test with an empty response cache."""
+    clear_cached_responses()
+    yield
+    clear_cached_responses()
+
+
+def test_cached_response_of_version():
+    """Test that responses are only served for the dataset version they were rendered from."""
+    cache_response("v1", ("name", "asc", 1, 50), b"page 1")
+
+    assert get_cached_response("v1", ("name", "asc", 1, 50)) == b"page 1"
+    assert get_cached_response("v1", ("name", "asc", 2, 50)) is None
+    assert get_cached_response("v2", ("name", "asc", 1, 50)) is None
+    assert get_cached_response(None, ("name", "asc", 1, 50)) is None
+
+
+def test_new_version_drops_responses():
+    """Test that caching a response of a new version drops the responses of the previous one."""
+    cache_response("v1", "page 1", b"v1 page 1")
+    cache_response("v2", "page 2", b"v2 page 2")
+
+    assert response_cache._responses == {"page 2": b"v2 page 2"}
+    assert response_cache._responses_bytes == len(b"v2 page 2")
+
+
+def test_response_cache_memory_bound():
+    """Test that the least recently used responses are evicted beyond RESPONSE_CACHE_MAX_BYTES."""
+    with patch("response_cache.RESPONSE_CACHE_MAX_BYTES", 10):
+        cache_response("v1", "a", b"aaaa")
+        cache_response("v1", "b", b"bbbb")
+        get_cached_response("v1", "a")
+        cache_response("v1", "c", b"cccc")
+        cache_response("v1", "too large", b"x" * 11)
+
+    assert list(response_cache._responses) == ["a", "c"]
+    assert response_cache._responses_bytes == 8
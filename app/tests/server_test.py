@@ -0,0 +1,74 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from server import available_cpus, cpu_quota, get_workers, run
+
+
+@pytest.fixture
+def cgroup(tmp_path):
+    """Fixture pointing the cgroup CPU files at a temporary directory, empty until the test writes them."""
+    with (
+        patch("server.CGROUP_V2_CPU_MAX", str(tmp_path / "cpu.max")),
+        patch("server.CGROUP_V1_CPU_QUOTA", str(tmp_path / "cpu.cfs_quota_us")),
+        patch("server.CGROUP_V1_CPU_PERIOD", str(tmp_path / "cpu.cfs_period_us")),
+    ):
+        yield tmp_path
+
+
+@pytest.mark.parametrize(
+    ("files", "expected_quota"),
+    [
+        ({"cpu.max": "150000 100000\n"}, 1.5),
+        ({"cpu.max": "max 100000\n"}, None),
+        ({"cpu.cfs_quota_us": "75000\n", "cpu.cfs_period_us": "100000\n"}, 0.75),
+        ({"cpu.cfs_quota_us": "-1\n", "cpu.cfs_period_us": "100000\n"}, None),
+        ({}, None),
+    ],
+)
+def test_cpu_quota(cgroup, files, expected_quota):
+    """Test that the CPU quota is read from cgroup v2, then cgroup v1, and that no limit is no quota."""
+    for name, content in files.items():
+        (cgroup / name).write_text(content)
+
+    assert cpu_quota() == expected_quota
+
+
+@pytest.mark.parametrize(("quota", "expected_cpus"), [(None, 8), (0.75, 1), (2.5, 3), (16, 8)])
+def test_available_cpus(quota, expected_cpus):
+    """Test that the CPUs are rounded up from the quota and bounded by the CPUs the process may run on."""
+    with (
+        patch("server.os.sched_getaffinity", return_value=set(range(8)), create=True),
+        patch("server.cpu_quota", return_value=quota),
+    ):
+        assert available_cpus() == expected_cpus
+
+
+@pytest.mark.parametrize(
+    ("workers", "environ", "expected_workers"),
+    [(0, {}, 1), (0, {"PROMETHEUS_MULTIPROC_DIR": "/tmp/metrics"}, 8), (2, {}, 2)],
+)
+def test_get_workers(workers, environ, expected_workers):
+    """Test that one worker per CPU is started by default only when the metrics of the workers are aggregated."""
+    with (
+        patch("server.SERVER_WORKERS", workers),
+        patch("server.available_cpus", return_value=8),
+        patch.dict("server.os.environ", environ, clear=True),
+    ):
+        assert get_workers() == expected_workers
+
+
+@pytest.mark.parametrize(("workers", "imported"), [(1, False), (4, True)])
+def test_run(workers, imported):
+    """Test that a single worker serves the app object, while several workers import it."""
+    app = MagicMock()
+
+    with patch("server.SERVER_WORKERS", workers), patch("server.uvicorn.run") as mock_run:
+        run(app, "main:app", log_config={})
+
+    assert mock_run.call_args.args[0] == ("main:app" if imported else app)
+    assert mock_run.call_args.kwargs["workers"] == workers
+    assert mock_run.call_args.kwargs["port"] == 8000
+    assert mock_run.call_args.kwargs["timeout_graceful_shutdown"] == 25
+    # Client addresses are read from X-Forwarded-For behind the trusted proxies only
+    assert mock_run.call_args.kwargs["proxy_headers"] is True
+    assert mock_run.call_args.kwargs["forwarded_allow_ips"] == "127.0.0.1"
@@ -0,0 +1,112 @@
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from cache import CACHE_SOFT_TTL, CachedCharacters, get_cached_characters, l1_invalidate
+from characters import Crawl, bootstrap_characters, refresh_characters
+from page_cache import CachedPage
+from snapshot import PREAMBLE, SNAPSHOT_MAGIC, export_snapshot, read_snapshot, write_snapshot
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def make_characters(count: int = 3) -> list[dict]:
+    return [
+        {
+            "id": character_id,
+            "name": f"Character {character_id}",
+            "origin": {"name": "Earth (C-137)", "url": "https://rickandmortyapi.com/api/location/1"},
+            "episode": ["https://rickandmortyapi.com/api/episode/1"],
+            "created": "2017-11-04T18:48:46.250Z",
+        }
+        for character_id in range(1, count + 1)
+    ]
+
+
+@pytest.mark.parametrize(("codec", "compression"), [("json", "none"), ("json", "zlib"), ("orjson", "zstd")])
+def test_snapshot_round_trip(tmp_path, codec, compression):
+    """Test that a snapshot is read back with the characters, their version and when they were fetched."""
+    cached = CachedCharacters.from_characters(make_characters())
+    path = tmp_path / "characters.snapshot"
+
+    size = write_snapshot(str(path), cached, codec=codec, compression=compression)
+
+    assert size == path.stat().st_size
+    assert read_snapshot(str(path)) == cached
+    # The snapshot replaced atomically leaves no temporary file behind
+    assert [file.name for file in tmp_path.iterdir()] == ["characters.snapshot"]
+
+
+def test_snapshot_round_trip_empty(tmp_path):
+    """Test that a snapshot of no characters is read back empty."""
+    cached = CachedCharacters.from_characters([])
+    write_snapshot(str(tmp_path / "characters.snapshot"), cached)
+
+    assert read_snapshot(str(tmp_path / "characters.snapshot")).characters == []
+
+
+@pytest.mark.parametrize(
+    ("corrupt", "message"),
+    [
+        (lambda data: data[:-1] + bytes([data[-1] ^ 1]), "checksum mismatch"),
+        (lambda data: b"NOTSNAP\0" + data[len(SNAPSHOT_MAGIC) :], "Not a characters snapshot"),
+        (lambda data: PREAMBLE.pack(SNAPSHOT_MAGIC, 99, 0) + data[PREAMBLE.size :], "format version 99"),
+        (lambda data: data[:4], "too short"),
+    ],
+)
+def test_read_snapshot_invalid(tmp_path, corrupt, message):
+    """Test that corrupted, foreign, future and truncated snapshots are rejected."""
+    path = tmp_path / "characters.snapshot"
+    write_snapshot(str(path), CachedCharacters.from_characters(make_characters()))
+    path.write_bytes(corrupt(path.read_bytes()))
+
+    with pytest.raises(ValueError, match=message):
+        read_snapshot(str(path))
+
+
+@pytest.mark.anyio
+async def test_bootstrap_characters(fake_redis, tmp_path):
+    """Test that an old snapshot is cached as just stale, so that it is served while it is refreshed."""
+    path = str(tmp_path / "characters.snapshot")
+    snapshot = CachedCharacters(characters=make_characters(), updated_at=time.time() - 86400, version="v1")
+    write_snapshot(path, snapshot)
+
+    cached = await bootstrap_characters(path)
+
+    assert cached.characters == snapshot.characters
+    l1_invalidate()
+    from_redis = await get_cached_characters()
+    assert from_redis.characters == snapshot.characters
+    assert from_redis.is_stale and not from_redis.is_expired
+    assert from_redis.age == pytest.approx(CACHE_SOFT_TTL, abs=5)
+
+
+@pytest.mark.anyio
+async def test_bootstrap_characters_keeps_cached_characters(fake_redis, tmp_path):
+    """Test that a snapshot only replaces the cached characters when forced, and that a missing one is ignored."""
+    path = str(tmp_path / "characters.snapshot")
+    write_snapshot(path, CachedCharacters.from_characters(make_characters(3)))
+    await bootstrap_characters(path)
+    write_snapshot(path, CachedCharacters.from_characters(make_characters(5)))
+
+    assert await bootstrap_characters(path) is None
+    assert await bootstrap_characters(str(tmp_path / "missing.snapshot"), force=True) is None
+    assert len((await bootstrap_characters(path, force=True)).characters) == 5
+
+
+@pytest.mark.anyio
+async def test_refresh_saves_snapshot(fake_redis, tmp_path):
+    """Test that a refresh saves the crawled characters to the snapshot, which export_snapshot overwrites."""
+    path = str(tmp_path / "characters.snapshot")
+    characters = make_characters()
+
+    with (
+        patch("characters.SNAPSHOT_PATH", path),
+        patch("characters.crawl_pages", return_value=Crawl(cached=[None], pages=[CachedPage(1, characters, "")])),
+        patch("characters.save_characters_to_db", return_value=len(characters)),
+    ):
+        await refresh_characters(MagicMock(spec=AsyncSession))
+
+    assert read_snapshot(path).characters == characters
+    (tmp_path / "characters.snapshot").unlink()
+    assert await export_snapshot(path) > 0
+    assert read_snapshot(path).characters == characters
@@ -0,0 +1,54 @@
+import asyncio
+from unittest.mock import patch
+
+import httpx
+import pytest
+import upstream
+from upstream import close_http_client, create_http_client, get_http_client, set_http_client
+
+
+@pytest.fixture(autouse=True)
+def reset_http_client():
+    """Make sure every test starts without a shared client."""
+    set_http_client(None)
+    yield
+    set_http_client(None)
+
+
+def test_get_http_client_is_shared():
+    """Test that the same pooled client is returned on every call."""
+    client = get_http_client()
+
+    assert get_http_client() is client
+    assert not client.is_closed
+
+
+def test_set_http_client_injects_client():
+    """Test that an injected client is used instead of creating a new one."""
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+
+    set_http_client(client)
+
+    assert get_http_client() is client
+
+
+def test_close_http_client():
+    """Test that closing the shared client closes it and creates a new one on next use."""
+    client = get_http_client()
+
+    asyncio.run(close_http_client())
+
+    assert client.is_closed
+    assert get_http_client() is not client
+
+
+def test_create_http_client_without_h2_falls_back_to_http1():
+    """Test that HTTP/2 is disabled when the h2 package is not installed."""
+    with (
+        patch.object(upstream, "UPSTREAM_HTTP2", True),
+        patch("upstream.importlib.util.find_spec", return_value=None),
+        patch("upstream.httpx.AsyncClient") as mock_client,
+    ):
+        create_http_client()
+
+    assert mock_client.call_args.kwargs["http2"] is False
@@ -0,0 +1,185 @@
+import os
+import subprocess
+import sys
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+import utils
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from prometheus_client.openmetrics.parser import text_string_to_metric_families
+from prometheus_client.values import MultiProcessValue
+from starlette.routing import Match
+from utils import (
+    REQUESTS,
+    REQUESTS_IN_PROGRESS,
+    PrometheusMiddleware,
+    clear_multiprocess_metrics,
+    mark_process_dead,
+    metrics,
+)
+
+
+def create_app(app_name: str) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(PrometheusMiddleware, app_name)
+
+    @app.get("/characters/{character_id}")
+    async def character(character_id: int):
+        if character_id == 0:
+            raise HTTPException(status_code=404)
+        return {"id": character_id}
+
+    @app.get("/stream")
+    async def stream():
+        async def chunks():
+            for chunk in (b"first ", b"second"):
+                yield chunk
+
+        return StreamingResponse(chunks())
+
+    @app.get("/error")
+    async def error():
+        raise RuntimeError("boom")
+
+    return app
+
+
+def sample(name: str, **labels) -> float | None:
+    return REGISTRY.get_sample_value(name, labels)
+
+
+def test_prometheus_middleware_records_route_templates():
+    """Test that requests are recorded by route template and that paths no route handles are not recorded."""
+    client = TestClient(create_app("templates-app"))
+
+    assert client.get("/characters/1").status_code == 200
+    assert client.get("/characters/2").status_code == 200
+    assert client.get("/characters/0").status_code == 404
+    assert client.get("/unknown").status_code == 404
+
+    labels = {"method": "GET", "path": "/characters/{character_id}", "app_name": "templates-app"}
+    assert sample("fastapi_requests_total", **labels) == 3
+    assert sample("fastapi_responses_total", status_code="200", **labels) == 2
+    assert sample("fastapi_responses_total", status_code="404", **labels) == 1
+    assert sample("fastapi_exceptions_total", status_code="404", **labels) == 1
+    assert sample("fastapi_requests_duration_seconds_count", **labels) == 3
+    assert sample("fastapi_requests_in_progress", **labels) == 0
+    assert sample("fastapi_requests_total", method="GET", path="/unknown", app_name="templates-app") is None
+
+
+def test_prometheus_middleware_streaming_response():
+    """Test that streaming responses are passed through and recorded with their status code."""
+    client = TestClient(create_app("streaming-app"))
+
+    response = client.get("/stream")
+
+    assert response.content == b"first second"
+    labels = {"method": "GET", "path": "/stream", "app_name": "streaming-app"}
+    assert sample("fastapi_responses_total", status_code="200", **labels) == 1
+    assert sample("fastapi_requests_duration_seconds_count", **labels) == 1
+
+
+def test_prometheus_middleware_exception():
+    """Test that an exception raised by a route is recorded once as a 500."""
+    client = TestClient(create_app("exception-app"), raise_server_exceptions=False)
+
+    assert client.get("/error").status_code == 500
+
+    labels = {"method": "GET", "path": "/error", "app_name": "exception-app"}
+    assert sample("fastapi_responses_total", status_code="500", **labels) == 1
+    assert sample("fastapi_exceptions_total", status_code="500", **labels) == 1
+    assert sample("fastapi_requests_in_progress", **labels) == 0
+
+
+@pytest.mark.parametrize(("max_entries", "expected_resolutions"), [(1, 3), (1024, 2)])
+def test_prometheus_middleware_resolves_routes_once(max_entries, expected_resolutions):
+    """Test that the route of a path is resolved once, and that the resolved paths are bounded."""
+    route = MagicMock(path="/characters/{character_id}")
+    route.matches.side_effect = lambda scope: (Match.FULL if scope["path"] != "/unknown" else Match.NONE, {})
+    middleware = PrometheusMiddleware(AsyncMock(), "resolve-app")
+
+    with patch("utils.ROUTE_CACHE_MAX_ENTRIES", max_entries):
+        paths = [
+            middleware.get_path({"method": "GET", "path": path, "app": MagicMock(routes=[route])})
+            for path in ("/characters/1", "/unknown", "/characters/1")
+        ]
+
+    assert paths == ["/characters/{character_id}", None, "/characters/{character_id}"]
+    # The first path is resolved again only once it was evicted by the second
+    assert route.matches.call_count == expected_resolutions
+
+
+@pytest.fixture
+def multiprocess_dir(tmp_path):
+    """Fixture aggregating the metrics of the worker processes in a temporary directory."""
+    with patch("utils.PROMETHEUS_MULTIPROC_DIR", str(tmp_path)):
+        yield tmp_path
+
+
+def record_in_worker(pid: int, app_name: str, in_progress: int) -> None:
+    """Record a request and requests in progress as the worker process `pid` would."""
+    labels = {"method": "GET", "path": "/characters", "app_name": app_name}
+    with (
+        patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": utils.PROMETHEUS_MULTIPROC_DIR}),
+        patch("prometheus_client.values.ValueClass", MultiProcessValue(lambda: pid)),
+    ):
+        REQUESTS.labels(**labels).inc()
+        REQUESTS_IN_PROGRESS.labels(**labels).set(in_progress)
+    # Every worker has children of its own
+    REQUESTS.remove(*labels.values())
+    REQUESTS_IN_PROGRESS.remove(*labels.values())
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def scrape(app_name: str) -> dict[str, float]:
+    families = text_string_to_metric_families(metrics(MagicMock()).body.decode())
+    return {
+        family.name: sample.value
+        for family in families
+        for sample in family.samples
+        if sample.labels.get("app_name") == app_name
+        and family.name in ("fastapi_requests", "fastapi_requests_in_progress")
+    }
+
+
+def test_metrics_aggregates_worker_processes(multiprocess_dir):
+    """Test that /metrics sums the metrics of every worker and drops the live gauges of dead workers."""
+    record_in_worker(os.getpid(), "multiprocess-app", in_progress=2)
+    record_in_worker(dead_pid(), "multiprocess-app", in_progress=3)
+
+    # The requests of the dead worker are kept, its requests in progress are not
+    assert scrape("multiprocess-app") == {"fastapi_requests": 2, "fastapi_requests_in_progress": 2}
+    assert len(list(multiprocess_dir.glob("gauge_livesum_*.db"))) == 1
+
+
+def test_mark_process_dead_and_clear_multiprocess_metrics(multiprocess_dir):
+    """Test that a worker exiting drops its live gauges, and that a restart drops every metric."""
+    record_in_worker(os.getpid(), "restart-app", in_progress=1)
+
+    mark_process_dead(os.getpid())
+    assert scrape("restart-app") == {"fastapi_requests": 1}
+
+    clear_multiprocess_metrics()
+    assert list(multiprocess_dir.iterdir()) == []
+    assert scrape("restart-app") == {}
+
+
+def test_importing_the_app_sets_no_metric(tmp_path):
+    """Test that the app sets no metric when imported, before the server clears the metrics of its previous run."""
+    subprocess.run(
+        [sys.executable, "-c", "import main"],
+        env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path), "OTEL_SDK_DISABLED": "true"},
+        cwd=os.path.dirname(utils.__file__),
+        check=True,
+        capture_output=True,
+    )
+
+    assert list(tmp_path.iterdir()) == []